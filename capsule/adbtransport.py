@@ -0,0 +1,249 @@
+# Copyright 2016 The Vanadium Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+"""Talks to the adb server directly instead of running the adb client.
+
+Every adb client command pays for starting a new process and a handshake with
+the adb server. AdbTransport instead speaks the adb server protocol over
+sockets (see SERVICES.TXT and SYNC.TXT in the adb sources):
+
+  * Requests are a 4 digit hex length followed by the request string. The
+    server answers OKAY, or FAIL followed by a hex length and a message.
+  * host:transport:<serial> binds the socket to a device. The next request is
+    a device service such as shell:<cmd>, exec:<cmd> or sync:.
+  * shell: and exec: services stream their output until the socket closes, so
+    every command needs its own socket. sync: connections can serve any
+    number of file transfers and are kept in a pool.
+"""
+
+import os
+import socket
+import struct
+import threading
+import time
+
+DEFAULT_HOST = '127.0.0.1'
+DEFAULT_PORT = int(os.environ.get('ANDROID_ADB_SERVER_PORT', 5037))
+SOCKET_TIMEOUT = 60
+# pm install of a large APK prints nothing until it is done, which can take
+# minutes on a slow device.
+INSTALL_TIMEOUT = 600
+# Maximum number of connections to the same device in use at once.
+POOL_SIZE = 4
+# The sync protocol limits the size of a DATA chunk.
+SYNC_DATA_MAX = 64 * 1024
+# Regular file with rw-r--r-- permissions.
+SYNC_FILE_MODE = 0100644
+APK_TMP_DIR = '/data/local/tmp/'
+
+
+class AdbError(IOError):
+  """The adb server or device answered with an error."""
+
+
+def recv_exactly(sock, size):
+  """Reads exactly size bytes from the socket."""
+  chunks = []
+  while size > 0:
+    chunk = sock.recv(min(size, SYNC_DATA_MAX))
+    if not chunk:
+      raise AdbError('Connection closed by the adb server.')
+    chunks.append(chunk)
+    size -= len(chunk)
+  return ''.join(chunks)
+
+
+def recv_all(sock):
+  """Reads from the socket until the other end closes it."""
+  chunks = []
+  while True:
+    chunk = sock.recv(SYNC_DATA_MAX)
+    if not chunk:
+      return ''.join(chunks)
+    chunks.append(chunk)
+
+
+class AdbTransport(object):
+  """Sends shell, exec-out, sync and install requests to one device."""
+
+  def __init__(self, serialno, host=DEFAULT_HOST, port=DEFAULT_PORT,
+               pool_size=POOL_SIZE):
+    """Constructor for AdbTransport class."""
+    self.serialno = serialno
+    self.host = host
+    self.port = port
+    self.slots = threading.BoundedSemaphore(pool_size)
+    self.lock = threading.Lock()
+    # Idle sync connections that can be reused.
+    self.idle_sync = []
+    # Number of requests sent to the server, for profiling.
+    self.num_requests = 0
+
+  def _request(self, sock, request):
+    sock.sendall('%04x%s' % (len(request), request))
+    self.num_requests += 1
+    status = recv_exactly(sock, 4)
+    if status != 'OKAY':
+      length = int(recv_exactly(sock, 4), 16)
+      raise AdbError('%s failed: %s' % (request, recv_exactly(sock, length)))
+
+  def _connect(self, service, timeout=SOCKET_TIMEOUT):
+    """Opens a socket bound to the device and starts the service on it."""
+    sock = socket.create_connection((self.host, self.port), timeout)
+    try:
+      self._request(sock, 'host:transport:' + self.serialno)
+      self._request(sock, service)
+    except:
+      sock.close()
+      raise
+    return sock
+
+  def _run_service(self, service, timeout=SOCKET_TIMEOUT):
+    self.slots.acquire()
+    try:
+      sock = self._connect(service, timeout)
+      try:
+        return recv_all(sock)
+      finally:
+        sock.close()
+    finally:
+      self.slots.release()
+
+  def shell(self, cmd, timeout=SOCKET_TIMEOUT):
+    """Runs a shell command and returns its output."""
+    return self._run_service('shell:' + cmd, timeout)
+
+  def exec_out(self, cmd):
+    """Runs a command without a pty, so binary output is not mangled."""
+    return self._run_service('exec:' + cmd)
+
+  def _acquire_sync(self):
+    self.slots.acquire()
+    with self.lock:
+      if self.idle_sync:
+        return self.idle_sync.pop()
+    try:
+      return self._connect('sync:')
+    except:
+      self.slots.release()
+      raise
+
+  def _release_sync(self, sock, reusable):
+    if reusable:
+      with self.lock:
+        self.idle_sync.append(sock)
+    else:
+      sock.close()
+    self.slots.release()
+
+  def _sync(self, func, *args):
+    """Runs func(sock, *args) on a pooled sync connection."""
+    sock = self._acquire_sync()
+    reusable = False
+    try:
+      result = func(sock, *args)
+      reusable = True
+      return result
+    finally:
+      self._release_sync(sock, reusable)
+
+  def _sync_pull(self, sock, remote_path):
+    sock.sendall('RECV' + struct.pack('<I', len(remote_path)) + remote_path)
+    self.num_requests += 1
+    chunks = []
+    while True:
+      msg_id, length = struct.unpack('<4sI', recv_exactly(sock, 8))
+      if msg_id == 'DATA':
+        chunks.append(recv_exactly(sock, length))
+      elif msg_id == 'DONE':
+        return ''.join(chunks)
+      elif msg_id == 'FAIL':
+        raise AdbError('Pull of %s failed: %s' % (remote_path,
+                                                 recv_exactly(sock, length)))
+      else:
+        raise AdbError('Unexpected sync response ' + repr(msg_id))
+
+  def _sync_push(self, sock, data, remote_path, mode):
+    header = '%s,%d' % (remote_path, mode)
+    sock.sendall('SEND' + struct.pack('<I', len(header)) + header)
+    self.num_requests += 1
+    for i in range(0, len(data), SYNC_DATA_MAX):
+      chunk = data[i:i + SYNC_DATA_MAX]
+      sock.sendall('DATA' + struct.pack('<I', len(chunk)) + chunk)
+    sock.sendall('DONE' + struct.pack('<I', int(time.time())))
+    msg_id, length = struct.unpack('<4sI', recv_exactly(sock, 8))
+    if msg_id != 'OKAY':
+      raise AdbError('Push to %s failed: %s' % (remote_path,
+                                                recv_exactly(sock, length)))
+
+  def pull_data(self, remote_path):
+    """Returns the contents of a file on the device."""
+    return self._sync(self._sync_pull, remote_path)
+
+  def pull(self, remote_path, local_path):
+    """Copies a file from the device to the host."""
+    data = self.pull_data(remote_path)
+    with open(local_path, 'wb') as out_file:
+      out_file.write(data)
+
+  def push_data(self, data, remote_path, mode=SYNC_FILE_MODE):
+    """Writes data to a file on the device."""
+    self._sync(self._sync_push, data, remote_path, mode)
+
+  def push(self, local_path, remote_path, mode=SYNC_FILE_MODE):
+    """Copies a file from the host to the device."""
+    with open(local_path, 'rb') as in_file:
+      self.push_data(in_file.read(), remote_path, mode)
+
+  def install(self, apk_path):
+    """Installs (or reinstalls) an APK. Returns the output of pm install."""
+    remote_path = APK_TMP_DIR + os.path.basename(apk_path)
+    self.push(apk_path, remote_path)
+    try:
+      out = self.shell("pm install -r '" + remote_path + "'", INSTALL_TIMEOUT)
+    finally:
+      self.shell("rm -f '" + remote_path + "'")
+    if 'Success' not in out:
+      raise AdbError('Could not install %s: %s' % (apk_path, out.strip()))
+    return out
+
+  def uninstall(self, package_name):
+    """Uninstalls a package. Returns the output of pm uninstall."""
+    return self.shell('pm uninstall ' + package_name)
+
+  def reboot(self):
+    """Reboots the device. Returns before the device is back up."""
+    self.close()
+    try:
+      self._run_service('reboot:')
+    except socket.error:
+      # The device may drop the connection as it goes down.
+      pass
+
+  def close(self):
+    """Closes the idle pooled connections."""
+    with self.lock:
+      for sock in self.idle_sync:
+        sock.close()
+      self.idle_sync = []
+
+
+TRANSPORTS = {}
+TRANSPORTS_LOCK = threading.Lock()
+
+
+def get_transport(serialno):
+  """Returns the shared AdbTransport of a device."""
+  with TRANSPORTS_LOCK:
+    if serialno not in TRANSPORTS:
+      TRANSPORTS[serialno] = AdbTransport(serialno)
+    return TRANSPORTS[serialno]
+
+
+def drop_transport(serialno):
+  """Closes the transport of a device, e.g. after it rebooted."""
+  with TRANSPORTS_LOCK:
+    transport = TRANSPORTS.pop(serialno, None)
+  if transport:
+    transport.close()
@@ -0,0 +1,147 @@
+# Copyright 2016 The Vanadium Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+"""Tests of AdbTransport against a fake adb server.
+
+Usage:
+python adbtransport_test.py
+"""
+
+import os
+import shutil
+import socket
+import tempfile
+import unittest
+
+from adbtransport import AdbError
+from adbtransport import AdbTransport
+from adbtransport import APK_TMP_DIR
+from adbtransport import SYNC_DATA_MAX
+from fakeadb import FakeAdbServer
+
+
+class AdbTransportTest(unittest.TestCase):
+
+  def setUp(self):
+    self.server = FakeAdbServer()
+    self.transport = AdbTransport(self.server.serialno, port=self.server.port)
+    self.tmp_dir = tempfile.mkdtemp()
+
+  def tearDown(self):
+    self.transport.close()
+    self.server.close()
+    shutil.rmtree(self.tmp_dir)
+
+  def test_shell(self):
+    self.server.outputs['getprop sys.boot_completed'] = '1\r\n'
+    self.assertEqual(self.transport.shell('getprop sys.boot_completed'),
+                     '1\r\n')
+    self.assertEqual(self.server.requests, [
+        'host:transport:' + self.server.serialno,
+        'shell:getprop sys.boot_completed'])
+
+  def test_exec_out_keeps_binary_output(self):
+    data = ''.join(chr(i) for i in range(256)) * 1000
+    self.server.outputs['screencap'] = data
+    self.assertEqual(self.transport.exec_out('screencap'), data)
+    self.assertEqual(self.server.requests[-1], 'exec:screencap')
+
+  def test_unknown_device_fails(self):
+    transport = AdbTransport('missing', port=self.server.port)
+    with self.assertRaises(AdbError) as context:
+      transport.shell('ls')
+    self.assertIn("device 'missing' not found", str(context.exception))
+
+  def test_unknown_service_fails(self):
+    with self.assertRaises(AdbError) as context:
+      self.transport._run_service('frobnicate:')  # pylint: disable=protected-access
+    self.assertIn('unknown service frobnicate:', str(context.exception))
+
+  def test_shell_timeout(self):
+    self.server.delays['sleep'] = 1
+    with self.assertRaises(socket.error):
+      self.transport.shell('sleep', timeout=0.1)
+
+  def test_pull(self):
+    data = 'x' * (2 * SYNC_DATA_MAX + 10)
+    self.server.files['/sdcard/a'] = data
+    path = os.path.join(self.tmp_dir, 'a')
+    self.transport.pull('/sdcard/a', path)
+    with open(path, 'rb') as in_file:
+      self.assertEqual(in_file.read(), data)
+
+  def test_pull_missing_file_fails(self):
+    with self.assertRaises(AdbError) as context:
+      self.transport.pull_data('/sdcard/missing')
+    self.assertIn('No such file or directory', str(context.exception))
+
+  def test_push(self):
+    data = ''.join(chr(i % 256) for i in range(3 * SYNC_DATA_MAX + 1))
+    path = os.path.join(self.tmp_dir, 'b')
+    with open(path, 'wb') as out_file:
+      out_file.write(data)
+    self.transport.push(path, '/sdcard/b')
+    self.assertEqual(self.server.files['/sdcard/b'], data)
+    self.assertIn('sync:SEND /sdcard/b,33188', self.server.requests)
+
+  def test_push_empty(self):
+    self.transport.push_data('', '/sdcard/empty')
+    self.assertEqual(self.server.files['/sdcard/empty'], '')
+
+  def test_sync_connection_is_reused(self):
+    self.server.files['/sdcard/a'] = 'a'
+    for _ in range(5):
+      self.assertEqual(self.transport.pull_data('/sdcard/a'), 'a')
+    self.transport.push_data('b', '/sdcard/b')
+    self.assertEqual(self.server.num_sync_connections, 1)
+    self.assertEqual(self.server.num_connections, 1)
+
+  def test_failed_sync_connection_is_not_reused(self):
+    self.server.files['/sdcard/a'] = 'a'
+    with self.assertRaises(AdbError):
+      self.transport.pull_data('/sdcard/missing')
+    self.assertEqual(self.transport.pull_data('/sdcard/a'), 'a')
+    self.assertEqual(self.server.num_sync_connections, 2)
+
+  def test_closed_sync_connections_are_not_reused(self):
+    self.transport.push_data('a', '/sdcard/a')
+    self.transport.close()
+    self.transport.push_data('b', '/sdcard/b')
+    self.assertEqual(self.server.num_sync_connections, 2)
+
+  def _write_apk(self, name):
+    path = os.path.join(self.tmp_dir, name + '.apk')
+    with open(path, 'wb') as out_file:
+      out_file.write('apk')
+    return path
+
+  def test_install(self):
+    out = self.transport.install(self._write_apk('com.example'))
+    self.assertIn('Success', out)
+    self.assertEqual(self.server.installed, set(['com.example']))
+    remote_path = APK_TMP_DIR + 'com.example.apk'
+    self.assertIn("shell:pm install -r '" + remote_path + "'",
+                  self.server.requests)
+    # The APK is removed from the device after the install.
+    self.assertNotIn(remote_path, self.server.files)
+
+  def test_install_failure(self):
+    self.server.install_output = 'Failure [INSTALL_FAILED_OLDER_SDK]\n'
+    with self.assertRaises(AdbError) as context:
+      self.transport.install(self._write_apk('com.example'))
+    self.assertIn('INSTALL_FAILED_OLDER_SDK', str(context.exception))
+    self.assertEqual(self.server.files, {})
+
+  def test_uninstall(self):
+    self.transport.install(self._write_apk('com.example'))
+    self.assertIn('Success', self.transport.uninstall('com.example'))
+    self.assertEqual(self.server.installed, set())
+
+  def test_reboot(self):
+    self.transport.reboot()
+    self.assertEqual(self.server.requests[-1], 'reboot:')
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,244 @@
+# Copyright 2016 The Vanadium Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+"""BatchScheduler class definition."""
+
+import json
+import os
+import threading
+import time
+import traceback
+
+import crawlpkg
+from devicepool import DevicePool
+from installer import InstallPipeline
+from installer import MAX_PENDING_INSTALLS
+
+FAILED = 'failed'
+SUMMARY_FILE = 'batch-summary.json'
+# How many devices a package is tried on before giving up on it.
+MAX_ATTEMPTS = 2
+# How many times a package is put back in the queue because its device turned
+# out to be unhealthy, before it counts as failing on that device.
+MAX_REQUEUES = 3
+
+
+class BatchScheduler(object):
+  """Crawls a list of packages in parallel on several devices.
+
+  Each device gets its own worker thread, which leases the device from a
+  DevicePool for every package, and all of the workers take packages from one
+  shared queue. A package that fails on a healthy device is put back in the
+  queue to be tried on a device it has not failed on. A package that fails
+  because its device became unhealthy is put back in the queue without being
+  held against it, and the device is recovered or retired.
+
+  Each worker installs the next packages it will crawl in the background
+  while it crawls the current one.
+  """
+
+  def __init__(self, serials, package_list, recrawl=False, uninstall=False,
+               max_attempts=MAX_ATTEMPTS, connected=None, pool=None,
+               max_pending_installs=MAX_PENDING_INSTALLS):
+    """Constructor for BatchScheduler class.
+
+    Args:
+      serials: Serial numbers of the devices to crawl on.
+      package_list: APK paths or package names to crawl.
+      recrawl: Whether to crawl packages that already have data.
+      uninstall: Whether to uninstall packages after crawling them.
+      max_attempts: Number of devices to try a package on before giving up.
+      connected: Optional dictionary of serial to (device, vc) for devices
+        that are already connected.
+      pool: DevicePool of the devices. One is created if not given.
+      max_pending_installs: Number of packages each device installs ahead of
+        the one it is crawling.
+    """
+    self.serials = serials
+    self.pool = pool or DevicePool(serials, connected)
+    self.recrawl = recrawl
+    self.uninstall = uninstall
+    self.max_attempts = max_attempts
+    self.max_pending_installs = max_pending_installs
+    self.queue = list(package_list)
+    # Maps package to the serials of the devices it failed on.
+    self.failed_on = {}
+    # Maps package to the number of times it was requeued after its device
+    # became unhealthy.
+    self.requeues = {}
+    # Maps package to its result, which is written to the batch summary.
+    self.results = {}
+    # Profiles of the device operations of every package that was attempted.
+    self.profiles = []
+    # Serials of the workers that are still able to crawl.
+    self.live_serials = set()
+    self.num_in_progress = 0
+    self.cond = threading.Condition()
+
+  def run(self):
+    """Crawls all of the packages and returns the batch summary."""
+    start = time.time()
+    self.live_serials = set(self.serials)
+    workers = [threading.Thread(target=self._run_worker, args=(serial,),
+                                name=serial) for serial in self.serials]
+    self.pool.start_watchdog()
+    for worker in workers:
+      worker.daemon = True
+      worker.start()
+    for worker in workers:
+      # Joining with a timeout keeps the main thread responsive to Ctrl-C.
+      while worker.is_alive():
+        worker.join(1)
+    self.pool.stop()
+
+    # Anything left in the queue had no device left to run on.
+    for package in self.queue:
+      self.results.setdefault(package, {'status': FAILED,
+                                        'devices': self.failed_on.get(package,
+                                                                      [])})
+    return self.write_summary(time.time() - start)
+
+  def _next_package(self, serial, wait=True):
+    """Returns the next package the device should crawl, or None when done.
+
+    If wait is False, returns None instead of waiting for a package.
+    """
+    with self.cond:
+      while True:
+        for package in self.queue:
+          if serial not in self.failed_on.get(package, []):
+            self.queue.remove(package)
+            self.num_in_progress += 1
+            return package
+        if not wait:
+          return None
+        # Only packages that already failed on this device are left. Wait in
+        # case another device picks them up or a running crawl fails.
+        if not self.queue and not self.num_in_progress:
+          return None
+        if self.queue and not self._others_can_retry(serial):
+          return None
+        self.cond.wait(1)
+
+  def _return_packages(self, packages):
+    """Puts packages taken by a device back at the front of the queue."""
+    if not packages:
+      return
+    with self.cond:
+      self.num_in_progress -= len(packages)
+      self.queue[0:0] = packages
+      self.cond.notify_all()
+
+  def _others_can_retry(self, serial):
+    return any(s != serial and s in self.live_serials for s in self.serials)
+
+  def _finish_package(self, package, serial, result, device_healthy=True):
+    with self.cond:
+      self.num_in_progress -= 1
+      if (result['status'] == FAILED and not device_healthy and
+          self.requeues.get(package, 0) < MAX_REQUEUES):
+        # The device is to blame, so the package goes to the front of the
+        # queue and may even be retried on the same device once it recovers.
+        print 'Requeuing ' + package + ' after its device became unhealthy.'
+        self.requeues[package] = self.requeues.get(package, 0) + 1
+        self.queue.insert(0, package)
+        self.cond.notify_all()
+        return
+      # A crawl that stopped early is retried like a failed one, and resumes
+      # from its checkpoint.
+      if result['status'] in (FAILED, crawlpkg.INCOMPLETE):
+        failed_on = self.failed_on.setdefault(package, [])
+        failed_on.append(serial)
+        if (len(failed_on) < self.max_attempts and
+            any(s not in failed_on for s in self.live_serials)):
+          print 'Retrying ' + package + ' on another device.'
+          self.queue.append(package)
+          self.cond.notify_all()
+          return
+        result['devices'] = failed_on
+      self.results[package] = result
+      self.cond.notify_all()
+
+  def _run_worker(self, serial):
+    """Leases the device and crawls packages until the queue is empty."""
+    installer = InstallPipeline(
+        serial, None if self.recrawl else crawlpkg.is_crawled)
+    while True:
+      pooled = self.pool.lease(serial)
+      if not pooled:
+        print 'Device ' + serial + ' is retired.'
+        break
+      if not installer.pending:
+        package = self._next_package(serial)
+        if package is None:
+          self.pool.release(pooled)
+          break
+        installer.submit(package)
+      # Start installing the next packages while this one is crawled.
+      while len(installer.pending) <= self.max_pending_installs:
+        package = self._next_package(serial, wait=False)
+        if package is None:
+          break
+        installer.submit(package)
+
+      package = installer.take()
+      start = time.time()
+      result = {'device': serial}
+      try:
+        result['status'] = crawlpkg.install_and_crawl(
+            pooled.vc, pooled.device, serial, package, self.recrawl,
+            self.uninstall, installer)
+      except Exception:  # pylint: disable=broad-except
+        # Any error (e.g. a socket timeout or a device reboot) fails the
+        # package on this device, but the worker moves on to the next one.
+        traceback.print_exc()
+        result['status'] = FAILED
+      result['seconds'] = round(time.time() - start, 1)
+      if result['status'] != crawlpkg.SKIPPED:
+        # The profiler belongs to this thread, so it has this package's crawl.
+        with self.cond:
+          self.profiles.append(crawlpkg.STATE.profiler.to_dict())
+      healthy = self.pool.release(pooled, result['status'] == FAILED)
+      if not healthy:
+        # Other devices may get to them before this one recovers.
+        self._return_packages(installer.drain())
+      self._finish_package(package, serial, result, healthy)
+
+    self._return_packages(installer.drain())
+    installer.close()
+    with self.cond:
+      self.live_serials.discard(serial)
+      self.cond.notify_all()
+
+  def write_summary(self, elapsed):
+    """Writes the results and profile of the batch to the data directory."""
+    devices = self.pool.to_dict()
+    for serial in self.serials:
+      crawled = [r for r in self.results.values()
+                 if r.get('device') == serial and
+                 r['status'] == crawlpkg.CRAWLED]
+      devices[serial].update({
+          'crawled': len(crawled),
+          'busy_seconds': round(sum(r['seconds'] for r in crawled), 1)})
+    num_crawled = sum(d['crawled'] for d in devices.values())
+    summary = {
+        'seconds': round(elapsed, 1),
+        'crawled': num_crawled,
+        'failed': sum(1 for r in self.results.values()
+                      if r['status'] == FAILED),
+        'incomplete': sum(1 for r in self.results.values()
+                          if r['status'] == crawlpkg.INCOMPLETE),
+        'packages_per_hour': round(num_crawled * 3600.0 / max(elapsed, 1), 2),
+        'devices': devices,
+        'packages': self.results}
+
+    if not os.path.exists(crawlpkg.DATA_DIR):
+      os.makedirs(crawlpkg.DATA_DIR)
+    with open(os.path.join(crawlpkg.DATA_DIR, SUMMARY_FILE), 'w') as out_file:
+      json.dump(summary, out_file, indent=2)
+    crawlpkg.save_batch_profile(self.profiles)
+    print ('Batch done: crawled {} packages on {} devices in {:.0f}s, {} '
+           'failed.'.format(num_crawled, len(self.serials), elapsed,
+                            summary['failed']))
+    return summary
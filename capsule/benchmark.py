@@ -0,0 +1,194 @@
+# Copyright 2016 The Vanadium Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+"""Benchmarks for the crawler and the data structures it uses.
+
+Usage:
+python benchmark.py [--layouts NUM_LAYOUTS] [--screens NUM_SCREENS]
+                    [--volatile FRACTION] [--app /PATH/TO/data/PACKAGE/]
+
+The crawl benchmark runs the real crawler against a simulated device (see
+simulator.py). By default the simulated app is generated with NUM_SCREENS
+screens; with --app it replays the screens and clicks of an earlier crawl.
+"""
+
+import argparse
+import os
+import random
+import resource
+import shutil
+import tempfile
+import time
+
+import crawlpkg
+from layout import Layout
+from layout import LayoutMap
+from layoutgraph import LayoutGraph
+from settle import SettleWaiter
+import simulator
+
+NUM_LAYOUTS = 5000
+NUM_LOOKUPS = 200
+VIEWS_PER_LAYOUT = 60
+EDGES_PER_LAYOUT = 4
+NUM_SCREENS = 60
+# The simulated UI is settled as soon as it is read, so waits do not sleep.
+SIM_SETTLE_SETTINGS = {'initial_delay': 0, 'max_delay': 0}
+ACTIVITIES = ['MainActivity', 'DetailActivity', 'SettingsActivity',
+              'LoginActivity', 'SearchActivity']
+FRAGMENTS = ['ListFragment', 'MapFragment', 'NavFragment', 'HeaderFragment']
+
+
+def synthetic_hierarchy(rand, num_views):
+  """Returns a list of views that only have the fields used for comparison."""
+  return [{'uniqueId': 'id/view_' + str(rand.randint(0, 4 * num_views))}
+          for _ in range(num_views)]
+
+
+def synthetic_layouts(num_layouts, seed=0):
+  """Returns a list of random Layouts."""
+  rand = random.Random(seed)
+  layouts = []
+  for num in range(num_layouts):
+    activity = rand.choice(ACTIVITIES)
+    frag_list = rand.sample(FRAGMENTS, rand.randint(0, 2))
+    hierarchy = synthetic_hierarchy(rand, VIEWS_PER_LAYOUT)
+    layouts.append(Layout(activity, frag_list, hierarchy, '', num))
+  return layouts
+
+
+def linear_find(layouts, activity, frag_list, hierarchy):
+  """The lookup the crawler used before LayoutMap was indexed."""
+  for layout in layouts:
+    if layout.is_duplicate(activity, frag_list, hierarchy):
+      return layout
+  return None
+
+
+def benchmark_layout_lookup(num_layouts=NUM_LAYOUTS, num_lookups=NUM_LOOKUPS):
+  """Times hierarchy lookups with a linear scan and with LayoutMap."""
+  layouts = synthetic_layouts(num_layouts)
+  layout_map = LayoutMap()
+  for layout in layouts:
+    layout_map[layout.get_name()] = layout
+
+  rand = random.Random(1)
+  # Half of the queries are hits (revisits) and half are misses (new screens).
+  queries = []
+  for _ in range(num_lookups):
+    if rand.random() < 0.5:
+      l = rand.choice(layouts)
+      queries.append((l.activity, l.frag_list, list(reversed(l.hierarchy))))
+    else:
+      queries.append((rand.choice(ACTIVITIES), [],
+                      synthetic_hierarchy(rand, VIEWS_PER_LAYOUT)))
+
+  start = time.time()
+  linear_results = [linear_find(layouts, *q) for q in queries]
+  linear_time = time.time() - start
+
+  start = time.time()
+  indexed_results = [layout_map.find(*q) for q in queries]
+  indexed_time = time.time() - start
+
+  assert linear_results == indexed_results
+  print ('Layout lookup, {} layouts x {} lookups: linear {:.3f}s, indexed '
+         '{:.3f}s ({:.0f}x)'.format(num_layouts, num_lookups, linear_time,
+                                    indexed_time,
+                                    linear_time / max(indexed_time, 1e-9)))
+
+
+def list_bfs(graph, start, end):
+  """The shortest path search the crawler used before LayoutGraph."""
+  queue = [[start]]
+  visited = set()
+  while queue:
+    path = queue.pop(0)
+    node = path[-1]
+    if node == end:
+      return path
+    for adjacent in graph.get(node, []):
+      if adjacent not in visited:
+        new_path = list(path)
+        new_path.append(adjacent)
+        queue.append(new_path)
+        visited.add(adjacent)
+
+
+def benchmark_navigation(num_layouts=NUM_LAYOUTS, num_targets=NUM_LOOKUPS):
+  """Times planning routes from the launch screen to unexplored layouts."""
+  rand = random.Random(2)
+  graph = LayoutGraph()
+  edges = {}
+  for node in range(num_layouts):
+    for _ in range(EDGES_PER_LAYOUT):
+      end = rand.randint(0, num_layouts - 1)
+      graph.add_edge(node, end)
+      edges.setdefault(node, set()).add(end)
+  targets = rand.sample(range(num_layouts), num_targets)
+
+  start = time.time()
+  list_paths = [list_bfs(edges, 0, t) for t in targets]
+  list_time = time.time() - start
+
+  start = time.time()
+  graph_paths = [graph.shortest_path(0, t) for t in targets]
+  graph_time = time.time() - start
+
+  assert ([len(p) for p in list_paths if p] ==
+          [len(p) for p in graph_paths if p])
+  print ('Navigation, {} layouts x {} targets: list BFS {:.3f}s, LayoutGraph '
+         '{:.3f}s ({:.0f}x)'.format(num_layouts, num_targets, list_time,
+                                    graph_time,
+                                    list_time / max(graph_time, 1e-9)))
+
+
+def benchmark_crawl(app):
+  """Crawls a simulated app and reports crawl throughput."""
+  device, vc = simulator.connect(app)
+  data_dir = crawlpkg.DATA_DIR
+  crawlpkg.DATA_DIR = tempfile.mkdtemp()
+  crawlpkg.STATE.settle = SettleWaiter(SIM_SETTLE_SETTINGS)
+  start = time.time()
+  try:
+    crawlpkg.install_and_crawl(vc, device, device.serialno, app.package_name)
+    num_layouts = len([f for f in os.listdir(os.path.join(
+        crawlpkg.DATA_DIR, app.package_name)) if f.endswith('-clicks.json')])
+  finally:
+    shutil.rmtree(crawlpkg.DATA_DIR)
+    crawlpkg.DATA_DIR = data_dir
+    crawlpkg.STATE.settle = None
+  elapsed = time.time() - start
+
+  steps = max(device.num_inputs, 1)
+  print ('Crawl of {} ({} screens): {} steps in {:.2f}s ({:.1f} steps/s), {} '
+         'layouts'.format(app.package_name, len(app.screens), device.num_inputs,
+                          elapsed, steps / max(elapsed, 1e-9), num_layouts))
+  print ('  {:.2f} device calls per step ({}), {:.1f} layouts per simulated '
+         'minute ({:.0f}s simulated)'.format(
+             device.num_calls() / float(steps),
+             ', '.join('{} {}'.format(k, v) for k, v in
+                       sorted(device.calls.iteritems())),
+             num_layouts * 60 / max(device.clock, 1e-9), device.clock))
+  # ru_maxrss is in kilobytes on Linux.
+  print '  Peak memory: {:.1f} MB'.format(
+      resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0)
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--layouts', type=int, default=NUM_LAYOUTS)
+  parser.add_argument('--screens', type=int, default=NUM_SCREENS)
+  parser.add_argument('--volatile', type=float, default=0.0,
+                      help='Fraction of generated screens that change a row '
+                      'on every visit.')
+  parser.add_argument('--app', help='Directory of a crawl to replay.')
+  args = parser.parse_args()
+  benchmark_layout_lookup(args.layouts)
+  benchmark_navigation(args.layouts)
+  if args.app:
+    benchmark_crawl(simulator.AppModel.from_crawl_data(args.app))
+  else:
+    benchmark_crawl(simulator.AppModel.synthetic(num_screens=args.screens,
+                                                 volatile=args.volatile))
@@ -8,13 +8,11 @@ import getopt
 import os
 import subprocess
 import sys
-import time
 
-from com.dtmilano.android.common import obtainAdbPath
+from batch import BatchScheduler
 from com.dtmilano.android.viewclient import ViewClient
 import crawlpkg
 
-ADB_PATH = obtainAdbPath()
 HELP_MSG = ('Capsule usage:\n'
             'python capsule.py DEVICE_SERIAL [flag] <argument>\n'
             'No command line flags -- crawl current package\n'
@@ -23,6 +21,8 @@ HELP_MSG = ('Capsule usage:\n'
             '-f or --file /[PATH TO FILE]/list.txt -- load text file of '
             'package names on device and crawl them.\n'
             '-r or --recrawl -- recrawl already explored apps.\n'
+            '-s or --serials SERIAL1,SERIAL2 -- also crawl on these devices, '
+            'in parallel.\n'
             '-h or --help -- help, list options')
 
 # PyDev sets PYTHONPATH, use it
@@ -81,6 +81,8 @@ if __name__ == '__main__':
   uninstall = False
   recrawl = False
   package_list = []
+  # Additional devices to crawl on in parallel with DEVICE_SERIAL.
+  extra_serials = []
 
   try:
     kwargs1 = {'verbose': True, 'ignoresecuredevice': True, 'timeout': 20}
@@ -108,7 +110,8 @@ if __name__ == '__main__':
     print HELP_MSG
   elif len(sys.argv) >= 4:
     try:
-      opts, _ = getopt.getopt(sys.argv[2:], 'd:f:h:r', ['directory=', 'file='])
+      opts, _ = getopt.getopt(sys.argv[2:], 'd:f:h:rs:',
+                              ['directory=', 'file=', 'serials='])
     except getopt.GetoptError as err:
       print str(err)
       print HELP_MSG
@@ -126,6 +129,8 @@ if __name__ == '__main__':
         print HELP_MSG
       elif opt in ('-r', '--recrawl'):
         recrawl = True
+      elif opt in ('-s', '--serials'):
+        extra_serials = [s for s in arg.split(',') if s and s != serialno]
       else:
         print ('Unhandled option. Use -h or --help for a listing of '
                'commands')
@@ -134,43 +139,12 @@ if __name__ == '__main__':
     if package_list:
       print 'Packages to be crawled: ' + ', '.join(package_list)
 
-    for package in package_list:
-      # Possibly install, then launch and crawl the app. device.shell() does
-      # not support the install or launch.
-      package_name = ''
-      should_crawl = True
-      if '.apk' in package:
-        package_name = crawlpkg.extract_between(package, '/', '.apk', -1)
-        subprocess.call([ADB_PATH, '-s', serialno, 'install', '-r', package])
-
-      else:
-        # We have the package name but not the .apk file.
-        package_name = package.split('/')[-1]
-        # Make sure the package is installed on the device by checking it
-        # against installed third-party packages.
-        installed_pkgs = device.shell('pm list packages -3')
-        if package_name not in installed_pkgs:
-          print 'Cannot find the package on the device: ' + package_name
-          should_crawl = False
-
-      if os.path.exists(os.path.dirname(os.path.abspath(__file__)) + '/data/' +
-                        package_name) and not recrawl:
-        should_crawl = False
-        print 'Skipping ' + package_name + '; package has already been crawled.'
-
-      if should_crawl:
-        print 'Crawling ' + package_name
-
-        # Launch the app.
-        device.shell('monkey -p ' + package_name +
-                     ' -c android.intent.category.LAUNCHER 1')
-        time.sleep(5)
-
-        crawlpkg.crawl_package(vc, device, serialno, package_name)
-
-        if uninstall:
-          print 'uninstall' + package_name
-          subprocess.call([ADB_PATH, '-s', serialno, 'uninstall', package_name])
+    # Even a single device crawls through the scheduler, whose device pool
+    # checks that the device stays healthy and recovers it if not.
+    scheduler = BatchScheduler([serialno] + extra_serials, package_list,
+                               recrawl, uninstall,
+                               connected={serialno: (device, vc)})
+    scheduler.run()
 
   else:
     print 'Invalid number of command line arguments.'
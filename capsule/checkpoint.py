@@ -0,0 +1,167 @@
+# Copyright 2016 The Vanadium Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+"""Checkpoints and status markers of package crawls.
+
+While a package is crawled, its directory has a status marker that says the
+crawl is in progress, and a checkpoint with the Layouts seen so far, the
+transitions between them, which of them are still being explored and the
+views that are left to click. A crawl that dies can be resumed from the
+checkpoint instead of starting over. Once the crawl finishes, the checkpoint is
+removed and the marker says the crawl is complete.
+"""
+
+import json
+import os
+
+from layout import Layout
+from layout import LayoutMap
+from layoutgraph import LayoutGraph
+
+CHECKPOINT_FILE = 'checkpoint.json'
+STATUS_FILE = 'status.json'
+# Crawl statuses.
+IN_PROGRESS = 'in progress'
+COMPLETE = 'complete'
+VERSION = 1
+
+
+class SavedView(object):
+  """A clickable view restored from a checkpoint.
+
+  It has the attributes of an AndroidViewClient View that the crawler needs to
+  identify and click on a view.
+  """
+
+  def __init__(self, info):
+    """Constructor for SavedView class."""
+    self.info = info
+
+  def __getitem__(self, key):
+    return self.info[key]
+
+  def getUniqueId(self):
+    return self.info['uniqueId']
+
+  def getId(self):
+    return self.info['id']
+
+  def getClass(self):
+    return self.info['class']
+
+  def getText(self):
+    return self.info['text']
+
+  def getX(self):
+    return self.info['x']
+
+  def getY(self):
+    return self.info['y']
+
+  def getXY(self):
+    return (self.info['x'], self.info['y'])
+
+
+def _view_to_dict(view):
+  return {'uniqueId': view.getUniqueId(), 'id': view.getId(),
+          'class': view.getClass(), 'text': view.getText(), 'x': view.getX(),
+          'y': view.getY()}
+
+
+def _layout_to_dict(layout):
+  return {'activity': layout.activity, 'frag_list': layout.frag_list,
+          'num': layout.num, 'screenshot': layout.screenshot,
+          'depth': layout.depth, 'click_dict': layout.click_dict,
+          'preceding': layout.preceding, 'signature': layout.signature,
+          # Only the unique ids of the hierarchy are needed to recognize the
+          # Layout again.
+          'view_ids': [view['uniqueId'] for view in layout.hierarchy or []],
+          'clickable': [_view_to_dict(view) for view in layout.clickable]}
+
+
+def _layout_from_dict(info):
+  hierarchy = [{'uniqueId': view_id} for view_id in info['view_ids']]
+  layout = Layout(info['activity'], info['frag_list'], hierarchy,
+                  info['screenshot'], info['num'])
+  layout.depth = info['depth']
+  layout.click_dict = info['click_dict']
+  layout.preceding = info['preceding']
+  if info.get('signature'):
+    layout.signature = tuple(info['signature'])
+  layout.clickable = [SavedView(view) for view in info['clickable']]
+  return layout
+
+
+def _write_json(directory, filename, data):
+  """Replaces a file atomically, so a crash never leaves half of it."""
+  path = os.path.join(directory, filename)
+  with open(path + '.tmp', 'w') as out_file:
+    json.dump(data, out_file)
+  os.rename(path + '.tmp', path)
+
+
+def save(directory, layout_map, layout_graph, still_exploring):
+  """Saves the state of a crawl."""
+  _write_json(directory, CHECKPOINT_FILE, {
+      'version': VERSION,
+      'layouts': [_layout_to_dict(l) for l in layout_map.itervalues()],
+      'edges': dict((start, sorted(ends))
+                    for start, ends in layout_graph.edges.iteritems()),
+      'still_exploring': sorted(still_exploring)})
+
+
+def load(directory):
+  """Loads the state of a crawl.
+
+  Returns:
+    (layout_map, layout_graph, still_exploring), or None if there is no
+    usable checkpoint.
+  """
+  try:
+    with open(os.path.join(directory, CHECKPOINT_FILE)) as in_file:
+      data = json.load(in_file)
+  except (IOError, ValueError):
+    return None
+  if data.get('version') != VERSION:
+    return None
+
+  layout_map = LayoutMap()
+  for info in data['layouts']:
+    layout = _layout_from_dict(info)
+    layout_map[layout.get_name()] = layout
+  layout_graph = LayoutGraph()
+  for start, ends in data['edges'].iteritems():
+    for end in ends:
+      layout_graph.add_edge(start, end)
+  still_exploring = dict((name, layout_map[name])
+                         for name in data['still_exploring']
+                         if name in layout_map)
+  return layout_map, layout_graph, still_exploring
+
+
+def clear(directory):
+  """Removes the checkpoint, so the next crawl starts from scratch."""
+  path = os.path.join(directory, CHECKPOINT_FILE)
+  if os.path.exists(path):
+    os.remove(path)
+
+
+def read_status(directory):
+  """Returns the status of the crawl in directory, or None if never crawled.
+
+  Crawls from before status markers existed are complete if they saved any
+  results.
+  """
+  try:
+    with open(os.path.join(directory, STATUS_FILE)) as in_file:
+      return json.load(in_file)['status']
+  except (IOError, ValueError, KeyError):
+    pass
+  if os.path.isdir(directory) and os.listdir(directory):
+    return COMPLETE
+  return None
+
+
+def write_status(directory, status):
+  _write_json(directory, STATUS_FILE, {'status': status})
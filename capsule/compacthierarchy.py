@@ -0,0 +1,318 @@
+# Copyright 2016 The Vanadium Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+"""A compact binary format for crawled view hierarchies.
+
+The JSON dumps written by the crawler repeat every attribute name of every view
+and store numbers and booleans as indented strings. This format stores the same
+data as columns:
+
+  * Every string (attribute names and values, unique ids and fragment names)
+    is stored once in a string table and referenced by index.
+  * Each view is a run of (attribute, type, value) cells in three parallel
+    arrays. Integers, booleans and integer-valued strings such as bounds,
+    flags and visibility are stored in the numeric value column.
+  * Parent and child relationships are stored as view indexes.
+
+The whole thing is zlib compressed. CompactHierarchy rebuilds the JSON
+dictionary of a view only when it is asked for.
+
+Usage:
+python compacthierarchy.py /PATH/TO/data/PACKAGE/ [--delete]
+Converts the JSON hierarchies of a crawl and reports the savings.
+"""
+
+from array import array
+import json
+import os
+import struct
+import sys
+import time
+import zlib
+
+MAGIC = 'CHB1'
+EXTENSION = '.chb'
+# Attribute names of nested dictionaries, such as the view attributes in
+# 'map', are joined to the name of the dictionary with this separator.
+KEY_SEPARATOR = '\x00'
+# Value types.
+STR = 0
+INT = 1
+# A string like '12' that is stored as a number but read back as a string.
+INT_STR = 2
+BOOL = 3
+# 'true' or 'false', stored as a number but read back as a string.
+BOOL_STR = 4
+NONE = 5
+# Anything else is stored as its JSON encoding.
+JSON = 6
+INT_MIN = -2 ** 31
+INT_MAX = 2 ** 31 - 1
+NO_PARENT = -1
+
+
+def _int_array(values=()):
+  a = array('i', values)
+  assert a.itemsize == 4
+  return a
+
+
+def _to_bytes(a):
+  if sys.byteorder == 'big':
+    a = array(a.typecode, a)
+    a.byteswap()
+  return a.tostring()
+
+
+def _from_bytes(typecode, data):
+  a = array(typecode)
+  a.fromstring(data)
+  if sys.byteorder == 'big':
+    a.byteswap()
+  return a
+
+
+class _Encoder(object):
+  """Builds the string table and columns of a hierarchy."""
+
+  def __init__(self):
+    self.strings = []
+    self.string_ids = {}
+    self.keys = _int_array()
+    self.types = array('B')
+    self.values = _int_array()
+
+  def intern(self, string):
+    if isinstance(string, str):
+      string = string.decode('utf-8')
+    if string not in self.string_ids:
+      self.string_ids[string] = len(self.strings)
+      self.strings.append(string)
+    return self.string_ids[string]
+
+  def add_cell(self, key, value):
+    if isinstance(value, bool):
+      value_type, number = BOOL, int(value)
+    elif isinstance(value, (int, long)) and INT_MIN <= value <= INT_MAX:
+      value_type, number = INT, value
+    elif value is None:
+      value_type, number = NONE, 0
+    elif isinstance(value, basestring):
+      if value in ('true', 'false'):
+        value_type, number = BOOL_STR, int(value == 'true')
+      elif (value.lstrip('-').isdigit() and str(int(value)) == value and
+            INT_MIN <= int(value) <= INT_MAX):
+        value_type, number = INT_STR, int(value)
+      else:
+        value_type, number = STR, self.intern(value)
+    else:
+      value_type, number = JSON, self.intern(json.dumps(value))
+    self.keys.append(self.intern(key))
+    self.types.append(value_type)
+    self.values.append(number)
+
+  def add_view(self, view, prefix=''):
+    for key, value in view.iteritems():
+      # Empty dictionaries are stored as JSON so that they are not lost.
+      if isinstance(value, dict) and value:
+        self.add_view(value, prefix + key + KEY_SEPARATOR)
+      else:
+        self.add_cell(prefix + key, value)
+
+
+def encode(layout_info):
+  """Encodes the layout info dictionary saved by the crawler.
+
+  Args:
+    layout_info: Dictionary with a 'hierarchy' dictionary of uniqueId to view
+      dictionary (whose 'parent' and 'children' are uniqueIds) and a
+      'fragmentList'.
+
+  Returns:
+    The encoded hierarchy as a string.
+  """
+  hierarchy = layout_info['hierarchy']
+  unique_ids = list(hierarchy)
+  index = dict((unique_id, i) for i, unique_id in enumerate(unique_ids))
+  encoder = _Encoder()
+  id_column = _int_array()
+  parents = _int_array()
+  cell_offsets = _int_array([0])
+  child_offsets = _int_array([0])
+  children = _int_array()
+
+  for unique_id in unique_ids:
+    view = dict(hierarchy[unique_id])
+    id_column.append(encoder.intern(unique_id))
+    parents.append(index.get(view.pop('parent', None), NO_PARENT))
+    children.extend(index[c] for c in view.pop('children', []) if c in index)
+    child_offsets.append(len(children))
+    encoder.add_view(view)
+    cell_offsets.append(len(encoder.keys))
+
+  frags = _int_array(encoder.intern(f)
+                     for f in layout_info.get('fragmentList') or [])
+
+  string_data = [s.encode('utf-8') for s in encoder.strings]
+  string_lengths = _int_array(len(s) for s in string_data)
+  sections = [string_lengths, ''.join(string_data), frags, id_column, parents,
+              cell_offsets, child_offsets, children, encoder.keys,
+              encoder.types, encoder.values]
+  body = []
+  for section in sections:
+    if isinstance(section, array):
+      section = _to_bytes(section)
+    body.append(struct.pack('<I', len(section)))
+    body.append(section)
+  return MAGIC + zlib.compress(''.join(body), 6)
+
+
+class CompactHierarchy(object):
+  """Reads an encoded hierarchy and rebuilds view dictionaries on demand."""
+
+  def __init__(self, data):
+    """Constructor for CompactHierarchy class."""
+    if data[:len(MAGIC)] != MAGIC:
+      raise ValueError('Not a compact hierarchy.')
+    body = zlib.decompress(data[len(MAGIC):])
+    sections = []
+    pos = 0
+    while pos < len(body):
+      (length,) = struct.unpack_from('<I', body, pos)
+      sections.append(body[pos + 4:pos + 4 + length])
+      pos += 4 + length
+
+    string_lengths = _from_bytes('i', sections[0])
+    self.strings = []
+    pos = 0
+    for length in string_lengths:
+      self.strings.append(sections[1][pos:pos + length].decode('utf-8'))
+      pos += length
+    (self.frags, self.ids, self.parents, self.cell_offsets,
+     self.child_offsets, self.children, self.keys) = [
+         _from_bytes('i', s) for s in sections[2:9]]
+    self.types = _from_bytes('B', sections[9])
+    self.values = _from_bytes('i', sections[10])
+
+  def __len__(self):
+    return len(self.ids)
+
+  def fragment_list(self):
+    return [self.strings[f] for f in self.frags]
+
+  def unique_id(self, i):
+    return self.strings[self.ids[i]]
+
+  def unique_ids(self):
+    return [self.strings[i] for i in self.ids]
+
+  def _value(self, cell):
+    value_type = self.types[cell]
+    value = self.values[cell]
+    if value_type == STR:
+      return self.strings[value]
+    elif value_type == INT:
+      return value
+    elif value_type == INT_STR:
+      return unicode(value)
+    elif value_type == BOOL:
+      return bool(value)
+    elif value_type == BOOL_STR:
+      return u'true' if value else u'false'
+    elif value_type == NONE:
+      return None
+    return json.loads(self.strings[value])
+
+  def view(self, i):
+    """Returns the dictionary of view i, in the same form as the JSON dump."""
+    view = {}
+    for cell in range(self.cell_offsets[i], self.cell_offsets[i + 1]):
+      path = self.strings[self.keys[cell]].split(KEY_SEPARATOR)
+      parent = view
+      for key in path[:-1]:
+        parent = parent.setdefault(key, {})
+      parent[path[-1]] = self._value(cell)
+    parent_index = self.parents[i]
+    view['parent'] = (self.unique_id(parent_index)
+                      if parent_index != NO_PARENT else None)
+    view['children'] = [
+        self.unique_id(c) for c in
+        self.children[self.child_offsets[i]:self.child_offsets[i + 1]]]
+    return view
+
+  def find(self, unique_id):
+    """Returns the dictionary of the view with the uniqueId, or None."""
+    for i in range(len(self)):
+      if self.unique_id(i) == unique_id:
+        return self.view(i)
+    return None
+
+  def to_layout_info(self):
+    """Returns the whole dictionary, as the JSON dump would have loaded it."""
+    return {'hierarchy': dict((self.unique_id(i), self.view(i))
+                              for i in range(len(self))),
+            'fragmentList': self.fragment_list()}
+
+
+def load(path):
+  """Returns the CompactHierarchy saved at path."""
+  with open(path, 'rb') as in_file:
+    return CompactHierarchy(in_file.read())
+
+
+def save(layout_info, path):
+  with open(path, 'wb') as out_file:
+    out_file.write(encode(layout_info))
+
+
+def convert_directory(directory, delete=False):
+  """Converts every JSON hierarchy in directory and prints the savings."""
+  json_bytes = compact_bytes = 0
+  json_time = compact_time = rebuild_time = 0.0
+  num_files = 0
+  for root, _, filenames in os.walk(directory):
+    for filename in sorted(filenames):
+      if not filename.endswith('.json') or filename.endswith('-clicks.json'):
+        continue
+      json_path = os.path.join(root, filename)
+      start = time.time()
+      with open(json_path) as in_file:
+        layout_info = json.load(in_file)
+      json_time += time.time() - start
+      if 'hierarchy' not in layout_info:
+        continue
+
+      compact_path = json_path[:-len('.json')] + EXTENSION
+      save(layout_info, compact_path)
+      start = time.time()
+      compact = load(compact_path)
+      compact_time += time.time() - start
+      start = time.time()
+      converted = compact.to_layout_info()
+      rebuild_time += time.time() - start
+      if converted != layout_info:
+        print 'Could not convert ' + json_path + ' without changes.'
+        os.remove(compact_path)
+        continue
+
+      num_files += 1
+      json_bytes += os.path.getsize(json_path)
+      compact_bytes += os.path.getsize(compact_path)
+      if delete:
+        os.remove(json_path)
+
+  print 'Converted {} hierarchies.'.format(num_files)
+  if num_files:
+    print 'Size: {} bytes of JSON, {} bytes compact ({:.1f}x smaller).'.format(
+        json_bytes, compact_bytes, json_bytes / float(max(compact_bytes, 1)))
+    print ('Load time: {:.3f}s JSON, {:.3f}s compact (plus {:.3f}s to rebuild '
+           'every view dictionary).'.format(json_time, compact_time,
+                                            rebuild_time))
+
+
+if __name__ == '__main__':
+  if len(sys.argv) < 2:
+    print __doc__
+    sys.exit()
+  convert_directory(sys.argv[1], '--delete' in sys.argv[2:])
@@ -4,6 +4,7 @@
 
 """Config class definition."""
 
+from collections import OrderedDict
 from ConfigParser import SafeConfigParser
 
 CONFIG_FILE = 'config.ini'
@@ -23,6 +24,7 @@ class Config(object):
     parser = SafeConfigParser()
     parser.read(CONFIG_FILE)
     for section_name in parser.sections():
-      self.data[section_name] = {}
+      # Ordered, since the order of rules in a section matters.
+      self.data[section_name] = OrderedDict()
       for name, value in parser.items(section_name):
         self.data[section_name][name] = value
@@ -7,29 +7,41 @@ from collections import Counter
 import copy
 import json
 import os
-import re
-import subprocess
-import time
-
-from com.dtmilano.android.common import obtainAdbPath
+import threading
 
+from adbtransport import get_transport
+import checkpoint
+import compacthierarchy
 from config import Config
+from crawlstore import CrawlStore
+from frontier import make_frontier
+from installer import get_package_name
+from installer import install_package
+from installer import uninstall_package
 from layout import Layout
+from layout import LayoutMap
+from layoutgraph import LayoutGraph
+from navigation import NavigationPlanner
+import profiler
+import rules
+from rules import LoginRules
+from rules import TextRules
+from screenshots import ScreenshotWriter
+from settle import SettleWaiter
+import similarity
+from snapshot import DeviceSnapshot
+
+# All crawled data is stored in a directory per package under this directory.
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data')
 
 # https://material.google.com/layout/structure.html#structure-system-bars
 NAVBAR_DP_HEIGHT = 48
 
-MAX_X = 0
-MAX_Y = 0
-STATUS_BAR_HEIGHT = 0
-
 # Visibility
 VISIBLE = 0x0
 INVISIBLE = 0x4
 GONE = 0x8
 
-ADB_PATH = obtainAdbPath()
-SERIAL_NO = ''
 BACK_BUTTON = 'back button'
 # Return a unique string if the package is not the focused window. Since
 # activities cannot have spaces, we ensure that no activity will be named this.
@@ -51,6 +63,32 @@ MAX_LAYOUTS = 40
 MAX_CONSEC_BACK_PRESSES = 10
 MAX_FB_AUTH_TAPS = 5
 MAX_FB_BUG_RESETS = 5
+# Values of the screen_probe option of the [settings] config. window reuses
+# the last dump while the focused window and the views listed by dumpsys
+# activity stay the same. screencap also requires a digest of the screen to
+# stay the same.
+PROBE_OFF = 'off'
+PROBE_WINDOW = 'window'
+PROBE_SCREENCAP = 'screencap'
+# The screencap probe turns itself off after this many probes if the dumps it
+# skipped saved less time than the digests took.
+PROBE_TRIAL = 30
+DEFAULT_DUMP_SECONDS = 1.5
+DEFAULT_DIGEST_SECONDS = 0.4
+# The checkpoint is rewritten in full, so it is only saved when a Layout or
+# transition was recorded, or after this many steps for the views clicked.
+CHECKPOINT_STEPS = 10
+# Formats for saved view hierarchies, set with the hierarchy_format option of
+# the [settings] config.
+JSON_FORMAT = 'json'
+COMPACT_FORMAT = 'compact'
+# Outcomes of install_and_crawl.
+CRAWLED = 'crawled'
+SKIPPED = 'skipped'
+NOT_INSTALLED = 'not installed'
+# The app could not be launched or left the screen before the crawl finished,
+# so its checkpoint is kept to resume from.
+INCOMPLETE = 'incomplete'
 
 NEGATIVE_WORDS = ['no', 'cancel', 'back', 'neg' 'deny', 'prev', 'exit',
                   'delete', 'end', 'remove', 'clear', 'reset', 'undo']
@@ -60,6 +98,61 @@ NEGATIVE_WORDS = ['no', 'cancel', 'back', 'neg' 'deny', 'prev', 'exit',
 # looking for the social network logins.
 REGISTERED_WORDS = ['sign in', 'log', 'already', 'member']
 END_WORDS = NEGATIVE_WORDS + REGISTERED_WORDS
+# Methods of the device, ViewClient and AdbTransport that are profiled.
+DEVICE_OPS = ('shell', 'touch', 'press', 'type', 'isKeyboardShown')
+VC_OPS = ('dump',)
+TRANSPORT_OPS = ('shell', 'exec_out', 'pull', 'push', 'install', 'uninstall')
+
+
+class DeviceState(threading.local):
+  """State of the device being crawled.
+
+  Each thread gets its own copy, so crawls of different devices can run in
+  parallel threads of the same process.
+  """
+
+  def __init__(self):
+    """Constructor for DeviceState class."""
+    super(DeviceState, self).__init__()
+    self.serialno = ''
+    # AdbTransport used for file transfers and installs.
+    self.transport = None
+    # ScreenshotWriter that saves screenshots in the background.
+    self.screenshots = None
+    # CrawlStore with the results of the package being crawled.
+    self.store = None
+    # Whether view hierarchies are saved as JSON or in the compact format.
+    self.hierarchy_format = JSON_FORMAT
+    self.max_x = 0
+    self.max_y = 0
+    self.status_bar_height = 0
+    # Device state for the current crawl step, shared by all of the obtain_*
+    # functions so that one step only queries the device once.
+    self.snapshot = None
+    # Waits for the UI to settle after actions, configured by the [settle]
+    # section of the config.
+    self.settle = None
+    # Profiler with the latencies of the device operations of the package.
+    self.profiler = profiler.Profiler()
+    # SimilarityIndex of the package's Layouts, or None if near duplicates are
+    # not merged.
+    self.similar = None
+    # LayoutGraph of the click and back button transitions of the package, that
+    # the NavigationPlanner plans on. It is updated along with the Layout graph.
+    self.navigation = None
+    # (window digest, screen digest, vc_dump) of the last dump, reused while
+    # the screen does not change.
+    self.last_dump = None
+    # What the last checkpoint had recorded, and steps taken since it was
+    # saved.
+    self.checkpoint_key = None
+    self.steps_since_checkpoint = 0
+    # TextRules and LoginRules compiled from the config for the package.
+    self.text_rules = None
+    self.login_rules = None
+
+
+STATE = DeviceState()
 
 
 def extract_between(text, sub1, sub2, nth=1):
@@ -74,8 +167,7 @@ def extract_between(text, sub1, sub2, nth=1):
 
 
 def set_device_dimens(vc, device):
-  """Sets global variables to the dimensions of the device."""
-  global MAX_X, MAX_Y, STATUS_BAR_HEIGHT
+  """Sets the dimensions of the device in the DeviceState."""
 
   try:
     # Returns a string similar to "Physical size: 1440x2560"
@@ -92,11 +184,11 @@ def set_device_dimens(vc, device):
     print '*** Socket timeout! Cannot get nav bar height.'
     navbar_height = 0
 
-  MAX_X = int(extract_between(size, ': ', 'x'))
-  MAX_Y = int(extract_between(size, 'x', '\r')) - navbar_height
+  STATE.max_x = int(extract_between(size, ': ', 'x'))
+  STATE.max_y = int(extract_between(size, 'x', '\r')) - navbar_height
   vc_dump = perform_vc_dump(vc)
   if vc_dump:
-    STATUS_BAR_HEIGHT = (
+    STATE.status_bar_height = (
         vc_dump[0].getY() - int(vc_dump[0]['layout:getLocationOnScreen_y()']))
   else:
     # Keep status at default 0 height.
@@ -104,11 +196,170 @@ def set_device_dimens(vc, device):
 
 
 def is_in_bounds(x, y):
-  return x >= 0 and x <= MAX_X and y >= STATUS_BAR_HEIGHT and y <= MAX_Y
+  return (x >= 0 and x <= STATE.max_x and y >= STATE.status_bar_height and
+          y <= STATE.max_y)
+
+
+def get_snapshot(device):
+  """Returns the DeviceSnapshot of the device for the current step."""
+  if not STATE.snapshot or STATE.snapshot.device is not device:
+    STATE.snapshot = DeviceSnapshot(device)
+  return STATE.snapshot
+
+
+def invalidate_snapshot():
+  """Must be called after every input event or app (re)launch."""
+  if STATE.snapshot:
+    STATE.snapshot.invalidate()
+
+
+def get_settle_waiter():
+  """Returns the SettleWaiter, creating it from the config on first use."""
+  if not STATE.settle:
+    STATE.settle = SettleWaiter(Config().data.get('settle'))
+  return STATE.settle
+
+
+def start_profile(package_name):
+  """Starts a new Profiler unless one is already running for the package."""
+  if STATE.profiler.package_name != package_name or not package_name:
+    STATE.profiler = profiler.Profiler(package_name)
+  return STATE.profiler
+
+
+def instrument(device, vc):
+  """Returns the device and ViewClient with their operations profiled."""
+  return (profiler.instrument(device, STATE.profiler, DEVICE_OPS),
+          profiler.instrument(vc, STATE.profiler, VC_OPS))
+
+
+def save_batch_profile(profiles):
+  """Writes the sum of the profiles of several packages to the data dir."""
+  if not profiles:
+    return
+  total = profiler.aggregate(profiles)
+  if not os.path.exists(DATA_DIR):
+    os.makedirs(DATA_DIR)
+  profiler.save_profile(total, os.path.join(DATA_DIR,
+                                            profiler.BATCH_PROFILE_FILE))
+  print 'Batch profile of {} packages:'.format(len(total['packages']))
+  profiler.print_profile(total)
+
+
+def report_near_duplicates(directory):
+  """Estimates the storage and crawl time saved by merging near duplicates."""
+  counters = STATE.profiler.counters
+  merged = counters.get('near duplicates', 0)
+  if not merged or not STATE.similar:
+    return
+  num_bytes = sum(os.path.getsize(os.path.join(directory, f))
+                  for f in os.listdir(directory))
+  bytes_saved = merged * num_bytes / max(len(STATE.similar.signatures), 1)
+  # Every merged Layout would have been saved, and its clickable views
+  # explored one crawl step at a time.
+  profile = STATE.profiler.to_dict()
+  create_ms = profile['ops'].get('create layout', {}).get('mean_ms', 0)
+  num_steps = profile['ops'].get('touch', {}).get('count', 0)
+  step_s = profile['wall_s'] / num_steps if num_steps else 0
+  seconds_saved = (merged * create_ms / 1000.0 +
+                   counters.get('near duplicate clickables', 0) * step_s)
+  STATE.profiler.count('near duplicate bytes saved', bytes_saved)
+  STATE.profiler.count('near duplicate seconds saved', round(seconds_saved, 1))
+  print ('Merged {} near duplicate layouts, saving about {} bytes and {:.0f}s '
+         'of crawling.'.format(merged, bytes_saved, seconds_saved))
+
+
+def save_checkpoint(layout_map, layout_graph, still_exploring):
+  """Saves the state of the crawl so that it can be resumed if it dies.
+
+  Does nothing unless a Layout or transition was recorded since the last
+  checkpoint, or CHECKPOINT_STEPS steps were taken.
+  """
+  key = (len(layout_map), len(still_exploring),
+         sum(len(ends) for ends in layout_graph.edges.itervalues()),
+         sum(len(layout.click_dict) for layout in layout_map.itervalues()))
+  STATE.steps_since_checkpoint += 1
+  if (key == STATE.checkpoint_key and
+      STATE.steps_since_checkpoint < CHECKPOINT_STEPS):
+    STATE.profiler.count('checkpoints skipped')
+    return
+  with STATE.profiler.timed('checkpoint'):
+    checkpoint.save(STATE.store.directory, layout_map, layout_graph,
+                    still_exploring)
+  STATE.checkpoint_key = key
+  STATE.steps_since_checkpoint = 0
+
+
+def wait_for_settle(device, vc=None, label='settle'):
+  """Waits until the UI stops changing instead of sleeping a fixed time."""
+  with STATE.profiler.timed('settle:' + label):
+    return get_settle_waiter().wait(get_snapshot(device), vc, label)
+
+
+def wait_for_launch(device, vc=None):
+  """Waits for a freshly (re)launched app to finish loading."""
+  waiter = get_settle_waiter()
+  with STATE.profiler.timed('settle:launch'):
+    return waiter.wait(get_snapshot(device), vc, 'launch',
+                       waiter.settings['launch_deadline'])
 
 
 def perform_press_back(device):
   device.press('KEYCODE_BACK')
+  invalidate_snapshot()
+
+
+def perform_tap(device, x, y):
+  """Taps the screen at x, y using the input shell command."""
+  device.shell('input tap ' + str(x) + ' ' + str(y))
+  invalidate_snapshot()
+
+
+def dump_if_changed(device, vc):
+  """Dumps the view hierarchy unless the screen is the same as last time.
+
+  The screen is taken to be the same if the window digest of the snapshot,
+  which costs no extra query, is. With the screencap probe on, the digests of
+  the screen have to match as well.
+  """
+  snapshot = get_snapshot(device)
+  window = snapshot.get_window_digest() if snapshot.probe_window else None
+  if not window:
+    STATE.last_dump = None
+    return perform_vc_dump(vc)
+  same = bool(STATE.last_dump) and STATE.last_dump[0] == window
+  # The digest is taken even if the window changed, so that the next step can
+  # be compared with the screen of this step's dump.
+  digest = snapshot.get_screen_digest() if snapshot.probe_screen else None
+  if digest:
+    STATE.profiler.count('screencap probes')
+    if same:
+      same = digest == STATE.last_dump[1]
+      if same:
+        STATE.profiler.count('screencap probe hits')
+    check_screen_probe(snapshot)
+  if same:
+    STATE.profiler.count('screen probe hits')
+    return STATE.last_dump[2]
+  STATE.profiler.count('screen probe misses')
+  vc_dump = perform_vc_dump(vc)
+  STATE.last_dump = (window, digest, vc_dump) if vc_dump else None
+  return vc_dump
+
+
+def check_screen_probe(snapshot):
+  """Turns the screencap probe off if it costs more than it saves."""
+  counters = STATE.profiler.counters
+  hits = counters.get('screencap probe hits', 0)
+  probes = counters.get('screencap probes', 0)
+  if probes % PROBE_TRIAL:
+    return
+  saved = hits * STATE.profiler.mean_seconds('dump', DEFAULT_DUMP_SECONDS)
+  spent = probes * STATE.profiler.mean_seconds('shell:screencap',
+                                               DEFAULT_DIGEST_SECONDS)
+  if saved < spent:
+    print 'The screencap probe costs more than it saves, turning it off.'
+    snapshot.probe_screen = False
 
 
 def perform_vc_dump(vc):
@@ -128,6 +379,7 @@ def touch(device, view):
   try:
     (x, y) = view.getXY()
     device.touch(x, y)
+    invalidate_snapshot()
     print('Clicked  {} {}, ({},{})'.format(view.getUniqueId(),
                                            view.getClass(), view.getX(),
                                            view.getY()))
@@ -137,7 +389,7 @@ def touch(device, view):
     print '***String coordinates'
 
 
-def use_keyboard(prev_clicked, config_data, device, vc):
+def use_keyboard(prev_clicked, device, vc):
   """Type text when the keyboard is visible."""
 
   print 'Prev clicked: ' + prev_clicked
@@ -172,39 +424,11 @@ def use_keyboard(prev_clicked, config_data, device, vc):
     perform_press_back(device)
     return
 
-  # Check if the id contains any of the words in the [basic_info] section of the
-  # config. If any of these fields have been removed, do not type anything.
-  basic_info = config_data.get('basic_info')
-  if 'name' in prev_clicked:
-    if any(x in prev_clicked for x in['last', 'sur']):
-      print 'Typing last name ' + basic_info.get('last_name', '')
-      device.type(basic_info.get('last_name', ''))
-    elif any(x in prev_clicked for x in['user']):
-      print 'Typing username ' + basic_info.get('username', '')
-    else:
-      print 'Typing first name ' + basic_info.get('first_name', '')
-      device.type(basic_info.get('first_name', ''))
-  elif any(x in prev_clicked for x in['email', 'mail', 'address']):
-    print 'Typing email address ' + basic_info.get('email', '')
-    device.type(basic_info.get('email', ''))
-  elif any(x in prev_clicked for x in['password', 'pw']):
-    print 'Typing password ' + basic_info.get('password', '')
-    device.type(basic_info.get('password', ''))
-  elif any(x in prev_clicked for x in['zip']):
-    print 'Typing zip code ' + basic_info.get('zipcode', '')
-    device.type(basic_info.get('zipcode', ''))
-  elif any(x in prev_clicked for x in['phone']):
-    print 'Typing phone number ' + basic_info.get('phone_num', '')
-    device.type(basic_info.get('phone_num', ''))
-  else:
-    # If the user has added additional fields in the config, check for those.
-    for c in config_data.get('extra'):
-      if any(x in prev_clicked for x in c):
-        device.type(config_data.get('extra').get(c, ''))
-        break
-    else:
-      print 'Typing default text ' + basic_info.get('default', '')
-      device.type(basic_info.get('default', ''))
+  # Match the id against the [text_rules] and [extra] sections of the config.
+  # If the matching field has been removed from the config, nothing is typed.
+  name, text = STATE.text_rules.text_for(prev_clicked)
+  print 'Typing ' + name.replace('_', ' ') + ' ' + text
+  device.type(text)
 
   # TODO(afergan): The enter key can sometimes advance us to the next field or
   # Layout, but we would have to track that here. For now, just minimize the
@@ -217,14 +441,13 @@ def fb_login(package_name, device, curr_layout, click, vc):
   """Log into Facebook by automating the authentication flow."""
 
   # Get the full name of the current activity.
-  focus_str = device.shell("dumpsys window windows | grep -E 'mCurrentFocus'")
+  focus_str = get_snapshot(device).get_focus()
   app_activity = extract_between(focus_str, ' ', '}', -1)
   print 'App activity: ' + app_activity
   print 'Trying to log into Facebook.'
   # Sometimes touch() doesn't work
   curr_layout.clickable.remove(click)
-  device.shell('input tap ' + str(click.getX()) +
-               ' ' + str(click.getY()))
+  perform_tap(device, click.getX(), click.getY())
 
   # Make sure the new screen is loaded by waiting for the dump.
   perform_vc_dump(vc)
@@ -247,16 +470,18 @@ def fb_login(package_name, device, curr_layout, click, vc):
     device.shell('am force-stop com.facebook.katana')
     device.shell('monkey -p com.facebook.katana -c '
                  'android.intent.category.LAUNCHER 1')
-    time.sleep(2)
+    invalidate_snapshot()
+    wait_for_launch(device)
     # Relaunch the app with the previous activity.
     out = device.shell('su 0 am start -n ' + app_activity)
+    invalidate_snapshot()
     if any(x in out for x in['Error', 'Warning']):
       # TODO(afergan): Relaunch the app and follow the shortest path to here.
       return False
 
-    time.sleep(5)
-    device.shell('input tap ' + str(click.getX()) + ' ' + str(click.getY()))
-    time.sleep(5)
+    wait_for_launch(device, vc)
+    perform_tap(device, click.getX(), click.getY())
+    wait_for_settle(device, vc, 'login')
     activity_str = obtain_focused_activity(device, vc)
     print activity_str
     f += 1
@@ -268,8 +493,7 @@ def fb_login(package_name, device, curr_layout, click, vc):
     # Because the Facebook authorization dialog is primarily a
     # WebView, we must click on x, y coordinates of the Continue
     # button instead of looking at the hierarchy.
-    device.shell('input tap ' + str(int(.5 * MAX_X)) + ' ' +
-                 str(int(.82 * MAX_Y)))
+    perform_tap(device, int(.5 * STATE.max_x), int(.82 * STATE.max_y))
     perform_vc_dump(vc)
     activity_str = obtain_focus_and_allow_permissions(device, vc)
 
@@ -277,10 +501,10 @@ def fb_login(package_name, device, curr_layout, click, vc):
     num_taps = 0
     while 'ProxyAuthDialog' in activity_str and num_taps < MAX_FB_AUTH_TAPS:
       print 'Facebook authorization #' + str(num_taps)
-      device.shell('input tap ' + str(int(.90 * MAX_X)) + ' ' +
-                   str(int(.95 * MAX_Y)))
+      perform_tap(device, int(.90 * STATE.max_x),
+                  int(.95 * STATE.max_y))
       num_taps += 1
-      time.sleep(3)
+      wait_for_settle(device, label='login')
       activity_str = obtain_focus_and_allow_permissions(device, vc)
     return True
 
@@ -299,7 +523,7 @@ def google_login(device, curr_layout, click, vc):
 
   curr_layout.clickable.remove(click)
   touch(device, click)
-  time.sleep(4)
+  wait_for_settle(device, vc, 'login')
   # Make sure the new screen is loaded by waiting for the dump.
   vc_dump = perform_vc_dump(vc)
   if not vc_dump:
@@ -320,7 +544,7 @@ def google_login(device, curr_layout, click, vc):
     if v:
       touch(device, v)
       print 'Selected user.'
-      time.sleep(4)
+      wait_for_settle(device, vc, 'login')
       perform_vc_dump(vc)
     activity_str = obtain_focus_and_allow_permissions(device, vc)
     print activity_str
@@ -331,11 +555,24 @@ def google_login(device, curr_layout, click, vc):
     if v:
       print 'Granting'
       touch(device, v)
-      time.sleep(4)
+      wait_for_settle(device, vc, 'login')
 
   return True
 
 
+def obtain_layout_on_screen(package_name, device, vc, layout_map,
+                            still_exploring):
+  """Returns the Layout on screen, or None if the app is not in front."""
+  activity = obtain_activity_name(package_name, device, vc)
+  if activity == EXITED_APP:
+    return None
+  vc_dump = perform_vc_dump(vc)
+  if not vc_dump:
+    return None
+  return obtain_curr_layout(activity, package_name, vc_dump, layout_map,
+                            still_exploring, device)
+
+
 def return_to_app_activity(package_name, device, vc):
   """Tries to press back a number of times to return to the app."""
 
@@ -347,7 +584,7 @@ def return_to_app_activity(package_name, device, vc):
       print 'Returned to app'
       return activity
 
-    time.sleep(5)
+    wait_for_settle(device, vc, 'return to app')
     print 'Failed returning to app, attempt #' + str(press_num + 1)
 
   return EXITED_APP
@@ -370,17 +607,16 @@ def obtain_focused_activity(device, vc):
 
 def obtain_focus_and_allow_permissions(device, vc):
   """Accepts any permission prompts and returns the current focus."""
-  activity_str = device.shell("dumpsys window windows "
-                              "| grep -E 'mCurrentFocus'")
+  snapshot = get_snapshot(device)
+  activity_str = snapshot.get_focus()
 
   # If the app is prompting for permissions, automatically accept them.
   while 'com.android.packageinstaller' in activity_str:
     print 'Allowing a permission.'
     perform_vc_dump(vc)
     touch(device, vc.findViewById('id/permission_allow_button'))
-    time.sleep(2)
-    activity_str = device.shell("dumpsys window windows "
-                                "| grep -E 'mCurrentFocus'")
+    wait_for_settle(device, vc, 'permission')
+    activity_str = snapshot.get_focus()
 
   # Keycodes are from
   # https://developer.android.com/reference/android/view/KeyEvent.html
@@ -388,13 +624,12 @@ def obtain_focus_and_allow_permissions(device, vc):
   # If a physical device is at the lockscreen, unlock it.
   if 'StatusBar' in activity_str:
     # If the screen is off, turn it on.
-    if (device.shell("dumpsys power | grep 'Display Power: state=' | grep -oE "
-                     "'(ON|OFF)'") == 'OFF'):
+    if not snapshot.is_screen_on():
       device.press('KEYCODE_POWER')
     # Unlock device.
     device.press('KEYCODE_MENU')
-    activity_str = device.shell("dumpsys window windows "
-                                "| grep -E 'mCurrentFocus'")
+    snapshot.invalidate()
+    activity_str = snapshot.get_focus()
   return activity_str
 
 
@@ -422,19 +657,7 @@ def obtain_activity_name(package_name, device, vc):
 
 def obtain_frag_list(package_name, device):
   """Gets the list of fragments in the current layout."""
-  activity_dump = device.shell('dumpsys activity ' + package_name)
-  frag_dump = re.findall('Added Fragments:(.*?)FragmentManager', activity_dump,
-                         re.DOTALL)
-  if frag_dump:
-    frag_list = re.findall(': (.*?){', frag_dump[0], re.DOTALL)
-    # For irregular or app-generated fragment names with spaces and IDs,
-    # terminate the name at the first space.
-    for i in range(0, len(frag_list)):
-      if ' ' in frag_list[i]:
-        frag_list[i] = frag_list[i].split()[0]
-    return frag_list
-
-  return []
+  return get_snapshot(device).get_frag_list(package_name)
 
 
 def obtain_package_name(device, vc):
@@ -453,16 +676,13 @@ def obtain_package_name(device, vc):
 
 def is_active_layout(stored_layout, package_name, device, vc):
   """Check if the current Layout name matches a stored Layout."""
-  print str(obtain_frag_list(package_name, device))
-  print ('Curr activity / frag list: ' +
-         obtain_activity_name(package_name, device, vc) + ' ' +
-         str(obtain_frag_list(package_name, device)))
+  activity = obtain_activity_name(package_name, device, vc)
+  frag_list = obtain_frag_list(package_name, device)
+  print 'Curr activity / frag list: ' + activity + ' ' + str(frag_list)
   print ('Stored activity + frag list: ' + stored_layout.activity + ' ' +
          str(stored_layout.frag_list))
-  return (obtain_activity_name(package_name, device, vc) ==
-          stored_layout.activity and Counter(obtain_frag_list(package_name,
-                                                              device)) ==
-          Counter(stored_layout.frag_list))
+  return (activity == stored_layout.activity and
+          Counter(frag_list) == Counter(stored_layout.frag_list))
 
 
 def save_layout_data(package_name, device, activity, frag_list, vc_dump):
@@ -473,17 +693,10 @@ def save_layout_data(package_name, device, activity, frag_list, vc_dump):
     first_frag = frag_list[0]
   else:
     first_frag = 'NoFrags'
-  directory = (os.path.dirname(os.path.abspath(__file__)) + '/data/' +
-               package_name)
-  if not os.path.exists(directory):
-    os.makedirs(directory)
-  file_num = 0
+  directory = STATE.store.directory
+  file_num = STATE.store.next_file_num(activity + '-' + first_frag)
   dump_file = os.path.join(directory, activity + '-' + first_frag + '-' +
-                           str(file_num) + '.json')
-  while os.path.exists(dump_file):
-    file_num += 1
-    dump_file = os.path.join(directory, activity + '-' + first_frag + '-' +
-                             str(file_num) + '.json')
+                           str(file_num))
 
   layout_info = {}
   layout_info['hierarchy'] = {}
@@ -502,46 +715,43 @@ def save_layout_data(package_name, device, activity, frag_list, vc_dump):
       dict_copy['children'].append(child.getUniqueId())
     layout_info['hierarchy'][view.getUniqueId()] = dict_copy
 
-  with open(dump_file, 'w') as out_file:
-    try:
-      json.dump(layout_info, out_file, indent=2)
-    except TypeError:
-      print 'Non-JSON serializable object in Layout.'
-
-  screen_name = activity + '-' + first_frag + '-' + str(file_num) + '.png'
-  screen_path = os.path.join(directory, screen_name)
-  # device.shell() does not work for taking/pulling screencaps.
-  device.shell('screencap /sdcard/' + screen_name)
-  subprocess.call([ADB_PATH, '-s', SERIAL_NO, 'pull', '/sdcard/' + screen_name,
-                   screen_path])
-  device.shell('rm /sdcard/' + screen_name)
+  try:
+    if STATE.hierarchy_format == COMPACT_FORMAT:
+      compacthierarchy.save(layout_info,
+                            dump_file + compacthierarchy.EXTENSION)
+    else:
+      with open(dump_file + '.json', 'w') as out_file:
+        json.dump(layout_info, out_file, indent=2)
+  except TypeError:
+    print 'Non-JSON serializable object in Layout.'
+
+  screen_path = STATE.screenshots.capture(
+      STATE.transport, os.path.join(directory, activity + '-' + first_frag +
+                                    '-' + str(file_num)))
   # Returns the filename & num so that the screenshot can be accessed
   # programatically.
   return screen_path, file_num
 
 
-def save_ui_flow_relationships(layout_to_save, package_name):
-  """Dumps to file the click dictionary and preceding Layouts."""
-  directory = (os.path.dirname(os.path.abspath(__file__)) + '/data/' +
-               package_name)
-  click_file = os.path.join(directory, layout_to_save.get_name() +
-                            '-clicks.json')
-  click_info = {}
-  click_info['click_dict'] = layout_to_save.click_dict
-  click_info['preceding'] = layout_to_save.preceding
-  click_info['depth'] = layout_to_save.depth
-  with open(click_file, 'w') as out_file:
-    json.dump(click_info, out_file, indent=2)
-
-
 def find_layout_in_map(activity, frag_list, vc_dump, layout_map):
   """Finds the  current Layout in the layout array (empty if new Layout)."""
-  # TODO(afergan): Consider creating another map indexed by the values compared
-  # in is_duplicate so that this comparison is O(1).
-  for val in layout_map.values():
-    if val.is_duplicate(activity, frag_list, vc_dump):
-      return val
-  return None
+  # The LayoutMap is indexed by Layout fingerprint, so this lookup is O(1) in
+  # the number of stored Layouts.
+  layout = layout_map.find(activity, frag_list, vc_dump)
+  if layout or not STATE.similar:
+    return layout
+
+  # A Layout whose hierarchy is almost the same, such as a feed with one
+  # different row, is treated as the same Layout.
+  match = STATE.similar.find(activity, frag_list,
+                             similarity.dump_signature(vc_dump))
+  if not match or match[0] not in layout_map:
+    return None
+  print 'Near duplicate of {} ({:.2f})'.format(*match)
+  STATE.profiler.count('near duplicates')
+  STATE.profiler.count('near duplicate clickables',
+                       sum(1 for v in vc_dump if v.isClickable()))
+  return layout_map[match[0]]
 
 
 def create_layout(package_name, device, vc_dump, activity, frag_list):
@@ -592,7 +802,20 @@ def create_layout(package_name, device, vc_dump, activity, frag_list):
   return l
 
 
-def link_ui_layouts(prev_layout, curr_layout, prev_clicked, package_name):
+def navigation_graph(layout_graph, layout_map):
+  """Returns the Layout graph with the recorded back button edges added."""
+  graph = LayoutGraph()
+  for start, ends in layout_graph.edges.iteritems():
+    for end in ends:
+      graph.add_edge(start, end)
+  for name, layout in layout_map.iteritems():
+    back = layout.click_dict.get(BACK_BUTTON)
+    if back in layout_map and back != name:
+      graph.add_edge(name, back)
+  return graph
+
+
+def link_ui_layouts(prev_layout, curr_layout, prev_clicked):
   """Stores the relationship between prev_layout and curr_layout."""
 
   # We store in the Layout information that the last layout links to the current
@@ -606,6 +829,9 @@ def link_ui_layouts(prev_layout, curr_layout, prev_clicked, package_name):
     prev_name = prev_layout.get_name()
     if prev_name not in curr_layout.preceding:
       curr_layout.preceding.append(prev_name)
+    if (prev_clicked == BACK_BUTTON and STATE.navigation and
+        prev_name != curr_layout.get_name()):
+      STATE.navigation.add_edge(prev_name, curr_layout.get_name())
   else:
     print 'Lost track of last clicked!'
   print 'Prev layout: ' + prev_layout.get_name()
@@ -613,12 +839,9 @@ def link_ui_layouts(prev_layout, curr_layout, prev_clicked, package_name):
   if curr_layout.depth == -1 or curr_layout.depth > prev_layout.depth + 1:
     curr_layout.depth = prev_layout.depth + 1
 
-  # TODO(afergan): Remove this later. For debugging, we print the clicks after
-  # each click to a new layout is recorded. However, this results in a lot of
-  # repeated writes to the same file. In the future, we can just write each
-  # file once we're done crawling the app.
-  save_ui_flow_relationships(prev_layout, package_name)
-  save_ui_flow_relationships(curr_layout, package_name)
+  # The relationship is appended to the journal of the CrawlStore, which
+  # writes the -clicks.json files once we're done crawling the app.
+  STATE.store.record_link(prev_layout, curr_layout, prev_clicked)
 
 
 def obtain_curr_layout(activity, package_name, vc_dump, layout_map,
@@ -637,12 +860,17 @@ def obtain_curr_layout(activity, package_name, vc_dump, layout_map,
     return layout
   else:
     print 'New layout'
-    new_layout = create_layout(package_name, device, vc_dump, activity,
-                               frag_list)
+    with STATE.profiler.timed('create layout'):
+      new_layout = create_layout(package_name, device, vc_dump, activity,
+                                 frag_list)
     # Make sure we have a valid Layout. This will be false if we get a socket
     # timeout.
     if new_layout.get_name():
       layout_map[new_layout.get_name()] = new_layout
+      if STATE.similar:
+        new_layout.signature = similarity.dump_signature(vc_dump)
+        STATE.similar.add(new_layout.get_name(), activity, frag_list,
+                          new_layout.signature)
       # If there are clickable views, explore this new Layout.
       if new_layout.clickable:
         still_exploring[new_layout.get_name()] = new_layout
@@ -669,27 +897,7 @@ def find_view_to_lead_to_layout(layout1, layout2):
 
 def find_shortest_path(graph, start, end, prevpath=()):
   """Use BFS to find the shortest path from the start to end node."""
-
-  # Modified from http://stackoverflow.com/a/8922151/1076508 to prevent cycles
-  # and account for already visited nodes.
-
-  queue = [[start]]
-  visited = set(prevpath)
-
-  while queue:
-    path = queue.pop(0)
-    node = path[-1]
-    # Path found.
-    if node == end:
-      return path
-    # Enumerate all adjacent nodes, construct a new path and push it into the
-    # queue.
-    for adjacent in graph.get(node, []):
-      if adjacent not in visited:
-        new_path = list(path)
-        new_path.append(adjacent)
-        queue.append(new_path)
-        visited.add(adjacent)
+  return graph.shortest_path(start, end, prevpath)
 
 
 def follow_path_to_layout(path, goal, package_name, device, layout_map,
@@ -699,6 +907,7 @@ def follow_path_to_layout(path, goal, package_name, device, layout_map,
   # We need to look at the length of path for each iteration since the path can
   # change when we get off course.
   i = 0
+  prev_clicked = ''
   while i < len(path) - 1:
     # We can be lenient here and only evaluate if the activity and fragments are
     # the same (and allow the layout hierarchy to have changed a little bit),
@@ -718,6 +927,7 @@ def follow_path_to_layout(path, goal, package_name, device, layout_map,
                click_id)
         return False
       if click_id == BACK_BUTTON:
+        prev_clicked = BACK_BUTTON
         perform_press_back(device)
       else:
         vc_dump = perform_vc_dump(vc)
@@ -731,14 +941,14 @@ def follow_path_to_layout(path, goal, package_name, device, layout_map,
           return False
     else:
       print 'Toto, I\'ve a feeling we\'re not on the right path anymore.'
-      # Remove the edge from the graph so that we don't follow it again (but
-      # don't remove it from our data collection.
-      try:
-        layout_graph[p].remove(path[i+1])
+      # Remove the edge from the graphs so that we don't follow it again (but
+      # don't remove it from our data collection. Back button edges are only
+      # in the planner's graph.
+      if path[i+1] in layout_graph.neighbors(p):
+        layout_graph.remove_edge(p, path[i+1])
         print 'Removed edge from ' + p + ' to ' + path[i+1]
-      except KeyError:
-        print ('??? Could not find edge from ' + p + ' to ' + path[i+1] +
-               ' to remove from graph.')
+      if path[i+1] in STATE.navigation.neighbors(p):
+        STATE.navigation.remove_edge(p, path[i+1])
 
       # Figure out where we are & link it to the previous layout, but then try
       # to still get to the intended Layout.
@@ -755,7 +965,7 @@ def follow_path_to_layout(path, goal, package_name, device, layout_map,
       path_to_curr = path[:i]
 
       if not prev_layout.is_duplicate_layout(curr_layout):
-        link_ui_layouts(prev_layout, curr_layout, prev_clicked, package_name)
+        link_ui_layouts(prev_layout, curr_layout, prev_clicked)
         path_to_curr.append(curr_layout.get_name())
 
       new_path = find_shortest_path(layout_graph, curr_layout.get_name(),
@@ -779,7 +989,7 @@ def follow_path_to_layout(path, goal, package_name, device, layout_map,
 
 
 def crawl_until_exit(vc, device, package_name, layout_map, layout_graph,
-                     still_exploring, start_layout, logged_in, config_data):
+                     still_exploring, start_layout, logged_in):
   """Main crawler loop. Evaluates layouts, stores new data, and clicks views."""
 
   print 'Logged in: ' + str(logged_in)
@@ -790,7 +1000,8 @@ def crawl_until_exit(vc, device, package_name, layout_map, layout_graph,
   while (len(layout_map) < MAX_LAYOUTS and
          consec_back_presses < MAX_CONSEC_BACK_PRESSES):
 
-    if device.isKeyboardShown():
+    save_checkpoint(layout_map, layout_graph, still_exploring)
+    if get_snapshot(device).is_keyboard_shown():
       perform_press_back(device)
 
     activity = obtain_activity_name(package_name, device, vc)
@@ -804,21 +1015,18 @@ def crawl_until_exit(vc, device, package_name, layout_map, layout_graph,
         prev_clicked = BACK_BUTTON
 
     prev_layout = curr_layout
-    vc_dump = perform_vc_dump(vc)
+    vc_dump = dump_if_changed(device, vc)
     if vc_dump:
       curr_layout = obtain_curr_layout(activity, package_name, vc_dump,
                                        layout_map, still_exploring, device)
       print 'Curr layout: ' + curr_layout.get_name()
       if not prev_layout.is_duplicate_layout(curr_layout):
         print 'At a diff layout!'
-        link_ui_layouts(prev_layout, curr_layout, prev_clicked, package_name)
+        link_ui_layouts(prev_layout, curr_layout, prev_clicked)
         prev_name = prev_layout.get_name()
-        if prev_name in layout_graph:
-          print 'New set: ' + prev_name + ' ' + curr_layout.get_name()
-          layout_graph.get(prev_name).add(curr_layout.get_name())
-        else:
-          layout_graph[prev_name] = {curr_layout.get_name()}
-          print 'Adding to set: ' + prev_name + ' ' + curr_layout.get_name()
+        STATE.navigation.add_edge(prev_name, curr_layout.get_name())
+        if layout_graph.add_edge(prev_name, curr_layout.get_name()):
+          print 'Adding edge: ' + prev_name + ' ' + curr_layout.get_name()
           print 'Num of nodes in layout graph: ' + str(len(layout_graph))
 
       print 'Layout depth: ' + str(curr_layout.depth)
@@ -827,31 +1035,21 @@ def crawl_until_exit(vc, device, package_name, layout_map, layout_graph,
       if curr_layout.clickable:
         found_login = False
         if not logged_in:
-          for click in curr_layout.clickable:
-            clickid = click.getUniqueId().lower()
-            if click.getText():
-              clicktext = click.getText().lower()
-            else:
-              clicktext = ''
-            if (click.getClass() == 'com.facebook.widget.LoginButton'
-                or any('facebook' in x for x in [clickid, clicktext])
-                or ('fb' in clickid and any(s in clickid for s in
-                                            ['login', 'log_in', 'signin',
-                                             'sign_in']))):
+          for click, login in STATE.login_rules.login_views(curr_layout):
+            if login == rules.FACEBOOK:
               found_login = True
               consec_back_presses = 0
               prev_clicked = click.getUniqueId()
-              logged_in = fb_login(package_name, device, curr_layout, click, vc)
+              with STATE.profiler.phase(profiler.LOGIN):
+                logged_in = fb_login(package_name, device, curr_layout, click,
+                                     vc)
 
-            elif (click.getClass ==
-                  'com.google.android.gms.common.SignInButton' or
-                  any('google' in x for x in [clickid, clicktext]) or
-                  any('gplus' in x for x in [clickid, clicktext]) or
-                  clickid == 'sign_in_button'):
+            elif login == rules.GOOGLE:
               found_login = True
               consec_back_presses = 0
               prev_clicked = click.getUniqueId()
-              logged_in = google_login(device, curr_layout, click, vc)
+              with STATE.profiler.phase(profiler.LOGIN):
+                logged_in = google_login(device, curr_layout, click, vc)
 
         if not found_login:
           c = curr_layout.clickable[0]
@@ -859,8 +1057,8 @@ def crawl_until_exit(vc, device, package_name, layout_map, layout_graph,
           consec_back_presses = 0
           prev_clicked = c.getUniqueId()
           curr_layout.clickable.remove(c)
-          if device.isKeyboardShown():
-            use_keyboard(prev_clicked, config_data, device, vc)
+          if get_snapshot(device).is_keyboard_shown():
+            use_keyboard(prev_clicked, device, vc)
 
       else:
         print 'Removing ' + curr_layout.get_name() + ' from still_exploring.'
@@ -901,8 +1099,7 @@ def crawl_until_exit(vc, device, package_name, layout_map, layout_graph,
             print 'Pressing back keeps at the current layout.'
             break
           else:
-            link_ui_layouts(prev_layout, curr_layout, 'back button',
-                            package_name)
+            link_ui_layouts(prev_layout, curr_layout, BACK_BUTTON)
     else:
       perform_press_back(device)
       consec_back_presses += 1
@@ -911,22 +1108,70 @@ def crawl_until_exit(vc, device, package_name, layout_map, layout_graph,
 
 
 def crawl_package(vc, device, serialno, package_name=None):
-  """Crawl package. Explore blindly, then return to unexplored layouts."""
+  """Crawl package. Explore blindly, then return to unexplored layouts.
+
+  Returns:
+    Whether the crawl finished. Otherwise its checkpoint is kept.
+  """
 
-  global SERIAL_NO
-  SERIAL_NO = serialno
+  STATE.serialno = serialno
+  start_profile(package_name)
+  device, vc = instrument(device, vc)
+  STATE.transport = profiler.instrument(get_transport(serialno),
+                                        STATE.profiler, TRANSPORT_OPS)
+  config_data = Config().data
+  STATE.screenshots = ScreenshotWriter(config_data.get('screenshots'))
+  STATE.hierarchy_format = config_data.get('settings', {}).get(
+      'hierarchy_format', JSON_FORMAT)
+
+  completed = False
+  try:
+    completed = explore_package(vc, device, package_name, config_data)
+  finally:
+    # Screenshots are written in the background, so make sure they are all
+    # saved before the package is uninstalled or the next one is crawled.
+    STATE.screenshots.finish()
+    if STATE.store:
+      directory = STATE.store.directory
+      report_near_duplicates(directory)
+      STATE.profiler.save(os.path.join(directory, profiler.PROFILE_FILE))
+      STATE.store.close()
+      STATE.store = None
+      # If the crawl died or stopped early, the checkpoint is kept and the
+      # status stays IN_PROGRESS so that it can be resumed.
+      if completed:
+        checkpoint.clear(directory)
+        checkpoint.write_status(directory, checkpoint.COMPLETE)
+    profiler.print_profile(STATE.profiler.to_dict())
+  return completed
+
+
+def explore_package(vc, device, package_name, config_data):
+  """Explore blindly, then return to unexplored layouts.
+
+  Returns:
+    Whether the crawl finished, rather than stopping because the app could not
+    be reached.
+  """
 
   set_device_dimens(vc, device)
   # Layout map stores all Layouts that we have seen, while the still_exploring
   # consists of only Layouts that have not been exhaustively explored yet (or
   # found to be unreachable.) The Layout graph stores all of the connections
   # between different screens.
-  layout_map = {}
+  layout_map = LayoutMap()
   still_exploring = {}
-  layout_graph = {}
+  layout_graph = LayoutGraph()
 
-  config_data = Config().data
   settings = config_data.get('settings')
+  threshold = float((settings or {}).get('near_duplicate_threshold', 0))
+  STATE.similar = similarity.SimilarityIndex(threshold) if threshold else None
+  # Picks which unexplored Layout each recrawl goes to.
+  frontier = make_frontier((settings or {}).get('frontier', 'priority'),
+                           STATE.profiler)
+  planner = NavigationPlanner(frontier, STATE.profiler)
+  STATE.text_rules = TextRules(config_data)
+  STATE.login_rules = LoginRules(config_data.get('login_rules'))
 
   if settings:
     if settings.get('lock_portrait_mode'):
@@ -956,92 +1201,240 @@ def crawl_package(vc, device, serialno, package_name=None):
 
   if not package_name:
     package_name = obtain_package_name(device, vc)
+    STATE.profiler.package_name = package_name
+  STATE.snapshot = DeviceSnapshot(device, package_name)
+  probe = (settings or {}).get('screen_probe', PROBE_WINDOW).lower()
+  # Earlier configs turned the screencap probe on and off with True and False.
+  probe = {'true': PROBE_SCREENCAP, 'false': PROBE_OFF}.get(probe, probe)
+  if probe not in (PROBE_OFF, PROBE_WINDOW, PROBE_SCREENCAP):
+    print 'Unknown screen probe ' + probe + ', using ' + PROBE_WINDOW + '.'
+    probe = PROBE_WINDOW
+  STATE.snapshot.probe_window = probe != PROBE_OFF
+  STATE.snapshot.probe_screen = probe == PROBE_SCREENCAP
+  STATE.last_dump = None
+  STATE.checkpoint_key = None
+  STATE.steps_since_checkpoint = 0
+  STATE.store = CrawlStore(os.path.join(DATA_DIR, package_name))
+  checkpoint.write_status(STATE.store.directory, checkpoint.IN_PROGRESS)
+  saved = checkpoint.load(STATE.store.directory)
+  if saved:
+    layout_map, layout_graph, still_exploring = saved
+    if STATE.similar:
+      for name, layout in layout_map.iteritems():
+        STATE.similar.add(name, layout.activity, layout.frag_list,
+                          layout.signature)
+    print ('Resuming from a checkpoint with ' + str(len(layout_map)) +
+           ' layouts.')
+  STATE.navigation = navigation_graph(layout_graph, layout_map)
 
   activity = obtain_activity_name(package_name, device, vc)
   if activity == EXITED_APP:
-    return
+    print 'The app is not in front.'
+    return False
   vc_dump = perform_vc_dump(vc)
   if not vc_dump:
-    return
+    return False
 
   first_layout = obtain_curr_layout(activity, package_name, vc_dump, layout_map,
                                     still_exploring, device)
   first_layout.depth = 0
 
   print 'Root is ' + first_layout.get_name()
+  launch_name = first_layout.get_name()
   num_crawls = 0
+  # Set when reaching a Layout without restarting failed.
+  restart_next = False
 
-  logged_in = crawl_until_exit(vc, device, package_name, layout_map,
-                               layout_graph, still_exploring, first_layout,
-                               logged_in, config_data)
+  with STATE.profiler.phase(profiler.INITIAL_CRAWL):
+    logged_in = crawl_until_exit(vc, device, package_name, layout_map,
+                                 layout_graph, still_exploring, first_layout,
+                                 logged_in)
 
   # Recrawl Layouts that aren't completely explored.
-  while (still_exploring and num_crawls < MAX_CRAWLS and
-         len(layout_map) < MAX_LAYOUTS):
-    print 'Crawl #' + str(num_crawls)
-    num_crawls += 1
-    print 'We have seen ' + str(len(layout_map)) + ' unique layouts.'
-    print 'We still have ' + str(len(still_exploring)) + ' layouts to explore.'
-    print 'Still need to explore: ' + str(still_exploring.keys())
-    l = still_exploring.values()[0]
-    print 'Now trying to explore '+  l.get_name()
-
-    # Restart the app with its initial screen.
-    device.shell('am force-stop ' + package_name)
-    device.shell('monkey -p ' + package_name +
-                 ' -c android.intent.category.LAUNCHER 1')
-
-    time.sleep(5)
-
-    activity = obtain_activity_name(package_name, device, vc)
-    if activity == EXITED_APP:
-      print 'Could not launch app.'
-      return
-
-    starting_layout = obtain_curr_layout(activity, package_name, vc_dump,
-                                         layout_map, still_exploring, device)
-    starting_layout.depth = 0
-    print 'Starting layout: ' + starting_layout.get_name()
-    path = find_shortest_path(layout_graph, starting_layout.get_name(),
-                              l.get_name())
-    if path:
-      print ('Shortest path from ' + starting_layout.get_name() + ' to ' +
-             l.get_name() + ': ' + str(path))
-
-      reached_layout = follow_path_to_layout(path, l, package_name, device,
-                                             layout_map, layout_graph,
-                                             still_exploring, vc)
-      if reached_layout:
-        print 'Reached the layout we were looking for.'
+  with STATE.profiler.phase(profiler.RECRAWL):
+    while (still_exploring and num_crawls < MAX_CRAWLS and
+           len(layout_map) < MAX_LAYOUTS):
+      print 'Crawl #' + str(num_crawls)
+      num_crawls += 1
+      save_checkpoint(layout_map, layout_graph, still_exploring)
+      print 'We have seen ' + str(len(layout_map)) + ' unique layouts.'
+      print ('We still have ' + str(len(still_exploring)) +
+             ' layouts to explore.')
+      print 'Still need to explore: ' + str(still_exploring.keys())
+
+      # If the app is still open, an unexplored Layout may be a few back
+      # presses or clicks away, which is cheaper than restarting the app.
+      path = None
+      if not restart_next:
+        curr_layout = obtain_layout_on_screen(package_name, device, vc,
+                                              layout_map, still_exploring)
+        if curr_layout:
+          path = planner.plan(layout_graph, STATE.navigation,
+                              curr_layout.get_name(), launch_name,
+                              still_exploring)
+      restarted = not path
+      restart_next = False
+      if path:
+        print 'Going from ' + path[0] + ' without restarting.'
       else:
-        print ('Did not reach intended layout, removing ' + l.get_name() +
-               ' from still_exploring.')
-        still_exploring.pop(l.get_name(), 0)
-      activity = obtain_activity_name(package_name, device, vc)
-    else:
-      print 'No path to ' + l.get_name() + '. Removing from still_exploring.'
-      still_exploring.pop(l.get_name(), 0)
-
-    if activity != EXITED_APP:
+        # Restart the app with its initial screen.
+        device.shell('am force-stop ' + package_name)
+        device.shell('monkey -p ' + package_name +
+                     ' -c android.intent.category.LAUNCHER 1')
+        invalidate_snapshot()
+        wait_for_launch(device, vc)
 
-      vc_dump = perform_vc_dump(vc)
+        activity = obtain_activity_name(package_name, device, vc)
+        if activity == EXITED_APP:
+          print 'Could not launch app.'
+          return False
 
-      if vc_dump:
-        curr_layout = obtain_curr_layout(activity, package_name, vc_dump,
-                                         layout_map, still_exploring, device)
-        print 'Wanted ' + l.get_name() + ', at ' + curr_layout.get_name()
-
-        if curr_layout.clickable:
-          # If we made it to our intended Layout, or at least a Layout with
-          # unexplored views, start crawling again.
-          print 'Crawling again'
-          logged_in = crawl_until_exit(vc, device, package_name, layout_map,
-                                       layout_graph, still_exploring,
-                                       curr_layout, logged_in, config_data)
-          print ('Done with the crawl. Still ' + str(len(l.clickable)) +
-                 ' views to click for this Layout.')
+        vc_dump = perform_vc_dump(vc) or vc_dump
+        starting_layout = obtain_curr_layout(activity, package_name, vc_dump,
+                                             layout_map, still_exploring,
+                                             device)
+        starting_layout.depth = 0
+        launch_name = starting_layout.get_name()
+        print 'Starting layout: ' + launch_name
+        path = frontier.next_path(layout_graph, launch_name, still_exploring)
+      if path:
+        l = layout_map.get(path[-1])
+        print 'Now trying to explore ' + l.get_name()
+        print ('Shortest path from ' + path[0] + ' to ' + l.get_name() + ': ' +
+               str(path))
+
+        with STATE.profiler.phase(profiler.PATH_FOLLOWING):
+          reached_layout = follow_path_to_layout(path, l, package_name, device,
+                                                 layout_map, layout_graph,
+                                                 still_exploring, vc)
+        if reached_layout:
+          print 'Reached the layout we were looking for.'
+        elif not restarted:
+          # The recorded transitions may depend on how we got to a Layout, so
+          # try again from the launch screen before giving up on it.
+          print 'Did not reach ' + l.get_name() + ', restarting.'
+          restart_next = True
+          continue
         else:
-          print 'Nothing left to click for ' + l.get_name()
+          print ('Did not reach intended layout, removing ' + l.get_name() +
+                 ' from still_exploring.')
           still_exploring.pop(l.get_name(), 0)
+        activity = obtain_activity_name(package_name, device, vc)
+      else:
+        print ('No path to any of ' + str(still_exploring.keys()) +
+               '. Removing them from still_exploring.')
+        still_exploring.clear()
+        break
+
+      if activity != EXITED_APP:
+
+        vc_dump = perform_vc_dump(vc)
+
+        if vc_dump:
+          curr_layout = obtain_curr_layout(activity, package_name, vc_dump,
+                                           layout_map, still_exploring, device)
+          print 'Wanted ' + l.get_name() + ', at ' + curr_layout.get_name()
+
+          if curr_layout.clickable:
+            # If we made it to our intended Layout, or at least a Layout with
+            # unexplored views, start crawling again.
+            print 'Crawling again'
+            logged_in = crawl_until_exit(vc, device, package_name, layout_map,
+                                         layout_graph, still_exploring,
+                                         curr_layout, logged_in)
+            print ('Done with the crawl. Still ' + str(len(l.clickable)) +
+                   ' views to click for this Layout.')
+          else:
+            print 'Nothing left to click for ' + l.get_name()
+            still_exploring.pop(l.get_name(), 0)
 
   print 'No more layouts to crawl.'
+  print 'Device state queries: ' + str(STATE.snapshot.num_queries)
+  counters = STATE.profiler.counters
+  probes = (counters.get('screen probe hits', 0) +
+            counters.get('screen probe misses', 0))
+  if probes:
+    print 'Screen probe skipped {} of {} dumps ({:.0%}).'.format(
+        counters.get('screen probe hits', 0), probes,
+        counters.get('screen probe hits', 0) / float(probes))
+  if counters.get('screencap probes'):
+    print ('Screencap probe took {} digests, of which {} confirmed an '
+           'unchanged window.'.format(counters['screencap probes'],
+                                      counters.get('screencap probe hits', 0)))
+  get_settle_waiter().print_stats()
+  return True
+
+
+def install_and_crawl(vc, device, serialno, package, recrawl=False,
+                      uninstall=False, installer=None):
+  """Possibly installs, then launches and crawls an app.
+
+  Args:
+    vc: ViewClient connected to the device.
+    device: AdbClient of the device.
+    serialno: Serial number of the device.
+    package: Path to an APK, or the name of a package already on the device.
+    recrawl: Whether to crawl packages that already have data from scratch.
+      Otherwise complete crawls are skipped and interrupted ones resumed.
+    uninstall: Whether to uninstall the package after crawling it.
+    installer: Optional InstallPipeline that the package was submitted to, in
+      which case it is installed and uninstalled in the background.
+
+  Returns:
+    CRAWLED, SKIPPED, NOT_INSTALLED or INCOMPLETE. The profile of a crawled
+    package is left in STATE.profiler.
+  """
+
+  package_name = get_package_name(package)
+  # The profile of the package includes installing and launching it.
+  start_profile(package_name)
+  device, vc = instrument(device, vc)
+  transport = profiler.instrument(get_transport(serialno), STATE.profiler,
+                                  TRANSPORT_OPS)
+
+  # Check before installing, so that crawled packages are not installed.
+  directory = os.path.join(DATA_DIR, package_name)
+  status = checkpoint.read_status(directory)
+  if status == checkpoint.COMPLETE and not recrawl:
+    print 'Skipping ' + package_name + '; package has already been crawled.'
+    return SKIPPED
+
+  if installer:
+    with STATE.profiler.timed('install wait'):
+      installed, install_seconds = installer.wait(package)
+    if install_seconds:
+      STATE.profiler.record('install', install_seconds)
+  else:
+    installed = install_package(transport, serialno, package)
+  if not installed:
+    return NOT_INSTALLED
+
+  if recrawl:
+    checkpoint.clear(directory)
+  elif status == checkpoint.IN_PROGRESS:
+    print 'Resuming the interrupted crawl of ' + package_name
+
+  print 'Crawling ' + package_name
+
+  # Launch the app.
+  device.shell('monkey -p ' + package_name +
+               ' -c android.intent.category.LAUNCHER 1')
+  invalidate_snapshot()
+  wait_for_launch(device, vc)
+
+  try:
+    completed = crawl_package(vc, device, serialno, package_name)
+  finally:
+    if uninstall:
+      if installer:
+        installer.uninstall(package_name)
+      else:
+        uninstall_package(transport, serialno, package_name)
+
+  return CRAWLED if completed else INCOMPLETE
+
+
+def is_crawled(package):
+  """Returns whether the crawl of an APK path or package name is complete."""
+  return checkpoint.read_status(os.path.join(
+      DATA_DIR, get_package_name(package))) == checkpoint.COMPLETE
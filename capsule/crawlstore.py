@@ -0,0 +1,116 @@
+# Copyright 2016 The Vanadium Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+"""CrawlStore class definition."""
+
+import json
+import os
+
+JOURNAL_FILE = 'journal.jsonl'
+CLICKS_SUFFIX = '-clicks.json'
+
+
+def click_file_path(directory, layout_name):
+  return os.path.join(directory, layout_name + CLICKS_SUFFIX)
+
+
+def write_click_info(directory, layout_name, click_dict, preceding, depth):
+  """Writes the click dictionary and preceding Layouts of a Layout."""
+  click_info = {}
+  click_info['click_dict'] = click_dict
+  click_info['preceding'] = preceding
+  click_info['depth'] = depth
+  with open(click_file_path(directory, layout_name), 'w') as out_file:
+    json.dump(click_info, out_file, indent=2)
+
+
+class CrawlStore(object):
+  """Keeps the relationships between a package's Layouts until the crawl ends.
+
+  Instead of rewriting the -clicks.json files of both Layouts on every
+  transition, each transition is appended as one line to a journal. The
+  -clicks.json files are written once, when the store is closed. If the crawl
+  dies before that, recover() rebuilds them from the journal.
+  """
+
+  def __init__(self, directory):
+    """Constructor for CrawlStore class."""
+    self.directory = directory
+    if not os.path.exists(directory):
+      os.makedirs(directory)
+    # Finish the results of a crawl that was interrupted.
+    recover(directory)
+    # Maps Layout name to Layout for every Layout with relationships to save.
+    self.layouts = {}
+    # Maps filename prefix (activity and first fragment) to the next free file
+    # number, so we do not need to look for existing files on every save.
+    self.file_nums = {}
+    for filename in os.listdir(directory):
+      prefix, _, num = filename.rpartition('.')[0].rpartition('-')
+      if prefix and num.isdigit():
+        self.file_nums[prefix] = max(self.file_nums.get(prefix, 0),
+                                     int(num) + 1)
+    # Line buffered, so that every transition reaches the file right away.
+    self.journal = open(os.path.join(directory, JOURNAL_FILE), 'a', 1)
+
+  def next_file_num(self, prefix):
+    """Returns an unused file number for files starting with prefix."""
+    num = self.file_nums.get(prefix, 0)
+    self.file_nums[prefix] = num + 1
+    return num
+
+  def record_link(self, prev_layout, curr_layout, prev_clicked):
+    """Records that clicking prev_clicked in prev_layout led to curr_layout."""
+    self.layouts[prev_layout.get_name()] = prev_layout
+    self.layouts[curr_layout.get_name()] = curr_layout
+    entry = {'from': prev_layout.get_name(), 'to': curr_layout.get_name(),
+             'view': prev_clicked, 'from_depth': prev_layout.depth,
+             'depth': curr_layout.depth}
+    self.journal.write(json.dumps(entry) + '\n')
+
+  def materialize(self):
+    """Writes the -clicks.json file of every Layout."""
+    for name, layout in self.layouts.iteritems():
+      write_click_info(self.directory, name, layout.click_dict,
+                       layout.preceding, layout.depth)
+
+  def close(self):
+    """Writes the final results and removes the journal."""
+    self.materialize()
+    self.journal.close()
+    os.remove(self.journal.name)
+
+
+def recover(directory):
+  """Writes the -clicks.json files from the journal of an interrupted crawl.
+
+  Returns:
+    True if there was a journal to recover from.
+  """
+  journal_path = os.path.join(directory, JOURNAL_FILE)
+  if not os.path.exists(journal_path):
+    return False
+
+  # Maps Layout name to [click_dict, preceding, depth].
+  layouts = {}
+  with open(journal_path) as journal:
+    for line in journal:
+      try:
+        entry = json.loads(line)
+      except ValueError:
+        # The last line may be cut off if the crawler was killed mid-write.
+        continue
+      prev_info = layouts.setdefault(entry['from'], [{}, [], -1])
+      curr_info = layouts.setdefault(entry['to'], [{}, [], -1])
+      if entry['view']:
+        prev_info[0][entry['view']] = entry['to']
+        if entry['from'] not in curr_info[1]:
+          curr_info[1].append(entry['from'])
+      prev_info[2] = entry['from_depth']
+      curr_info[2] = entry['depth']
+
+  for name, (click_dict, preceding, depth) in layouts.iteritems():
+    write_click_info(directory, name, click_dict, preceding, depth)
+  os.remove(journal_path)
+  return True
@@ -0,0 +1,294 @@
+# Copyright 2016 The Vanadium Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+"""DevicePool class definition.
+
+A device that stops responding in the middle of a batch would otherwise stall
+its worker until someone notices. The pool checks the health of every device
+before it is leased to a crawl and after a crawl fails:
+
+  * sys.boot_completed must be 1,
+  * a trivial adb shell command must answer within MAX_ADB_LATENCY, and
+  * the view server must answer a dump.
+
+An unhealthy device is first recycled by reconnecting its ViewClient, which
+restarts the view server. If that does not help it is rebooted, and once
+MAX_RECOVERIES recoveries in a row have failed it is retired for the rest of
+the batch. A watchdog thread also checks the leased devices, and reboots a
+device that stops answering adb so that the crawl blocked on it fails instead
+of hanging. A device that answers slowly, or says it is not booted, is only
+rebooted once that happened in WATCHDOG_STRIKES checks in a row.
+"""
+
+import socket
+import subprocess
+import threading
+import time
+
+from adbtransport import AdbError
+from adbtransport import drop_transport
+from adbtransport import get_transport
+from com.dtmilano.android.viewclient import ViewClient
+
+# Health check results.
+HEALTHY = 'healthy'
+NOT_BOOTED = 'not booted'
+ADB_UNRESPONSIVE = 'adb unresponsive'
+ADB_SLOW = 'adb slow'
+VIEW_SERVER_UNRESPONSIVE = 'view server unresponsive'
+# Seconds a trivial adb shell command may take on a healthy device.
+MAX_ADB_LATENCY = 5.0
+# Seconds after which an idle device is checked again before it is leased.
+CHECK_INTERVAL = 600
+# Seconds between the watchdog's checks of leased devices.
+WATCHDOG_INTERVAL = 120
+# Unhealthy watchdog checks in a row after which a device that still answers
+# adb is rebooted.
+WATCHDOG_STRIKES = 3
+BOOT_DEADLINE = 300
+BOOT_POLL_INTERVAL = 5
+# Recoveries in a row after which a device is retired.
+MAX_RECOVERIES = 3
+CONNECT_KWARGS = {'verbose': True, 'ignoresecuredevice': True, 'timeout': 20}
+VC_KWARGS = {'startviewserver': True, 'forceviewserveruse': True,
+             'autodump': False, 'ignoreuiautomatorkilled': True}
+
+
+def connect_view_client(serial):
+  """Returns a (device, vc) pair connected to the device with the serial."""
+  try:
+    device, _ = ViewClient.connectToDeviceOrExit(serialno=serial,
+                                                 **CONNECT_KWARGS)
+    return device, ViewClient(device, serial, **VC_KWARGS)
+  except (RuntimeError, subprocess.CalledProcessError, SystemExit):
+    print 'Error, could not connect to device ' + serial
+    return None
+
+
+def probe_adb(serial):
+  """Returns (status, seconds) of a boot_completed query over adb.
+
+  The status is ADB_UNRESPONSIVE only if the query failed, and ADB_SLOW if it
+  answered but took longer than MAX_ADB_LATENCY.
+  """
+  start = time.time()
+  try:
+    out = get_transport(serial).shell('getprop sys.boot_completed')
+  except (AdbError, socket.error):
+    return ADB_UNRESPONSIVE, time.time() - start
+  seconds = time.time() - start
+  if out.strip() != '1':
+    return NOT_BOOTED, seconds
+  if seconds > MAX_ADB_LATENCY:
+    return ADB_SLOW, seconds
+  return HEALTHY, seconds
+
+
+class PooledDevice(object):
+  """A device of the pool and the state of its health."""
+
+  def __init__(self, serial, device=None, vc=None):
+    """Constructor for PooledDevice class."""
+    self.serial = serial
+    self.device = device
+    self.vc = vc
+    self.status = None
+    self.leased = False
+    self.retired = False
+    # time.time() of the last health check.
+    self.checked_at = 0
+    # Set by the watchdog when it rebooted the device during a lease.
+    self.rebooted = False
+    # Unhealthy watchdog checks in a row.
+    self.strikes = 0
+    self.num_checks = 0
+    self.num_recycles = 0
+    self.num_reboots = 0
+    self.num_recoveries = 0
+    self.adb_seconds = 0.0
+
+  def to_dict(self):
+    return {'status': 'retired' if self.retired else self.status,
+            'recycles': self.num_recycles, 'reboots': self.num_reboots,
+            'mean_adb_ms': round(self.adb_seconds * 1000 /
+                                 max(self.num_checks, 1), 1)}
+
+
+class DevicePool(object):
+  """Leases healthy devices to crawl workers and recovers unhealthy ones."""
+
+  def __init__(self, serials, connected=None, connect=connect_view_client):
+    """Constructor for DevicePool class.
+
+    Args:
+      serials: Serial numbers of the devices in the pool.
+      connected: Optional dictionary of serial to (device, vc) for devices
+        that are already connected.
+      connect: Function that connects to a serial and returns (device, vc),
+        or None if it cannot.
+    """
+    self.connect = connect
+    self.devices = dict((serial, PooledDevice(serial)) for serial in serials)
+    for serial, (device, vc) in (connected or {}).iteritems():
+      if serial in self.devices:
+        self.devices[serial].device = device
+        self.devices[serial].vc = vc
+    self.lock = threading.Lock()
+    self.stopped = threading.Event()
+    self.watchdog = None
+
+  def start_watchdog(self):
+    self.watchdog = threading.Thread(target=self._run_watchdog,
+                                     name='watchdog')
+    self.watchdog.daemon = True
+    self.watchdog.start()
+
+  def stop(self):
+    self.stopped.set()
+    if self.watchdog:
+      self.watchdog.join()
+
+  def check(self, pooled):
+    """Checks the health of a device and returns its status."""
+    status, seconds = probe_adb(pooled.serial)
+    if status == HEALTHY:
+      try:
+        if not pooled.vc or pooled.vc.dump(window='-1') is None:
+          status = VIEW_SERVER_UNRESPONSIVE
+      except Exception:  # pylint: disable=broad-except
+        # ViewClient raises anything from socket errors to RuntimeErrors.
+        status = VIEW_SERVER_UNRESPONSIVE
+    with self.lock:
+      pooled.status = status
+      pooled.checked_at = time.time()
+      pooled.num_checks += 1
+      pooled.adb_seconds += seconds
+    if status != HEALTHY:
+      print 'Device ' + pooled.serial + ' is unhealthy: ' + status
+    return status
+
+  def _reconnect(self, pooled):
+    connection = self.connect(pooled.serial)
+    pooled.device, pooled.vc = connection or (None, None)
+    return connection is not None
+
+  def _wait_for_boot(self, serial):
+    deadline = time.time() + BOOT_DEADLINE
+    while time.time() < deadline and not self.stopped.is_set():
+      if probe_adb(serial)[0] == HEALTHY:
+        return True
+      time.sleep(BOOT_POLL_INTERVAL)
+    return False
+
+  def _reboot(self, pooled):
+    print 'Rebooting device ' + pooled.serial
+    pooled.num_reboots += 1
+    try:
+      get_transport(pooled.serial).reboot()
+    except (AdbError, socket.error) as e:
+      print 'Could not reboot ' + pooled.serial + ': ' + str(e)
+    # Connections made before the reboot are dead.
+    drop_transport(pooled.serial)
+
+  def recover(self, pooled):
+    """Recycles, then reboots, an unhealthy device. Returns if it is healthy."""
+    pooled.num_recoveries += 1
+    if pooled.num_recoveries > MAX_RECOVERIES:
+      print 'Retiring device ' + pooled.serial + ' after too many recoveries.'
+      pooled.retired = True
+      return False
+
+    if pooled.rebooted:
+      pooled.rebooted = False
+    elif pooled.status != ADB_UNRESPONSIVE:
+      print 'Recycling device ' + pooled.serial
+      pooled.num_recycles += 1
+      if (probe_adb(pooled.serial)[0] == HEALTHY and self._reconnect(pooled)
+          and self.check(pooled) == HEALTHY):
+        return True
+      self._reboot(pooled)
+    else:
+      self._reboot(pooled)
+
+    if (self._wait_for_boot(pooled.serial) and self._reconnect(pooled) and
+        self.check(pooled) == HEALTHY):
+      return True
+    print 'Could not recover device ' + pooled.serial
+    return False
+
+  def lease(self, serial):
+    """Returns the healthy PooledDevice with the serial for one crawl.
+
+    Returns None if the device cannot be recovered and is retired.
+    """
+    pooled = self.devices[serial]
+    while not pooled.retired:
+      if pooled.rebooted:
+        # Only needs to wait for the boot and reconnect.
+        pass
+      elif not pooled.vc and not self._reconnect(pooled):
+        pooled.status = VIEW_SERVER_UNRESPONSIVE
+      elif (pooled.status == HEALTHY and
+            time.time() - pooled.checked_at < CHECK_INTERVAL):
+        break
+      elif self.check(pooled) == HEALTHY:
+        break
+      if self.recover(pooled):
+        break
+    if pooled.retired:
+      return None
+    with self.lock:
+      pooled.leased = True
+      pooled.num_recoveries = 0
+      pooled.strikes = 0
+    return pooled
+
+  def release(self, pooled, failed=False):
+    """Returns a leased device. Returns whether the device is still healthy.
+
+    Args:
+      pooled: PooledDevice returned by lease().
+      failed: Whether the crawl on the device failed, in which case the
+        device is checked right away.
+    """
+    with self.lock:
+      pooled.leased = False
+      if pooled.rebooted:
+        pooled.status = NOT_BOOTED
+      elif failed:
+        # Check before the next lease.
+        pooled.checked_at = 0
+    if pooled.rebooted:
+      return False
+    return not failed or self.check(pooled) == HEALTHY
+
+  def _run_watchdog(self):
+    while not self.stopped.wait(WATCHDOG_INTERVAL):
+      with self.lock:
+        leased = [p for p in self.devices.itervalues()
+                  if p.leased and not p.rebooted]
+      for pooled in leased:
+        # The crawl is using the view server, so only adb is checked.
+        status, _ = probe_adb(pooled.serial)
+        if status == HEALTHY:
+          pooled.strikes = 0
+          continue
+        pooled.strikes += 1
+        # A slow answer may just be a busy device, so it only counts once it
+        # keeps happening.
+        if status != ADB_UNRESPONSIVE and pooled.strikes < WATCHDOG_STRIKES:
+          print ('Device ' + pooled.serial + ' is unhealthy during a crawl: ' +
+                 status + ' (' + str(pooled.strikes) + ' in a row)')
+          continue
+        print ('Device ' + pooled.serial + ' stopped responding during a '
+               'crawl: ' + status)
+        pooled.status = status
+        pooled.rebooted = True
+        self._reboot(pooled)
+
+  def to_dict(self):
+    """Returns the health of every device, for the batch summary."""
+    with self.lock:
+      return dict((serial, pooled.to_dict())
+                  for serial, pooled in self.devices.iteritems())
@@ -0,0 +1,173 @@
+# Copyright 2016 The Vanadium Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+"""A fake adb server for testing AdbTransport without a device.
+
+FakeAdbServer listens on a local port and speaks the host side of the adb
+server protocol for a single device: host:transport:<serial>, shell:, exec:,
+reboot: and the RECV, SEND, DATA, DONE and QUIT messages of sync:. The device
+has a dictionary of files, and answers shell commands from a dictionary of
+outputs, or with pm install, pm uninstall and rm -f of those files.
+"""
+
+import re
+import socket
+import struct
+import threading
+import time
+
+SERIAL_NO = 'fake-5554'
+INSTALL_RE = re.compile(r"^pm install -r '(.*)'$")
+RM_RE = re.compile(r"^rm -f '(.*)'$")
+UNINSTALL_RE = re.compile(r'^pm uninstall (.*)$')
+
+
+def recv_exactly(sock, size):
+  data = ''
+  while len(data) < size:
+    chunk = sock.recv(size - len(data))
+    if not chunk:
+      raise EOFError()
+    data += chunk
+  return data
+
+
+class FakeAdbServer(object):
+  """An adb server with one device, served from a background thread."""
+
+  def __init__(self, serialno=SERIAL_NO):
+    """Constructor for FakeAdbServer class."""
+    self.serialno = serialno
+    # Maps remote path to contents.
+    self.files = {}
+    # Maps shell or exec command to its output.
+    self.outputs = {}
+    # Maps shell or exec command to the seconds it takes.
+    self.delays = {}
+    # Output of pm install for APKs that are on the device.
+    self.install_output = 'Success\n'
+    self.installed = set()
+    # Requests received, e.g. 'shell:ls' or 'sync:RECV /path'.
+    self.requests = []
+    self.num_connections = 0
+    self.num_sync_connections = 0
+    self.lock = threading.Lock()
+    self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    self.server.bind(('127.0.0.1', 0))
+    self.server.listen(16)
+    self.port = self.server.getsockname()[1]
+    self.thread = threading.Thread(target=self._accept, name='fake adb')
+    self.thread.daemon = True
+    self.thread.start()
+
+  def close(self):
+    self.server.close()
+
+  def _accept(self):
+    while True:
+      try:
+        sock, _ = self.server.accept()
+      except socket.error:
+        return
+      with self.lock:
+        self.num_connections += 1
+      thread = threading.Thread(target=self._serve, args=(sock,))
+      thread.daemon = True
+      thread.start()
+
+  def _log(self, request):
+    with self.lock:
+      self.requests.append(request)
+
+  def _read_request(self, sock):
+    length = int(recv_exactly(sock, 4), 16)
+    return recv_exactly(sock, length)
+
+  def _fail(self, sock, message):
+    sock.sendall('FAIL%04x%s' % (len(message), message))
+
+  def _serve(self, sock):
+    try:
+      request = self._read_request(sock)
+      self._log(request)
+      if request != 'host:transport:' + self.serialno:
+        self._fail(sock, "device '%s' not found" % request.split(':')[-1])
+        return
+      sock.sendall('OKAY')
+      request = self._read_request(sock)
+      self._log(request)
+      if request.startswith('shell:') or request.startswith('exec:'):
+        sock.sendall('OKAY')
+        sock.sendall(self._run(request.split(':', 1)[1]))
+      elif request == 'sync:':
+        with self.lock:
+          self.num_sync_connections += 1
+        sock.sendall('OKAY')
+        self._serve_sync(sock)
+      elif request == 'reboot:':
+        sock.sendall('OKAY')
+      else:
+        self._fail(sock, 'unknown service ' + request)
+    except (EOFError, socket.error):
+      pass
+    finally:
+      sock.close()
+
+  def _run(self, cmd):
+    time.sleep(self.delays.get(cmd, 0))
+    if cmd in self.outputs:
+      return self.outputs[cmd]
+    match = INSTALL_RE.match(cmd)
+    if match:
+      if match.group(1) not in self.files:
+        return 'Failure [INSTALL_FAILED_INVALID_URI]\n'
+      if 'Success' in self.install_output:
+        self.installed.add(match.group(1).split('/')[-1][:-len('.apk')])
+      return self.install_output
+    match = RM_RE.match(cmd)
+    if match:
+      self.files.pop(match.group(1), None)
+      return ''
+    match = UNINSTALL_RE.match(cmd)
+    if match:
+      if match.group(1) not in self.installed:
+        return 'Failure\n'
+      self.installed.discard(match.group(1))
+      return 'Success\n'
+    return '/system/bin/sh: %s: not found\n' % cmd.split(' ')[0]
+
+  def _serve_sync(self, sock):
+    """Serves sync requests until the client quits or disconnects."""
+    while True:
+      msg_id, length = struct.unpack('<4sI', recv_exactly(sock, 8))
+      if msg_id == 'QUIT':
+        return
+      arg = recv_exactly(sock, length)
+      self._log('sync:' + msg_id + ' ' + arg)
+      if msg_id == 'RECV':
+        if arg not in self.files:
+          self._fail_sync(sock, 'No such file or directory')
+          continue
+        data = self.files[arg]
+        for i in range(0, len(data), 64 * 1024):
+          chunk = data[i:i + 64 * 1024]
+          sock.sendall('DATA' + struct.pack('<I', len(chunk)) + chunk)
+        sock.sendall('DONE' + struct.pack('<I', 0))
+      elif msg_id == 'SEND':
+        path = arg.rsplit(',', 1)[0]
+        chunks = []
+        while True:
+          msg_id, length = struct.unpack('<4sI', recv_exactly(sock, 8))
+          if msg_id == 'DONE':
+            break
+          chunks.append(recv_exactly(sock, length))
+        self.files[path] = ''.join(chunks)
+        sock.sendall('OKAY' + struct.pack('<I', 0))
+      else:
+        self._fail_sync(sock, 'unknown sync request ' + msg_id)
+        return
+
+  def _fail_sync(self, sock, message):
+    sock.sendall('FAIL' + struct.pack('<I', len(message)) + message)
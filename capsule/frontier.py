@@ -0,0 +1,93 @@
+# Copyright 2016 The Vanadium Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+"""Schedulers that pick which unexplored Layout to recrawl next.
+
+Every recrawl restarts the app and replays a path from the launch screen, so
+the choice of Layout decides how much a restart costs and how many views it
+gets to click. The scheduler is set with the frontier option of the [settings]
+config section.
+"""
+
+# Scheduler names.
+NEAREST = 'nearest'
+PRIORITY = 'priority'
+# Seconds used for operations that have not been measured yet.
+DEFAULT_STEP_SECONDS = 1.0
+DEFAULT_RESTART_SECONDS = 5.0
+# Operations of one step along a path: check the screen, dump it and click.
+STEP_OPS = ('shell:dumpsys', 'dump', 'touch')
+RESTART_OPS = ('shell:am', 'shell:monkey', 'settle:launch')
+
+
+def _mean(profiler, ops, default):
+  return sum(profiler.mean_seconds(op, default / len(ops)) for op in ops)
+
+
+def step_seconds(profiler):
+  """Returns the measured time of one step along a path."""
+  return _mean(profiler, STEP_OPS, DEFAULT_STEP_SECONDS)
+
+
+def restart_seconds(profiler):
+  """Returns the measured time to restart the app."""
+  return _mean(profiler, RESTART_OPS, DEFAULT_RESTART_SECONDS)
+
+
+class NearestFrontier(object):
+  """Picks the unexplored Layout with the shortest path from the start."""
+
+  def next_path(self, layout_graph, start, still_exploring):
+    """Returns the path to the Layout to explore next, or None."""
+    return layout_graph.nearest(start, lambda name: name in still_exploring)
+
+
+class PriorityFrontier(object):
+  """Picks the Layout with the lowest estimated cost per view to click.
+
+  Reaching a Layout costs a restart and one step per edge of the path, and
+  clicking each of its remaining views costs one more step. Step and restart
+  times are the mean latencies measured by the Profiler so far. Spreading the
+  cost over the remaining views favors Layouts with many views left to click;
+  ties go to shallower Layouts, which are less likely to be lost on the way.
+  """
+
+  def __init__(self, profiler):
+    """Constructor for PriorityFrontier class."""
+    self.profiler = profiler
+
+  def rank(self, layout_graph, start, still_exploring):
+    """Returns (cost per view, name) of reachable Layouts, best first."""
+    step = step_seconds(self.profiler)
+    restart = restart_seconds(self.profiler)
+    predecessors, order = layout_graph.bfs_tree(start)
+    hops = {}
+    ranked = []
+    for name in order:
+      predecessor = predecessors[name]
+      hops[name] = hops[predecessor] + 1 if predecessor is not None else 0
+      layout = still_exploring.get(name)
+      if layout is None:
+        continue
+      num_views = max(len(layout.clickable), 1)
+      cost = restart + (hops[name] + num_views) * step
+      ranked.append((cost / num_views, max(layout.depth, 0), hops[name], name))
+    ranked.sort()
+    return [(r[0], r[-1]) for r in ranked]
+
+  def next_path(self, layout_graph, start, still_exploring):
+    """Returns the path to the Layout to explore next, or None."""
+    ranked = self.rank(layout_graph, start, still_exploring)
+    if not ranked:
+      return None
+    return layout_graph.shortest_path(start, ranked[0][1])
+
+
+def make_frontier(name, profiler):
+  """Returns the scheduler with the given name."""
+  if name == NEAREST:
+    return NearestFrontier()
+  if name != PRIORITY:
+    print 'Unknown frontier ' + name + ', using ' + PRIORITY + '.'
+  return PriorityFrontier(profiler)
@@ -0,0 +1,261 @@
+# Copyright 2016 The Vanadium Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+"""Installs and uninstalls the packages of a batch.
+
+Installing a large APK takes tens of seconds, during which the device would
+sit idle. InstallPipeline installs the next packages a device will crawl in a
+background thread while it crawls the current one, and uninstalls crawled
+packages after their crawl. The number of packages installed ahead is bounded
+so that they do not fill up the device.
+
+The third-party packages of each device are listed once and the list is then
+kept up to date as packages are installed and uninstalled.
+"""
+
+import Queue
+import socket
+import threading
+import time
+import traceback
+
+from adbtransport import AdbError
+from adbtransport import get_transport
+
+# Packages installed ahead of the one being crawled.
+MAX_PENDING_INSTALLS = 1
+INSTALL = 'install'
+UNINSTALL = 'uninstall'
+
+
+def get_package_name(package):
+  """Returns the package name of an APK path or package name."""
+  if package.endswith('.apk'):
+    return package.split('/')[-1][:-len('.apk')]
+  return package.split('/')[-1]
+
+
+class InstalledPackages(object):
+  """Cached set of the third-party packages installed on a device."""
+
+  def __init__(self):
+    """Constructor for InstalledPackages class."""
+    self.names = None
+    self.lock = threading.Lock()
+
+  def _parse(self, out):
+    return set(line.strip()[len('package:'):] for line in out.splitlines()
+               if line.strip().startswith('package:'))
+
+  def contains(self, transport, package_name):
+    """Returns whether the package is installed on the device.
+
+    The first call lists all packages. Later calls only ask the device about
+    packages missing from the list, in case they were installed since.
+    """
+    with self.lock:
+      if self.names is None:
+        self.names = self._parse(transport.shell('pm list packages -3'))
+      elif package_name not in self.names:
+        self.names.update(self._parse(
+            transport.shell('pm list packages -3 ' + package_name)))
+      return package_name in self.names
+
+  def add(self, package_name):
+    with self.lock:
+      if self.names is not None:
+        self.names.add(package_name)
+
+  def discard(self, package_name):
+    with self.lock:
+      if self.names is not None:
+        self.names.discard(package_name)
+
+
+INSTALLED = {}
+INSTALLED_LOCK = threading.Lock()
+
+
+def get_installed(serialno):
+  """Returns the shared InstalledPackages of a device."""
+  with INSTALLED_LOCK:
+    if serialno not in INSTALLED:
+      INSTALLED[serialno] = InstalledPackages()
+    return INSTALLED[serialno]
+
+
+def install_package(transport, serialno, package):
+  """Makes sure a package is on the device. Returns whether it is.
+
+  Args:
+    transport: AdbTransport of the device.
+    serialno: Serial number of the device.
+    package: Path to an APK to install, or the name of a package that should
+      already be installed.
+  """
+  package_name = get_package_name(package)
+  installed = get_installed(serialno)
+  if package.endswith('.apk'):
+    try:
+      transport.install(package)
+    except AdbError as e:
+      print str(e)
+      return False
+    except socket.error as e:
+      # E.g. the install timed out.
+      print 'Could not install ' + package + ': ' + str(e)
+      return False
+    installed.add(package_name)
+    return True
+  if installed.contains(transport, package_name):
+    return True
+  print 'Cannot find the package on the device: ' + package_name
+  return False
+
+
+def uninstall_package(transport, serialno, package_name):
+  print 'Uninstalling ' + package_name
+  transport.uninstall(package_name)
+  get_installed(serialno).discard(package_name)
+
+
+class InstallJob(object):
+  """The install of one package submitted to an InstallPipeline."""
+
+  def __init__(self, package):
+    """Constructor for InstallJob class."""
+    self.package = package
+    self.done = threading.Event()
+    # (installed, install seconds), once done.
+    self.result = None
+    # Set when the package will not be crawled after all, so it is not
+    # installed, or is uninstalled again if it already was.
+    self.cancelled = False
+    # Whether the pipeline installed the APK, rather than finding it on the
+    # device or skipping it.
+    self.installed = False
+
+
+class InstallPipeline(object):
+  """Installs the packages a device crawls next in a background thread.
+
+  Packages are submitted in the order they will be crawled, and each crawl
+  waits for its own install. Installs and uninstalls run one at a time, in the
+  order they were requested.
+  """
+
+  def __init__(self, serialno, skip=None):
+    """Constructor for InstallPipeline class.
+
+    Args:
+      serialno: Serial number of the device.
+      skip: Optional function that returns True for packages that will not be
+        crawled, so they need not be installed.
+    """
+    self.serialno = serialno
+    self.skip = skip
+    # InstallJobs of the submitted packages that have not been taken for a
+    # crawl yet, in crawl order.
+    self.pending = []
+    # InstallJob of the package being crawled.
+    self.taken = None
+    self.tasks = Queue.Queue()
+    # Guards the cancelled and installed flags of the jobs.
+    self.lock = threading.Lock()
+    self.thread = threading.Thread(target=self._run,
+                                   name=serialno + ' installs')
+    self.thread.daemon = True
+    self.thread.start()
+
+  def submit(self, package):
+    """Starts installing a package that will be crawled after the others."""
+    job = InstallJob(package)
+    self.pending.append(job)
+    self.tasks.put((INSTALL, job))
+
+  def take(self):
+    """Returns the next package to crawl, or None."""
+    self.taken = self.pending.pop(0) if self.pending else None
+    return self.taken.package if self.taken else None
+
+  def drain(self):
+    """Returns the packages that will not be crawled here after all.
+
+    Their installs are cancelled, and those that were already installed are
+    uninstalled again.
+    """
+    with self.lock:
+      for job in self.pending:
+        job.cancelled = True
+        if job.done.is_set() and job.installed:
+          self.uninstall(get_package_name(job.package))
+    packages = [job.package for job in self.pending]
+    self.pending = []
+    return packages
+
+  def wait(self, package):
+    """Waits for the install of the package that was taken last.
+
+    Returns:
+      (installed, seconds the install took).
+    """
+    job = self.taken
+    if not job or job.package != package:
+      # The package was not submitted, so install it now.
+      return self._install(package)
+    job.done.wait()
+    return job.result
+
+  def uninstall(self, package_name):
+    """Uninstalls a crawled package after the installs requested before."""
+    self.tasks.put((UNINSTALL, package_name))
+
+  def close(self):
+    """Waits for the requested installs and uninstalls to finish."""
+    self.tasks.put(None)
+    self.thread.join()
+
+  def _install(self, package, job=None):
+    start = time.time()
+    if self.skip and self.skip(package):
+      installed = True
+    else:
+      installed = install_package(get_transport(self.serialno), self.serialno,
+                                  package)
+      if job:
+        job.installed = installed and package.endswith('.apk')
+    return installed, time.time() - start
+
+  def _uninstall(self, package_name):
+    try:
+      uninstall_package(get_transport(self.serialno), self.serialno,
+                        package_name)
+    except Exception:  # pylint: disable=broad-except
+      traceback.print_exc()
+
+  def _run(self):
+    while True:
+      task = self.tasks.get()
+      if task is None:
+        return
+      kind, arg = task
+      if kind == UNINSTALL:
+        self._uninstall(arg)
+        continue
+      if arg.cancelled:
+        arg.result = (False, 0.0)
+        arg.done.set()
+        continue
+      try:
+        arg.result = self._install(arg.package, arg)
+      except Exception:  # pylint: disable=broad-except
+        # E.g. the device went away. The crawl will fail on it as well.
+        traceback.print_exc()
+        arg.result = (False, 0.0)
+      with self.lock:
+        arg.done.set()
+        # Drained while it was being installed.
+        uninstall = arg.cancelled and arg.installed
+      if uninstall:
+        self._uninstall(get_package_name(arg.package))
@@ -7,6 +7,17 @@
 from collections import Counter
 
 
+def compute_fingerprint(activity, frag_list, hierarchy):
+  """Returns a hashable key identifying a Layout's activity, frags and views.
+
+  Two Layouts have the same fingerprint exactly when Layout.is_duplicate would
+  consider them identical, so the fingerprint can be used as a dictionary key.
+  """
+  frag_key = frozenset(Counter(frag_list or []).items())
+  view_ids = Counter(h['uniqueId'] for h in hierarchy or [])
+  return (activity, frag_key, frozenset(view_ids.items()))
+
+
 class Layout(object):
   """Base class for all layouts.
 
@@ -25,6 +36,11 @@ class Layout(object):
     self.preceding = []
     self.click_dict = {}
     self.depth = -1
+    # Computed once here since the hierarchy does not change after creation.
+    self.fingerprint = compute_fingerprint(activity, frag_list, hierarchy)
+    # MinHash signature of the hierarchy, set by the crawler when near
+    # duplicates are merged (see similarity.py).
+    self.signature = None
 
   def get_name(self):
     """Returns the identifying name of the Layout."""
@@ -45,42 +61,14 @@ class Layout(object):
 
   def is_duplicate(self, activity, frag_list, hierarchy):
     """Determines if the passed-in information is identical to this Layout."""
-
-    # Since the fragment names are hashable, this is the most efficient method
-    # to compare two unordered lists according to
-    # http://stackoverflow.com/questions/7828867/how-to-efficiently-compare-two-unordered-lists-not-sets-in-python
-    # We also use it below to compare hierarchy ids.
-    if (self.activity != activity or
-        Counter(self.frag_list) != Counter(frag_list)):
+    if self.activity != activity or self.num_views() != len(hierarchy or []):
       return False
-
-    if hierarchy:
-      if self.num_views() != len(hierarchy):
-        return False
-    else:
-      return self.num_views() == 0
-
-    hierarchy_ids = [h['uniqueId'] for h in self.hierarchy]
-    layout_ids = [h['uniqueId'] for h in hierarchy]
-
-    return Counter(hierarchy_ids) == Counter(layout_ids)
+    return self.fingerprint == compute_fingerprint(activity, frag_list,
+                                                   hierarchy)
 
   def is_duplicate_layout(self, other_layout):
     """Determines if the passed-in Layout is identical to this Layout."""
-    if (self.activity != other_layout.activity or
-        Counter(self.frag_list) != Counter(other_layout.frag_list)):
-      return False
-
-    if other_layout.hierarchy:
-      if self.num_views() != len(other_layout.hierarchy):
-        return False
-    else:
-      return self.num_views() == 0
-
-    hierarchy_ids = [h['uniqueId'] for h in self.hierarchy]
-    other_layout_ids = [ov['uniqueId'] for ov in other_layout.hierarchy]
-
-    return Counter(hierarchy_ids) == Counter(other_layout_ids)
+    return self.fingerprint == other_layout.fingerprint
 
   def print_info(self):
     """Prints out information about the layout."""
@@ -91,3 +79,68 @@ class Layout(object):
     print 'Hierarchy: '
     for view in self.hierarchy:
       print view.getUniqueId()
+
+
+class LayoutMap(dict):
+  """Dictionary of Layouts by name that is also indexed by fingerprint.
+
+  Looking up a view hierarchy is O(1) instead of comparing it against every
+  stored Layout. Every method that changes the dictionary keeps the index up
+  to date.
+  """
+
+  def __init__(self, *args, **kwargs):
+    """Constructor for LayoutMap class."""
+    super(LayoutMap, self).__init__()
+    # Maps fingerprint to the stored Layouts that have it, oldest first.
+    self.fingerprints = {}
+    self.update(*args, **kwargs)
+
+  def __setitem__(self, name, layout):
+    if name in self:
+      self._unindex(self[name])
+    super(LayoutMap, self).__setitem__(name, layout)
+    self.fingerprints.setdefault(layout.fingerprint, []).append(layout)
+
+  def __delitem__(self, name):
+    self._unindex(self[name])
+    super(LayoutMap, self).__delitem__(name)
+
+  def pop(self, name, *default):
+    if name in self:
+      self._unindex(self[name])
+    return super(LayoutMap, self).pop(name, *default)
+
+  def popitem(self):
+    name, layout = super(LayoutMap, self).popitem()
+    self._unindex(layout)
+    return name, layout
+
+  def setdefault(self, name, layout=None):
+    if name not in self:
+      self[name] = layout
+    return self[name]
+
+  def clear(self):
+    super(LayoutMap, self).clear()
+    self.fingerprints.clear()
+
+  def update(self, *args, **kwargs):
+    for name, layout in dict(*args, **kwargs).iteritems():
+      self[name] = layout
+
+  def _unindex(self, layout):
+    layouts = self.fingerprints.get(layout.fingerprint, [])
+    for i, indexed in enumerate(layouts):
+      if indexed is layout:
+        del layouts[i]
+        break
+    # Other Layouts with the same fingerprint can still be found.
+    if not layouts:
+      self.fingerprints.pop(layout.fingerprint, None)
+
+  def find(self, activity, frag_list, hierarchy):
+    """Returns the stored Layout matching the given info, or None."""
+    layouts = self.fingerprints.get(compute_fingerprint(activity, frag_list,
+                                                        hierarchy))
+    return layouts[0] if layouts else None
@@ -0,0 +1,107 @@
+# Copyright 2016 The Vanadium Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+"""LayoutGraph class definition."""
+
+from collections import deque
+
+
+class LayoutGraph(object):
+  """Directed graph of the transitions between Layouts, by Layout name.
+
+  Shortest paths are found with a breadth-first search that records the
+  predecessor of each node instead of copying paths. The search tree from a
+  start node is cached until an edge is added or removed, so planning several
+  routes from the launch screen costs a single search.
+  """
+
+  def __init__(self):
+    """Constructor for LayoutGraph class."""
+    # Maps Layout name to the set of names of Layouts it leads to.
+    self.edges = {}
+    # Maps start node to (predecessor map, nodes in BFS order).
+    self.trees = {}
+
+  def __contains__(self, node):
+    return node in self.edges
+
+  def __len__(self):
+    return len(self.edges)
+
+  def neighbors(self, node):
+    return self.edges.get(node, ())
+
+  def add_edge(self, start, end):
+    """Adds an edge. Returns True if it was not already in the graph."""
+    ends = self.edges.setdefault(start, set())
+    if end in ends:
+      return False
+    ends.add(end)
+    self.trees.clear()
+    return True
+
+  def remove_edge(self, start, end):
+    """Removes an edge. Raises KeyError if it is not in the graph."""
+    self.edges[start].remove(end)
+    self.trees.clear()
+
+  def _search(self, start, avoid=()):
+    """Breadth-first search from start that never enters the avoided nodes."""
+    predecessors = {start: None}
+    order = [start]
+    visited = set(avoid)
+    visited.add(start)
+    queue = deque([start])
+    while queue:
+      node = queue.popleft()
+      for adjacent in self.edges.get(node, ()):
+        if adjacent not in visited:
+          visited.add(adjacent)
+          predecessors[adjacent] = node
+          order.append(adjacent)
+          queue.append(adjacent)
+    return predecessors, order
+
+  def bfs_tree(self, start):
+    """Returns the (cached) predecessor map and BFS order from start."""
+    if start not in self.trees:
+      self.trees[start] = self._search(start)
+    return self.trees[start]
+
+  def _path_to(self, predecessors, end):
+    if end not in predecessors:
+      return None
+    path = []
+    while end is not None:
+      path.append(end)
+      end = predecessors[end]
+    path.reverse()
+    return path
+
+  def shortest_path(self, start, end, avoid=()):
+    """Returns the shortest list of nodes from start to end, or None.
+
+    Args:
+      start: Name of the first Layout.
+      end: Name of the Layout to reach.
+      avoid: Nodes the path cannot go through. Searches that avoid nodes are
+        not cached.
+    """
+    if avoid:
+      predecessors, _ = self._search(start, avoid)
+    else:
+      predecessors, _ = self.bfs_tree(start)
+    return self._path_to(predecessors, end)
+
+  def nearest(self, start, is_target):
+    """Returns the path to the closest node for which is_target is true.
+
+    The start node itself is considered first. Returns None if no reachable
+    node is a target.
+    """
+    predecessors, order = self.bfs_tree(start)
+    for node in order:
+      if is_target(node):
+        return self._path_to(predecessors, node)
+    return None
@@ -0,0 +1,65 @@
+# Copyright 2016 The Vanadium Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+"""NavigationPlanner class definition."""
+
+from frontier import restart_seconds
+from frontier import step_seconds
+
+
+class NavigationPlanner(object):
+  """Decides whether to reach the next Layout to explore without a restart.
+
+  Restarting the app and replaying a path from the launch screen works from
+  anywhere, but a relaunch is slow. When the crawler is still in the app, the
+  planner looks for a path from the current Layout that uses back button and
+  click transitions, and takes it if it is estimated to be cheaper than the
+  restart and replay.
+  """
+
+  def __init__(self, frontier, profiler):
+    """Constructor for NavigationPlanner class.
+
+    Args:
+      frontier: Scheduler that picks the Layout to explore after a restart.
+      profiler: Profiler with the measured latencies of the crawl.
+    """
+    self.frontier = frontier
+    self.profiler = profiler
+
+  def plan(self, layout_graph, graph, curr_name, launch_name,
+           still_exploring):
+    """Returns a path from curr_name that avoids a restart, or None.
+
+    Args:
+      layout_graph: LayoutGraph of click transitions.
+      graph: LayoutGraph of click and back button transitions. It is kept up
+        to date by the crawler instead of being rebuilt for every plan, so
+        its BFS trees are cached between plans.
+      curr_name: Name of the Layout on screen.
+      launch_name: Name of the Layout the app launches into.
+      still_exploring: Dictionary of the Layouts that have views left to
+        click.
+    """
+    if curr_name not in graph:
+      # Nothing was seen to lead anywhere from it.
+      return None
+    step = step_seconds(self.profiler)
+    restart_path = self.frontier.next_path(layout_graph, launch_name,
+                                           still_exploring)
+    if restart_path:
+      restart_cost = (restart_seconds(self.profiler) +
+                      (len(restart_path) - 1) * step)
+    else:
+      restart_cost = float('inf')
+
+    # Either go to the Layout the frontier would pick after a restart, or to
+    # the closest Layout that has views left to click.
+    paths = [graph.nearest(curr_name, lambda name: name in still_exploring)]
+    if restart_path:
+      paths.append(graph.shortest_path(curr_name, restart_path[-1]))
+    paths = [p for p in paths if p and (len(p) - 1) * step < restart_cost]
+    if not paths:
+      return None
+    return min(paths, key=len)
@@ -0,0 +1,237 @@
+# Copyright 2016 The Vanadium Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+"""Latency instrumentation for the device operations of a crawl.
+
+A Profiler counts every timed operation and keeps a latency histogram for it,
+separately for each phase of the crawl. Recording an operation only costs a
+dictionary lookup and a bisect, so profiling is always on.
+
+Operations can nest: a settle wait is recorded as one operation, and the shell
+commands and dumps it makes are recorded as well.
+"""
+
+from bisect import bisect_left
+from contextlib import contextmanager
+import json
+import time
+
+PROFILE_FILE = 'profile.json'
+BATCH_PROFILE_FILE = 'batch-profile.json'
+# Phases of a crawl.
+SETUP = 'setup'
+INITIAL_CRAWL = 'initial crawl'
+RECRAWL = 'recrawl'
+PATH_FOLLOWING = 'path following'
+LOGIN = 'login'
+# Upper bounds of the histogram buckets, in milliseconds. The last bucket holds
+# everything slower.
+BUCKET_BOUNDS_MS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000,
+                    10000)
+# Methods whose first argument is a command. The operation is named after the
+# method and the first word of the command, such as shell:dumpsys.
+COMMAND_METHODS = ('shell', 'exec_out')
+PERCENTILES = (50, 90, 99)
+
+
+def _new_stats():
+  # [count, total seconds, max seconds, histogram]
+  return [0, 0.0, 0.0, [0] * (len(BUCKET_BOUNDS_MS) + 1)]
+
+
+def _percentile(histogram, count, percentile):
+  """Returns the upper bound in ms of the bucket holding the percentile."""
+  rank = count * percentile / 100.0
+  seen = 0
+  for i, num in enumerate(histogram):
+    seen += num
+    if seen >= rank and num:
+      return BUCKET_BOUNDS_MS[i] if i < len(BUCKET_BOUNDS_MS) else None
+  return None
+
+
+def _stats_to_dict(stats):
+  count, total, longest, histogram = stats
+  info = {'count': count, 'total_s': round(total, 3),
+          'max_ms': round(longest * 1000, 1),
+          'mean_ms': round(total * 1000 / count, 1) if count else 0,
+          'histogram': histogram}
+  for percentile in PERCENTILES:
+    info['p' + str(percentile) + '_ms'] = _percentile(histogram, count,
+                                                      percentile)
+  return info
+
+
+def _stats_from_dict(info):
+  return [info['count'], info['total_s'], info['max_ms'] / 1000.0,
+          list(info['histogram'])]
+
+
+def _add_stats(stats, other):
+  stats[0] += other[0]
+  stats[1] += other[1]
+  stats[2] = max(stats[2], other[2])
+  stats[3] = [a + b for a, b in zip(stats[3], other[3])]
+
+
+class Profiler(object):
+  """Per-operation counters and latency histograms of one package's crawl."""
+
+  def __init__(self, package_name=None):
+    """Constructor for Profiler class."""
+    self.package_name = package_name
+    self.start = time.time()
+    # Stack of the phases being profiled. Operations are tagged with the top.
+    self.phases = [SETUP]
+    # Maps phase to a dictionary of operation name to stats.
+    self.stats = {}
+    # Maps name to the number of events that are counted but not timed.
+    self.counters = {}
+
+  @contextmanager
+  def phase(self, name):
+    """Tags the operations recorded inside the block with a phase."""
+    self.phases.append(name)
+    try:
+      yield
+    finally:
+      self.phases.pop()
+
+  def record(self, op, seconds):
+    """Records one operation that took the given number of seconds."""
+    ops = self.stats.setdefault(self.phases[-1], {})
+    stats = ops.get(op)
+    if not stats:
+      stats = ops[op] = _new_stats()
+    stats[0] += 1
+    stats[1] += seconds
+    if seconds > stats[2]:
+      stats[2] = seconds
+    stats[3][bisect_left(BUCKET_BOUNDS_MS, seconds * 1000)] += 1
+
+  def mean_seconds(self, op, default):
+    """Returns the mean latency of an operation over all phases."""
+    count = total = 0
+    for ops in self.stats.itervalues():
+      stats = ops.get(op)
+      if stats:
+        count += stats[0]
+        total += stats[1]
+    return total / count if count else default
+
+  def count(self, name, num=1):
+    self.counters[name] = self.counters.get(name, 0) + num
+
+  @contextmanager
+  def timed(self, op):
+    """Records the time taken by the block as one operation."""
+    start = time.time()
+    try:
+      yield
+    finally:
+      self.record(op, time.time() - start)
+
+  def to_dict(self):
+    """Returns the profile in the form that is saved as JSON."""
+    totals = {}
+    for ops in self.stats.itervalues():
+      for op, stats in ops.iteritems():
+        _add_stats(totals.setdefault(op, _new_stats()), stats)
+    return {
+        'packages': [self.package_name] if self.package_name else [],
+        'wall_s': round(time.time() - self.start, 3),
+        'bucket_bounds_ms': list(BUCKET_BOUNDS_MS),
+        'phases': dict((phase, dict((op, _stats_to_dict(stats))
+                                    for op, stats in ops.iteritems()))
+                       for phase, ops in self.stats.iteritems()),
+        'ops': dict((op, _stats_to_dict(stats))
+                    for op, stats in totals.iteritems()),
+        'counters': dict(self.counters),
+    }
+
+  def save(self, path):
+    save_profile(self.to_dict(), path)
+
+
+def aggregate(profiles):
+  """Sums the dictionaries of several profiles into one.
+
+  The wall time of the result is the sum of the crawl times, which is more than
+  the elapsed time when devices crawl in parallel.
+  """
+  total = Profiler()
+  packages = []
+  wall = 0.0
+  for profile in profiles:
+    packages.extend(profile['packages'])
+    wall += profile['wall_s']
+    for phase, phase_ops in profile['phases'].iteritems():
+      for op, info in phase_ops.iteritems():
+        _add_stats(total.stats.setdefault(phase, {}).setdefault(
+            op, _new_stats()), _stats_from_dict(info))
+    for name, num in profile.get('counters', {}).iteritems():
+      total.count(name, num)
+  result = total.to_dict()
+  result['packages'] = packages
+  result['wall_s'] = round(wall, 3)
+  return result
+
+
+def save_profile(profile, path):
+  with open(path, 'w') as out_file:
+    json.dump(profile, out_file, indent=2, sort_keys=True)
+
+
+def print_profile(profile, num_ops=10):
+  """Prints the operations that took the most time in total."""
+  ops = sorted(profile['ops'].iteritems(), key=lambda item: -item[1]['total_s'])
+  print 'Slowest operations over {:.1f}s:'.format(profile['wall_s'])
+  for op, info in ops[:num_ops]:
+    print '  {}: {} calls, {:.1f}s total, {} ms mean, {} ms max'.format(
+        op, info['count'], info['total_s'], info['mean_ms'], info['max_ms'])
+
+
+class Instrumented(object):
+  """Forwards to an object and times the calls to some of its methods."""
+
+  def __init__(self, target, profiler, methods):
+    """Constructor for Instrumented class.
+
+    Args:
+      target: Object to forward to, such as the AndroidViewClient device.
+      profiler: Profiler to record the calls in.
+      methods: Names of the methods to time.
+    """
+    self.target = target
+    self.profiler = profiler
+    self.methods = methods
+
+  def __getattr__(self, name):
+    attr = getattr(self.target, name)
+    if name not in self.methods:
+      return attr
+
+    def timed(*args, **kwargs):
+      op = name
+      if name in COMMAND_METHODS and args and isinstance(args[0], basestring):
+        op += ':' + args[0].split(' ', 1)[0]
+      start = time.time()
+      try:
+        return attr(*args, **kwargs)
+      finally:
+        self.profiler.record(op, time.time() - start)
+
+    return timed
+
+
+def instrument(obj, profiler, methods):
+  """Returns obj wrapped so that calls to methods are recorded in profiler.
+
+  Objects that are already instrumented for the profiler are returned as is.
+  """
+  if isinstance(obj, Instrumented):
+    if obj.profiler is profiler:
+      return obj
+    obj = obj.target
+  return Instrumented(obj, profiler, methods)
@@ -0,0 +1,161 @@
+# Copyright 2016 The Vanadium Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+"""Rule tables for text entry and social network login detection.
+
+A rule table is an ordered list of (name, regular expression) pairs, read from
+a config section where each option is a rule. Continuation lines of an option
+are alternatives of the same rule. The first rule that matches wins, and
+matching is case insensitive.
+
+All of the rules of a table are compiled into a single regular expression, so
+a view is matched against the whole table in one pass. Text fields are matched
+by their unique id. Views that may be social network logins are matched as the
+three lines class:CLASS, id:UNIQUE_ID and text:TEXT, so rules can anchor on a
+line with ^ and $.
+"""
+
+from collections import OrderedDict
+import re
+
+# Login rule names, which pick the login flow of the crawler.
+FACEBOOK = 'facebook'
+GOOGLE = 'google'
+# Used when the [text_rules] section of the config is missing. Names are
+# options of the [basic_info] section.
+DEFAULT_TEXT_RULES = OrderedDict([
+    ('last_name', r'(last|sur).*name|name.*(last|sur)'),
+    ('username', r'user.*name|name.*user'),
+    ('first_name', r'name'),
+    ('email', r'mail|address'),
+    ('password', r'password|pw'),
+    ('zipcode', r'zip'),
+    ('phone_num', r'phone'),
+])
+# Used when the [login_rules] section of the config is missing.
+DEFAULT_LOGIN_RULES = OrderedDict([
+    (FACEBOOK, '\n'.join([
+        r'^class:com\.facebook\.widget\.LoginButton$',
+        r'^(id|text):.*facebook',
+        r'^id:.*fb.*(login|log_in|signin|sign_in)',
+        r'^id:.*(login|log_in|signin|sign_in).*fb'])),
+    (GOOGLE, '\n'.join([
+        r'^class:com\.google\.android\.gms\.common\.SignInButton$',
+        r'^(id|text):.*(google|gplus)',
+        r'^id:(.*/)?sign_in_button$'])),
+])
+# basic_info option typed into fields that no rule matches.
+DEFAULT_TEXT = 'default'
+
+
+def parse_rules(section, defaults):
+  """Returns the (name, pattern) rules of a config section, in order."""
+  rules = []
+  for name, value in (section or defaults).iteritems():
+    alternatives = [line.strip() for line in value.split('\n') if line.strip()]
+    pattern = '|'.join('(?:' + a + ')' for a in alternatives)
+    try:
+      re.compile(pattern)
+    except re.error as e:
+      print 'Skipping rule ' + name + ': ' + str(e)
+      continue
+    if pattern:
+      rules.append((name, pattern))
+  return rules
+
+
+class RuleMatcher(object):
+  """Matches a string against an ordered rule table in a single pass."""
+
+  def __init__(self, rules):
+    """Constructor for RuleMatcher class.
+
+    Args:
+      rules: List of (name, pattern) pairs. Earlier rules take precedence.
+    """
+    self.names = [name for name, _ in rules]
+    # Each alternative may skip any prefix of the string before its rule
+    # matches, and alternatives are tried in order, so the first rule that
+    # matches anywhere wins rather than the one that matches first.
+    self.regex = re.compile(
+        '^(?:' + '|'.join(r'[\s\S]*?(?P<r' + str(i) + '>' + pattern + ')'
+                          for i, (_, pattern) in enumerate(rules)) + ')',
+        re.IGNORECASE | re.MULTILINE) if rules else None
+
+  def match(self, subject):
+    """Returns the name of the first rule that matches subject, or None."""
+    if not self.regex:
+      return None
+    m = self.regex.match(subject)
+    if not m:
+      return None
+    for i, name in enumerate(self.names):
+      if m.group('r' + str(i)) is not None:
+        return name
+    return None
+
+
+class TextRules(object):
+  """Picks the text to type into a text field from its unique id.
+
+  The [text_rules] config section maps options of [basic_info] to patterns.
+  Options of the [extra] section match the fields whose id contains them, after
+  all of the [text_rules].
+  """
+
+  def __init__(self, config_data):
+    """Constructor for TextRules class."""
+    self.basic_info = config_data.get('basic_info') or {}
+    self.extra = config_data.get('extra') or {}
+    rules = parse_rules(config_data.get('text_rules'), DEFAULT_TEXT_RULES)
+    rules.extend((name, re.escape(name)) for name in self.extra)
+    self.matcher = RuleMatcher(rules)
+    # Maps unique id of a text field to the name of the rule it matched.
+    self.cache = {}
+
+  def text_for(self, field_id):
+    """Returns (rule name, text) to type into the field with the given id."""
+    name = self.cache.get(field_id)
+    if name is None:
+      name = self.cache[field_id] = (self.matcher.match(field_id) or
+                                     DEFAULT_TEXT)
+    if name in self.basic_info:
+      return name, self.basic_info[name]
+    # Fields removed from the config are left empty.
+    return name, self.extra.get(name, '')
+
+
+def _login_subject(view):
+  return u'class:{}\nid:{}\ntext:{}'.format(view.getClass() or '',
+                                            view.getUniqueId() or '',
+                                            view.getText() or '')
+
+
+class LoginRules(object):
+  """Finds the views of a Layout that log into a social network."""
+
+  def __init__(self, section=None):
+    """Constructor for LoginRules class.
+
+    Args:
+      section: Dictionary of the [login_rules] config section.
+    """
+    self.matcher = RuleMatcher(parse_rules(section, DEFAULT_LOGIN_RULES))
+    # Maps Layout fingerprint to a dictionary of unique id to rule name of its
+    # login views.
+    self.cache = {}
+
+  def login_views(self, layout):
+    """Returns (view, rule name) of the clickable login views of a Layout."""
+    logins = self.cache.get(layout.fingerprint)
+    if logins is None:
+      logins = self.cache[layout.fingerprint] = {}
+      for view in layout.clickable:
+        name = self.matcher.match(_login_subject(view))
+        if name:
+          logins[view.getUniqueId()] = name
+    if not logins:
+      return []
+    return [(view, logins[view.getUniqueId()]) for view in layout.clickable
+            if view.getUniqueId() in logins]
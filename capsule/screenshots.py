@@ -0,0 +1,185 @@
+# Copyright 2016 The Vanadium Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+"""ScreenshotWriter class definition."""
+
+from cStringIO import StringIO
+import os
+import Queue
+import struct
+import threading
+import traceback
+import zlib
+
+from adbtransport import AdbError
+
+try:
+  from PIL import Image
+except ImportError:
+  Image = None
+
+# Fidelity tiers, set with the fidelity option of the [screenshots] config.
+# Full resolution PNG, as encoded by the device.
+PNG = 'png'
+# Downscaled lossy images, encoded on the host. These require PIL.
+JPEG = 'jpeg'
+WEBP = 'webp'
+# The raw framebuffer is saved during the crawl and only encoded as PNG once
+# the crawl of the package is finished.
+DEFERRED = 'deferred'
+EXTENSIONS = {PNG: '.png', JPEG: '.jpg', WEBP: '.webp', DEFERRED: '.png'}
+RAW_EXTENSION = '.raw'
+
+DEFAULT_SETTINGS = {'fidelity': PNG, 'scale': 0.5, 'quality': 80}
+# Maximum number of screenshots waiting to be written before capture blocks.
+MAX_PENDING = 16
+# The raw output of screencap starts with width, height and pixel format. Since
+# Android O it is followed by the color space.
+RAW_HEADER_SIZES = (12, 16)
+BYTES_PER_PIXEL = 4
+
+
+def encode_png(width, height, rgba):
+  """Encodes RGBA pixels as a PNG without needing PIL."""
+
+  def chunk(chunk_type, data):
+    return (struct.pack('>I', len(data)) + chunk_type + data +
+            struct.pack('>I', zlib.crc32(chunk_type + data) & 0xffffffff))
+
+  stride = width * BYTES_PER_PIXEL
+  # Each row starts with the filter type, which is 0 (none).
+  rows = ''.join('\x00' + rgba[y * stride:(y + 1) * stride]
+                 for y in range(height))
+  return ('\x89PNG\r\n\x1a\n' +
+          chunk('IHDR', struct.pack('>IIBBBBB', width, height, 8, 6, 0, 0, 0)) +
+          chunk('IDAT', zlib.compress(rows, 6)) +
+          chunk('IEND', ''))
+
+
+def raw_to_png(raw):
+  """Converts the raw output of screencap to a PNG."""
+  width, height = struct.unpack('<II', raw[:8])
+  header_size = len(raw) - width * height * BYTES_PER_PIXEL
+  if header_size not in RAW_HEADER_SIZES:
+    raise ValueError('Unexpected raw screenshot size.')
+  return encode_png(width, height, raw[header_size:])
+
+
+def can_save(fidelity):
+  """Returns whether PIL has an encoder for the format of a fidelity."""
+  Image.init()
+  return fidelity.upper() in Image.SAVE
+
+
+class ScreenshotWriter(object):
+  """Captures screenshots into memory and writes them in the background.
+
+  Screenshots are streamed from the device with exec-out, so nothing is
+  written to the device's storage, and the crawler can keep going while a
+  background thread encodes and writes them to disk.
+  """
+
+  def __init__(self, settings=None):
+    """Constructor for ScreenshotWriter class.
+
+    Args:
+      settings: Dictionary of the [screenshots] config section.
+    """
+    settings = dict(DEFAULT_SETTINGS, **(settings or {}))
+    self.fidelity = settings['fidelity'].lower()
+    if self.fidelity not in EXTENSIONS:
+      print 'Unknown screenshot fidelity ' + self.fidelity + ', using png.'
+      self.fidelity = PNG
+    if self.fidelity in (JPEG, WEBP) and not Image:
+      print 'PIL is needed to downscale screenshots, using png.'
+      self.fidelity = PNG
+    if self.fidelity in (JPEG, WEBP) and not can_save(self.fidelity):
+      print ('This PIL cannot save ' + self.fidelity + ' screenshots, using '
+             'png.')
+      self.fidelity = PNG
+    self.scale = float(settings['scale'])
+    self.quality = int(settings['quality'])
+    self.queue = Queue.Queue(MAX_PENDING)
+    self.thread = None
+    # Raw screenshots that still have to be encoded.
+    self.deferred = []
+
+  def capture(self, transport, base_path):
+    """Takes a screenshot and queues it to be saved.
+
+    Args:
+      transport: AdbTransport of the device.
+      base_path: Path of the screenshot without the file extension.
+
+    Returns:
+      The path the screenshot will be saved to.
+    """
+    path = base_path + EXTENSIONS[self.fidelity]
+    try:
+      if self.fidelity == DEFERRED:
+        data = transport.exec_out('screencap')
+        raw_path = base_path + RAW_EXTENSION
+        self.deferred.append((raw_path, path))
+        self._queue_write(raw_path, data)
+      else:
+        self._queue_write(path, transport.exec_out('screencap -p'))
+    except AdbError as e:
+      print '*** Could not take screenshot: ' + str(e)
+    return path
+
+  def _queue_write(self, path, data):
+    if not self.thread:
+      self.thread = threading.Thread(target=self._run)
+      self.thread.daemon = True
+      self.thread.start()
+    self.queue.put((path, data))
+
+  def _run(self):
+    while True:
+      item = self.queue.get()
+      if item is None:
+        return
+      path, data = item
+      try:
+        self._write(path, data)
+      except (IOError, ValueError) as e:
+        print '*** Could not save screenshot ' + path + ': ' + str(e)
+      except Exception:  # pylint: disable=broad-except
+        # The thread must keep draining the queue, or capture() and finish()
+        # block forever. The PNG from the device is saved as it is instead.
+        traceback.print_exc()
+        try:
+          with open(path, 'wb') as out_file:
+            out_file.write(data)
+        except IOError as e:
+          print '*** Could not save screenshot ' + path + ': ' + str(e)
+
+  def _write(self, path, data):
+    if self.fidelity in (JPEG, WEBP):
+      image = Image.open(StringIO(data)).convert('RGB')
+      if self.scale != 1:
+        image = image.resize((int(image.size[0] * self.scale),
+                              int(image.size[1] * self.scale)),
+                             Image.ANTIALIAS)
+      image.save(path, self.fidelity.upper(), quality=self.quality)
+    else:
+      with open(path, 'wb') as out_file:
+        out_file.write(data)
+
+  def finish(self):
+    """Waits for all screenshots to be written and encodes deferred ones."""
+    if self.thread:
+      self.queue.put(None)
+      self.thread.join()
+      self.thread = None
+    for raw_path, path in self.deferred:
+      try:
+        with open(raw_path, 'rb') as raw_file:
+          png = raw_to_png(raw_file.read())
+        with open(path, 'wb') as out_file:
+          out_file.write(png)
+        os.remove(raw_path)
+      except (IOError, ValueError) as e:
+        print '*** Could not encode screenshot ' + raw_path + ': ' + str(e)
+    self.deferred = []
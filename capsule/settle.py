@@ -0,0 +1,105 @@
+# Copyright 2016 The Vanadium Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+"""SettleWaiter class definition."""
+
+import time
+
+# Defaults used when the [settle] section of the config is missing a value.
+# All times are in seconds.
+DEFAULT_SETTINGS = {
+    'initial_delay': 0.25,
+    'max_delay': 2.0,
+    'backoff': 2.0,
+    'deadline': 5.0,
+    'launch_deadline': 10.0,
+}
+
+
+class SettleWaiter(object):
+  """Waits until the UI of the device stops changing.
+
+  Instead of sleeping for a fixed time after an action, the waiter polls the
+  focused window (and the view hierarchy if a ViewClient is given) with
+  exponential backoff. The UI is considered settled once two consecutive polls
+  return the same state. If the UI keeps changing, the wait gives up at the
+  deadline. The wall time of every wait is recorded per label.
+  """
+
+  def __init__(self, settings=None):
+    """Constructor for SettleWaiter class.
+
+    Args:
+      settings: Dictionary of the [settle] config section. Values can be
+        strings as read by ConfigParser.
+    """
+    self.settings = dict(DEFAULT_SETTINGS)
+    for name, value in (settings or {}).iteritems():
+      if name in DEFAULT_SETTINGS:
+        self.settings[name] = float(value)
+    # Maps label to [number of waits, total time, max time, number of timeouts].
+    self.stats = {}
+
+  def wait(self, snapshot, vc=None, label='settle', deadline=None):
+    """Blocks until the UI is settled or the deadline passes.
+
+    Args:
+      snapshot: DeviceSnapshot of the device, used to read the focused window.
+      vc: ViewClient. If given, the view hierarchy must also be stable.
+      label: Name under which the wait time is recorded.
+      deadline: Maximum seconds to wait. Defaults to the configured deadline.
+
+    Returns:
+      True if the UI settled before the deadline.
+    """
+    if deadline is None:
+      deadline = self.settings['deadline']
+    start = time.time()
+    delay = self.settings['initial_delay']
+    prev_focus = None
+    prev_hierarchy = None
+    settled = False
+
+    while True:
+      time.sleep(delay)
+      snapshot.refresh()
+      focus = snapshot.focus
+      if focus and focus == prev_focus:
+        if not vc:
+          settled = True
+          break
+        hierarchy = self._hierarchy_signature(vc)
+        if hierarchy is not None and hierarchy == prev_hierarchy:
+          settled = True
+          break
+        prev_hierarchy = hierarchy
+      prev_focus = focus
+
+      delay = min(delay * self.settings['backoff'], self.settings['max_delay'])
+      if time.time() - start + delay > deadline:
+        break
+
+    self._record(label, time.time() - start, settled)
+    return settled
+
+  def _hierarchy_signature(self, vc):
+    try:
+      return tuple(v.getUniqueId() for v in vc.dump(window='-1'))
+    except IOError:
+      return None
+
+  def _record(self, label, elapsed, settled):
+    stat = self.stats.setdefault(label, [0, 0.0, 0.0, 0])
+    stat[0] += 1
+    stat[1] += elapsed
+    stat[2] = max(stat[2], elapsed)
+    if not settled:
+      stat[3] += 1
+
+  def print_stats(self):
+    """Prints how much wall time the waits took for each label."""
+    for label, (num, total, longest, timeouts) in sorted(
+        self.stats.iteritems()):
+      print ('Settle {}: {} waits, {:.2f}s total, {:.2f}s max, {} timed '
+             'out'.format(label, num, total, longest, timeouts))
@@ -0,0 +1,221 @@
+# Copyright 2016 The Vanadium Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+"""Near-duplicate detection of view hierarchies.
+
+Layout.is_duplicate needs the exact same views, so a feed or list that changes
+a single row looks like a new Layout. Here each hierarchy gets a MinHash
+signature of its structure: the class and id of every view, the classes of
+every parent and child, and the class of the views at each depth. The fraction
+of equal signature values estimates the Jaccard similarity of two hierarchies.
+
+SimilarityIndex splits signatures into bands (locality-sensitive hashing), so
+a lookup only compares the hierarchies that share a band instead of all of
+them.
+
+Usage:
+python similarity.py /PATH/TO/data/PACKAGE/ [THRESHOLD]
+Reports which Layouts of a crawl would have been merged, and the storage and
+crawl time that would have saved.
+"""
+
+from collections import Counter
+import json
+import os
+import random
+import re
+import sys
+import zlib
+
+import compacthierarchy
+from profiler import PROFILE_FILE
+
+NUM_HASHES = 64
+NUM_BANDS = 16
+ROWS_PER_BAND = NUM_HASHES / NUM_BANDS
+DEFAULT_THRESHOLD = 0.9
+# Mersenne prime for the universal hash functions that stand in for random
+# permutations.
+PRIME = (1 << 61) - 1
+_RAND = random.Random(0)
+PERMUTATIONS = [(_RAND.randint(1, PRIME - 1), _RAND.randint(0, PRIME - 1))
+                for _ in range(NUM_HASHES)]
+# Views without an id get an index as id, which changes when rows move.
+NO_ID = re.compile(r'id/no_id/\d+')
+
+
+def _tokens(class_name, unique_id, parent_class, depth):
+  unique_id = NO_ID.sub('id/no_id', unique_id or '')
+  return ('v:' + class_name + '#' + unique_id,
+          'e:' + parent_class + '>' + class_name,
+          'd:' + str(depth) + ':' + class_name)
+
+
+def minhash(tokens):
+  """Returns the MinHash signature of a set of strings."""
+  hashes = set(zlib.crc32(t.encode('utf-8') if isinstance(t, unicode) else t)
+               & 0xffffffff for t in tokens)
+  if not hashes:
+    return ()
+  return tuple(min((a * h + b) % PRIME for h in hashes)
+               for a, b in PERMUTATIONS)
+
+
+def dump_signature(vc_dump):
+  """Returns the signature of the views of a ViewClient dump."""
+  # Maps id of a view to its depth. Parents come before their children.
+  depths = {}
+  tokens = set()
+  for view in vc_dump:
+    parent = getattr(view, 'parent', None)
+    depth = depths.get(id(parent), -1) + 1 if parent else 0
+    depths[id(view)] = depth
+    tokens.update(_tokens(view.getClass() or '', view.getUniqueId(),
+                          parent.getClass() or '' if parent else '', depth))
+  return minhash(tokens)
+
+
+def hierarchy_signature(hierarchy):
+  """Returns the signature of a hierarchy saved by the crawler."""
+
+  def class_of(unique_id):
+    return hierarchy[unique_id].get('map', {}).get('class', '')
+
+  tokens = set()
+  for unique_id, view in hierarchy.iteritems():
+    depth = 0
+    parent = view.get('parent')
+    while parent in hierarchy and depth < len(hierarchy):
+      depth += 1
+      parent = hierarchy[parent].get('parent')
+    parent = view.get('parent')
+    tokens.update(_tokens(class_of(unique_id), unique_id,
+                          class_of(parent) if parent in hierarchy else '',
+                          depth))
+  return minhash(tokens)
+
+
+def similarity(signature1, signature2):
+  """Estimates the Jaccard similarity of the hierarchies of two signatures."""
+  if not signature1 or not signature2:
+    return 0.0
+  same = sum(1 for a, b in zip(signature1, signature2) if a == b)
+  return same / float(len(signature1))
+
+
+def screen_key(activity, frag_list):
+  """Only Layouts of the same activity and fragments can be merged."""
+  return (activity, frozenset(Counter(frag_list or []).items()))
+
+
+class SimilarityIndex(object):
+  """Finds stored Layouts whose hierarchy is similar to a new one."""
+
+  def __init__(self, threshold=DEFAULT_THRESHOLD):
+    """Constructor for SimilarityIndex class.
+
+    Args:
+      threshold: Minimum estimated similarity, between 0 and 1, for a
+        hierarchy to be considered a near duplicate.
+    """
+    self.threshold = threshold
+    # Maps (screen key, band number, band values) to Layout names.
+    self.buckets = {}
+    # Maps Layout name to its signature.
+    self.signatures = {}
+
+  def _band_keys(self, key, signature):
+    for band in range(NUM_BANDS):
+      start = band * ROWS_PER_BAND
+      yield (key, band, signature[start:start + ROWS_PER_BAND])
+
+  def add(self, name, activity, frag_list, signature):
+    if not signature:
+      return
+    self.signatures[name] = signature
+    for band_key in self._band_keys(screen_key(activity, frag_list),
+                                    signature):
+      self.buckets.setdefault(band_key, []).append(name)
+
+  def find(self, activity, frag_list, signature):
+    """Returns (name, similarity) of the most similar Layout, or None."""
+    if not signature:
+      return None
+    candidates = set()
+    for band_key in self._band_keys(screen_key(activity, frag_list),
+                                    signature):
+      candidates.update(self.buckets.get(band_key, ()))
+    best = None
+    for name in candidates:
+      score = similarity(signature, self.signatures[name])
+      if score >= self.threshold and (not best or score > best[1]):
+        best = (name, score)
+    return best
+
+
+def _load_layout_info(path):
+  if path.endswith(compacthierarchy.EXTENSION):
+    return compacthierarchy.load(path).to_layout_info()
+  with open(path) as in_file:
+    return json.load(in_file)
+
+
+def report(directory, threshold=DEFAULT_THRESHOLD):
+  """Prints which Layouts of a crawl are near duplicates of earlier ones."""
+  # Layouts are numbered in the order they were found.
+  layouts = []
+  for filename in os.listdir(directory):
+    name, extension = os.path.splitext(filename)
+    if (extension not in ('.json', compacthierarchy.EXTENSION) or
+        filename.endswith('-clicks.json')):
+      continue
+    layout_info = _load_layout_info(os.path.join(directory, filename))
+    if 'hierarchy' not in layout_info:
+      continue
+    num = name.rpartition('-')[2]
+    layouts.append((int(num) if num.isdigit() else 0, name, layout_info))
+  layouts.sort()
+
+  index = SimilarityIndex(threshold)
+  merged = []
+  for _, name, layout_info in layouts:
+    activity = name.rpartition('-')[0].rpartition('-')[0]
+    signature = hierarchy_signature(layout_info['hierarchy'])
+    match = index.find(activity, layout_info['fragmentList'], signature)
+    if match:
+      merged.append((name, match[0], match[1]))
+    else:
+      index.add(name, activity, layout_info['fragmentList'], signature)
+
+  saved_bytes = 0
+  for name, match, score in merged:
+    for filename in os.listdir(directory):
+      if os.path.splitext(filename)[0] in (name, name + '-clicks'):
+        saved_bytes += os.path.getsize(os.path.join(directory, filename))
+    print '{} is a near duplicate of {} ({:.2f})'.format(name, match, score)
+  print '{} of {} layouts are near duplicates at threshold {}.'.format(
+      len(merged), len(layouts), threshold)
+  if not merged:
+    return
+  print 'Merging them would save {} bytes.'.format(saved_bytes)
+
+  try:
+    with open(os.path.join(directory, PROFILE_FILE)) as in_file:
+      profile = json.load(in_file)
+  except (IOError, ValueError):
+    return
+  num_steps = profile['ops'].get('touch', {}).get('count', 0)
+  if num_steps:
+    # Every Layout takes at least one crawl step to explore.
+    step_s = profile['wall_s'] / num_steps
+    print 'and at least {:.0f}s of crawl time ({:.1f}s per step).'.format(
+        len(merged) * step_s, step_s)
+
+
+if __name__ == '__main__':
+  if len(sys.argv) < 2:
+    print __doc__
+    sys.exit()
+  report(sys.argv[1],
+         float(sys.argv[2]) if len(sys.argv) > 2 else DEFAULT_THRESHOLD)
@@ -0,0 +1,498 @@
+# Copyright 2016 The Vanadium Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+"""A simulated device for running the crawler without an emulator.
+
+SimDevice and SimViewClient stand in for the AndroidViewClient device and
+ViewClient. They replay an AppModel: the screens of an app, the views on each
+screen, and which screen each click leads to. A model is either generated or
+built from the output of an earlier crawl in data/<package>/.
+
+Every device operation advances a simulated clock by a typical latency for that
+operation instead of sleeping, and is counted, so crawler changes can be
+measured without a device.
+"""
+
+import hashlib
+import json
+import os
+import random
+import re
+
+import adbtransport
+import compacthierarchy
+from screenshots import encode_png
+
+SCREEN_WIDTH = 1440
+SCREEN_HEIGHT = 2560
+DENSITY = 560
+SERIAL_NO = 'sim-5554'
+LAUNCHER_FOCUS = ('mCurrentFocus=Window{1 u0 com.android.launcher3/'
+                  'com.android.launcher3.Launcher}')
+BACK_BUTTON = 'back button'
+CLICKS_SUFFIX = '-clicks.json'
+# Simulated seconds taken by each kind of device operation.
+LATENCIES = {
+    'shell': 0.05,
+    'input': 0.1,
+    'dump': 0.8,
+    'screencap': 0.35,
+    # screencap | md5sum, on top of the shell command that runs it.
+    'digest': 0.15,
+    'launch': 2.0,
+    'install': 5.0,
+}
+VIEW_HEIGHT = 120
+VIEW_WIDTH = 300
+VIEWS_PER_ROW = 4
+TOP_MARGIN = 200
+# A 1x1 PNG stands in for screenshots.
+SCREENSHOT = encode_png(1, 1, '\x00\x00\x00\xff')
+
+
+class Screen(object):
+  """One screen of a simulated app."""
+
+  def __init__(self, name, activity, frag_list, views):
+    """Constructor for Screen class.
+
+    Args:
+      name: Name of the screen.
+      activity: Short activity name, without the package.
+      frag_list: Names of the fragments on the screen.
+      views: List of view attribute dictionaries, root first. Each has at
+        least 'uniqueId', and 'parent' as the index of the parent view.
+    """
+    self.name = name
+    self.activity = activity
+    self.frag_list = frag_list
+    self.views = views
+    # Maps uniqueId of a clickable view to the name of the screen it opens.
+    self.clicks = {}
+    # Screen that the back button leads to. None follows the back stack.
+    self.back = None
+    # Whether a row of the screen changes on every visit, like a feed.
+    self.volatile = False
+
+
+class AppModel(object):
+  """The screens of an app and the transitions between them."""
+
+  def __init__(self, package_name, screens, launch_screen):
+    """Constructor for AppModel class."""
+    self.package_name = package_name
+    self.screens = screens
+    self.launch_screen = launch_screen
+
+  @staticmethod
+  def synthetic(package_name='com.sim.synthetic', num_screens=60,
+                views_per_screen=30, clickable_per_screen=6, volatile=0.0,
+                seed=0):
+    """Generates a random app.
+
+    Args:
+      volatile: Fraction of the screens that change a row on every visit.
+    """
+    rand = random.Random(seed)
+    activities = ['Activity' + str(i) for i in range(max(1, num_screens / 8))]
+    fragments = ['Fragment' + str(i) for i in range(max(1, num_screens / 4))]
+    screens = {}
+    for s in range(num_screens):
+      views = [{'uniqueId': 'id/root', 'class': 'android.widget.FrameLayout',
+                'x': 0, 'y': 0, 'width': SCREEN_WIDTH, 'height': SCREEN_HEIGHT,
+                'clickable': False, 'parent': None},
+               {'uniqueId': 'id/title_' + str(s),
+                'class': 'android.widget.TextView', 'x': 0, 'y': 0,
+                'width': SCREEN_WIDTH, 'height': TOP_MARGIN,
+                'clickable': False, 'parent': 0, 'text': 'Screen ' + str(s)}]
+      clickable = set(rand.sample(range(views_per_screen),
+                                  min(clickable_per_screen, views_per_screen)))
+      for v in range(views_per_screen):
+        views.append({
+            'uniqueId': 'id/view_' + str(rand.randint(0, 3 * views_per_screen)),
+            'class': rand.choice(['android.widget.TextView',
+                                  'android.widget.ImageView',
+                                  'android.widget.Button']),
+            'x': (v % VIEWS_PER_ROW) * VIEW_WIDTH,
+            'y': TOP_MARGIN + (v / VIEWS_PER_ROW) * VIEW_HEIGHT,
+            'width': VIEW_WIDTH - 10, 'height': VIEW_HEIGHT - 10,
+            'clickable': v in clickable, 'parent': 0})
+      name = 'screen' + str(s)
+      screens[name] = Screen(name, rand.choice(activities),
+                             rand.sample(fragments, rand.randint(0, 1)), views)
+      screens[name].volatile = rand.random() < volatile
+
+    names = sorted(screens)
+    for screen in screens.values():
+      for view in screen.views:
+        # Some clicks do not change the screen.
+        if view['clickable'] and rand.random() < 0.8:
+          screen.clicks[view['uniqueId']] = rand.choice(names)
+    return AppModel(package_name, screens, names[0])
+
+  @staticmethod
+  def from_crawl_data(directory):
+    """Builds a model from the output of a crawl in data/<package>/."""
+    package_name = os.path.basename(os.path.normpath(directory))
+    screens = {}
+    launch_screen = None
+    for filename in sorted(os.listdir(directory)):
+      path = os.path.join(directory, filename)
+      if filename.endswith(compacthierarchy.EXTENSION):
+        layout_info = compacthierarchy.load(path).to_layout_info()
+      elif filename.endswith('.json') and not filename.endswith(CLICKS_SUFFIX):
+        with open(path) as in_file:
+          layout_info = json.load(in_file)
+        if 'hierarchy' not in layout_info:
+          continue
+      else:
+        continue
+      name = os.path.splitext(filename)[0]
+      # Layout names are <activity>-<first fragment>-<num>.
+      activity = name.rsplit('-', 2)[0]
+      screens[name] = Screen(name, activity, layout_info['fragmentList'],
+                             _views_from_hierarchy(layout_info['hierarchy']))
+
+    for name, screen in screens.iteritems():
+      click_path = os.path.join(directory, name + CLICKS_SUFFIX)
+      if not os.path.exists(click_path):
+        continue
+      with open(click_path) as in_file:
+        click_info = json.load(in_file)
+      for view_id, target in click_info['click_dict'].iteritems():
+        if target not in screens:
+          continue
+        if view_id == BACK_BUTTON:
+          screen.back = target
+        else:
+          screen.clicks[view_id] = target
+      if click_info.get('depth') == 0:
+        launch_screen = name
+
+    if not screens:
+      raise ValueError('No hierarchies found in ' + directory)
+    return AppModel(package_name, screens, launch_screen or sorted(screens)[0])
+
+
+def _views_from_hierarchy(hierarchy):
+  """Converts the saved hierarchy of a Layout to simulated views."""
+  ids = list(hierarchy)
+  # Parents come before their children, as in a dump.
+  ids.sort(key=lambda i: _depth(hierarchy, i))
+  index = dict((unique_id, i) for i, unique_id in enumerate(ids))
+  views = []
+  for unique_id in ids:
+    attrs = hierarchy[unique_id].get('map', {})
+
+    def number(key, attrs=attrs):
+      try:
+        return int(float(attrs.get(key, 0)))
+      except (TypeError, ValueError):
+        return 0
+
+    views.append({
+        'uniqueId': unique_id, 'class': attrs.get('class', ''),
+        'x': number('layout:getLocationOnScreen_x()'),
+        'y': number('layout:getLocationOnScreen_y()'),
+        'width': number('layout:getWidth()'),
+        'height': number('layout:getHeight()'),
+        'clickable': attrs.get('isClickable()') == 'true',
+        'text': attrs.get('text:mText', ''),
+        'parent': index.get(hierarchy[unique_id].get('parent'))})
+  return views
+
+
+def _depth(hierarchy, unique_id):
+  depth = 0
+  parent = hierarchy[unique_id].get('parent')
+  while parent in hierarchy and depth < len(hierarchy):
+    depth += 1
+    parent = hierarchy[parent].get('parent')
+  return depth
+
+
+class SimView(object):
+  """Stands in for an AndroidViewClient View."""
+
+  def __init__(self, attrs, device):
+    """Constructor for SimView class."""
+    self.map = {
+        'uniqueId': attrs['uniqueId'],
+        'class': attrs['class'],
+        'mID': attrs['uniqueId'],
+        'text:mText': attrs.get('text', ''),
+        'layout:getLocationOnScreen_x()': str(attrs['x']),
+        'layout:getLocationOnScreen_y()': str(attrs['y']),
+        'layout:getWidth()': str(attrs['width']),
+        'layout:getHeight()': str(attrs['height']),
+        'isClickable()': 'true' if attrs['clickable'] else 'false',
+        'getVisibility()': 'VISIBLE',
+    }
+    self.device = device
+    self.parent = None
+    self.children = []
+
+  def __getitem__(self, key):
+    return self.map[key]
+
+  def getUniqueId(self):
+    return self.map['uniqueId']
+
+  def getId(self):
+    return self.map['mID']
+
+  def getClass(self):
+    return self.map['class']
+
+  def getText(self):
+    return self.map['text:mText']
+
+  def getX(self):
+    return int(self.map['layout:getLocationOnScreen_x()'])
+
+  def getY(self):
+    return int(self.map['layout:getLocationOnScreen_y()'])
+
+  def getXY(self):
+    return (self.getX(), self.getY())
+
+  def getWidth(self):
+    return int(self.map['layout:getWidth()'])
+
+  def getHeight(self):
+    return int(self.map['layout:getHeight()'])
+
+  def isClickable(self):
+    return self.map['isClickable()'] == 'true'
+
+  def isFocused(self):
+    return False
+
+  def getVisibility(self):
+    # VISIBLE
+    return 0
+
+
+class SimDevice(object):
+  """Stands in for an AndroidViewClient device running an AppModel."""
+
+  def __init__(self, app):
+    """Constructor for SimDevice class."""
+    self.app = app
+    self.serialno = SERIAL_NO
+    # None when the app is not in the foreground.
+    self.screen = None
+    self.back_stack = []
+    # Number of times a screen was shown.
+    self.num_visits = 0
+    # Simulated seconds spent on device operations.
+    self.clock = 0.0
+    # Maps kind of operation to number of times it was done.
+    self.calls = {}
+    self.num_inputs = 0
+
+  def _count(self, kind, latency=None):
+    self.calls[kind] = self.calls.get(kind, 0) + 1
+    self.clock += LATENCIES[latency or kind]
+
+  def num_calls(self):
+    return sum(self.calls.values())
+
+  def _show(self, screen):
+    self.screen = screen
+    if screen:
+      self.num_visits += 1
+
+  def _screen_state(self):
+    """Returns a string that changes whenever the pixels would."""
+    if not self.screen:
+      return 'launcher'
+    if self.app.screens[self.screen].volatile:
+      return self.screen + '#' + str(self.num_visits)
+    return self.screen
+
+  def _focus(self):
+    if not self.screen:
+      return LAUNCHER_FOCUS
+    screen = self.app.screens[self.screen]
+    return ('mCurrentFocus=Window{1a2b u0 %s/%s.%s}' %
+            (self.app.package_name, self.app.package_name, screen.activity))
+
+  def _volatile_row(self, screen):
+    """Returns the index of the view that changes on every visit, or None."""
+    if not screen.volatile:
+      return None
+    return next((i for i, v in enumerate(screen.views)
+                 if i > 0 and not v['clickable']), None)
+
+  def _activity_dump(self):
+    if not self.screen:
+      return ''
+    screen = self.app.screens[self.screen]
+    frags = ''.join('    #%d: %s{%x}\n' % (i, f, i)
+                    for i, f in enumerate(screen.frag_list))
+    # Like a device, dumpsys activity also lists the views of the activity.
+    row = self._volatile_row(screen)
+    views = ''.join(
+        '      %s{%x V.E...... %d,%d-%d,%d %s}\n' % (
+            v['class'], i, v['x'], v['y'], v['x'] + v['width'],
+            v['y'] + v['height'],
+            'id/row_' + str(self.num_visits) if i == row else v['uniqueId'])
+        for i, v in enumerate(screen.views))
+    return ('Added Fragments:\n' + frags + '  FragmentManager misc state:\n' +
+            '  View Hierarchy:\n' + views)
+
+  def _shell_output(self, cmd):
+    cmd = cmd.strip()
+    if cmd.startswith('echo '):
+      return cmd[len('echo '):] + '\n'
+    if cmd.startswith('dumpsys window windows'):
+      return '  ' + self._focus() + '\r\n'
+    if cmd.startswith('dumpsys input_method'):
+      return '  mInputShown=false\r\n'
+    if cmd.startswith('dumpsys power'):
+      return 'Display Power: state=ON\r\n'
+    if cmd.startswith('dumpsys activity'):
+      return self._activity_dump()
+    if cmd.startswith('screencap') and 'md5sum' in cmd:
+      self.clock += LATENCIES['digest']
+      return hashlib.md5(self._screen_state()).hexdigest() + '  -\n'
+    if cmd == 'getprop sys.boot_completed':
+      return '1\n'
+    if cmd == 'wm size':
+      return 'Physical size: %dx%d\r\n' % (SCREEN_WIDTH, SCREEN_HEIGHT)
+    if cmd == 'wm density':
+      return 'Physical density: %d\r\n' % DENSITY
+    if cmd.startswith('pm list packages'):
+      return 'package:' + self.app.package_name + '\r\n'
+    if cmd.startswith('am force-stop'):
+      self._show(None)
+      self.back_stack = []
+    elif cmd.startswith('monkey -p ' + self.app.package_name):
+      self._count('launch')
+      self._show(self.app.launch_screen)
+      self.back_stack = []
+    elif cmd.startswith('input tap '):
+      x, y = cmd.split()[2:4]
+      self._tap(int(x), int(y))
+    return ''
+
+  def shell(self, cmd):
+    self._count('shell')
+    # Combined commands are run one after another, as the device shell would.
+    return ''.join(self._shell_output(c) for c in re.split(r' ; ', cmd))
+
+  def _tap(self, x, y):
+    self.num_inputs += 1
+    if not self.screen:
+      return
+    screen = self.app.screens[self.screen]
+    for view in reversed(screen.views):
+      if (view['clickable'] and view['x'] <= x < view['x'] + view['width'] and
+          view['y'] <= y < view['y'] + view['height']):
+        target = screen.clicks.get(view['uniqueId'])
+        if target and target != self.screen:
+          self.back_stack.append(self.screen)
+          self._show(target)
+        return
+
+  def touch(self, x, y):
+    self._count('input')
+    self._tap(x, y)
+
+  def press(self, keycode):
+    self._count('input')
+    self.num_inputs += 1
+    if keycode != 'KEYCODE_BACK' or not self.screen:
+      return
+    back = self.app.screens[self.screen].back
+    if back:
+      self._show(back)
+    elif self.back_stack:
+      self._show(self.back_stack.pop())
+    else:
+      self._show(None)
+
+  def type(self, text):
+    self._count('input')
+
+  def isKeyboardShown(self):
+    self._count('shell')
+    return False
+
+  def dump(self):
+    """Returns the SimViews of the current screen."""
+    self._count('dump')
+    if not self.screen:
+      return []
+    screen = self.app.screens[self.screen]
+    views = [SimView(v, self) for v in screen.views]
+    for view, attrs in zip(views, screen.views):
+      if attrs['parent'] is not None:
+        view.parent = views[attrs['parent']]
+        view.parent.children.append(view)
+    row = self._volatile_row(screen)
+    if row is not None:
+      views[row].map['uniqueId'] = 'id/row_' + str(self.num_visits)
+    return views
+
+
+class SimViewClient(object):
+  """Stands in for an AndroidViewClient ViewClient."""
+
+  def __init__(self, device):
+    """Constructor for SimViewClient class."""
+    self.device = device
+    self.views = []
+
+  def dump(self, window='-1'):
+    self.views = self.device.dump()
+    return self.views
+
+  def findViewById(self, view_id):
+    return next((v for v in self.views if v.getUniqueId() == view_id), None)
+
+
+class SimTransport(object):
+  """Stands in for the AdbTransport of a SimDevice."""
+
+  def __init__(self, device):
+    """Constructor for SimTransport class."""
+    self.device = device
+
+  def shell(self, cmd):
+    return self.device.shell(cmd)
+
+  def exec_out(self, cmd):
+    self.device._count('screencap')  # pylint: disable=protected-access
+    return SCREENSHOT
+
+  def pull(self, remote_path, local_path):
+    self.device._count('shell')  # pylint: disable=protected-access
+    with open(local_path, 'wb') as out_file:
+      out_file.write(SCREENSHOT)
+
+  def install(self, apk_path):
+    self.device._count('install')  # pylint: disable=protected-access
+    return 'Success'
+
+  def uninstall(self, package_name):
+    return self.device.shell('pm uninstall ' + package_name)
+
+  def reboot(self):
+    self.device.shell('am force-stop ' + self.device.app.package_name)
+
+  def close(self):
+    pass
+
+
+def connect(app):
+  """Returns a (device, vc) pair running the app.
+
+  The transport of the simulated device is registered so that the crawler's
+  get_transport() returns it.
+  """
+  device = SimDevice(app)
+  adbtransport.TRANSPORTS[device.serialno] = SimTransport(device)
+  return device, SimViewClient(device)
@@ -0,0 +1,143 @@
+# Copyright 2016 The Vanadium Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+"""DeviceSnapshot class definition."""
+
+import hashlib
+import re
+
+# Printed between the outputs of the combined shell command. It cannot appear in
+# any dumpsys output.
+SECTION_MARKER = '--capsule-snapshot-section--'
+
+FOCUS_CMD = "dumpsys window windows | grep -E 'mCurrentFocus'"
+KEYBOARD_CMD = "dumpsys input_method | grep -E 'mInputShown'"
+POWER_CMD = "dumpsys power | grep 'Display Power: state='"
+ACTIVITY_CMD = 'dumpsys activity '
+# A digest of the framebuffer, which tells if the screen changed much more
+# cheaply than a view hierarchy dump.
+DIGEST_CMD = 'screencap | md5sum'
+DIGEST_RE = re.compile(r'^[0-9a-f]{32}$')
+
+
+def parse_frag_list(activity_dump):
+  """Gets the list of fragments from the output of dumpsys activity."""
+  frag_dump = re.findall('Added Fragments:(.*?)FragmentManager', activity_dump,
+                         re.DOTALL)
+  if frag_dump:
+    frag_list = re.findall(': (.*?){', frag_dump[0], re.DOTALL)
+    # For irregular or app-generated fragment names with spaces and IDs,
+    # terminate the name at the first space.
+    for i in range(0, len(frag_list)):
+      if ' ' in frag_list[i]:
+        frag_list[i] = frag_list[i].split()[0]
+    return frag_list
+
+  return []
+
+
+class DeviceSnapshot(object):
+  """The state of the device that the crawler checks on every step.
+
+  The focused window, fragment list, keyboard state and screen power are all
+  read with one combined shell command the first time any of them is needed.
+  The values are reused until invalidate() is called, which must happen after
+  every input event sent to the device.
+
+  get_window_digest() hashes the focused window and the activity dump, which
+  lists the views of the activity, so the crawler can tell that nothing
+  changed without dumping the hierarchy. It costs no extra query. If
+  probe_screen is set, get_screen_digest() also takes a digest of the pixels
+  of the screen, which catches changes that leave the views where they were.
+  """
+
+  def __init__(self, device, package_name=None):
+    """Constructor for DeviceSnapshot class."""
+    self.device = device
+    self.package_name = package_name
+    # Number of shell commands sent to the device by this snapshot.
+    self.num_queries = 0
+    self.focus = ''
+    self.activity_dump = ''
+    self.keyboard_shown = False
+    self.screen_on = True
+    # Whether the crawler compares window digests, and screen digests on top.
+    self.probe_window = False
+    self.probe_screen = False
+    # md5 of the framebuffer, or None if it has not been taken.
+    self.digest = None
+    self.valid = False
+
+  def invalidate(self):
+    """Marks the snapshot as stale so that the next read queries the device."""
+    self.valid = False
+    self.digest = None
+
+  def refresh(self):
+    """Reads all of the device state with a single shell command."""
+    cmds = [FOCUS_CMD, KEYBOARD_CMD, POWER_CMD]
+    if self.package_name:
+      cmds.append(ACTIVITY_CMD + self.package_name)
+    out = self.device.shell((' ; echo ' + SECTION_MARKER + ' ; ').join(cmds))
+    self.num_queries += 1
+    sections = (out or '').split(SECTION_MARKER)
+    sections += [''] * (len(cmds) - len(sections))
+
+    self.focus = sections[0].strip()
+    self.keyboard_shown = 'mInputShown=true' in sections[1]
+    self.screen_on = 'state=OFF' not in sections[2]
+    self.activity_dump = sections[3] if self.package_name else ''
+    self.valid = True
+
+  def _ensure_valid(self):
+    if not self.valid:
+      self.refresh()
+
+  def get_focus(self):
+    """Returns the mCurrentFocus line of dumpsys window."""
+    self._ensure_valid()
+    return self.focus
+
+  def get_window_digest(self):
+    """Returns a digest of the focused window and activity dump, or None.
+
+    It is None if the activity dump is not part of the snapshot, since the
+    focus alone says nothing about the views.
+    """
+    self._ensure_valid()
+    if not self.activity_dump:
+      return None
+    return hashlib.md5(self.focus + SECTION_MARKER +
+                       self.activity_dump).hexdigest()
+
+  def get_screen_digest(self):
+    """Returns the digest of the screen, or None if the probe is off."""
+    if self.probe_screen and not self.digest:
+      out = self.device.shell(DIGEST_CMD)
+      self.num_queries += 1
+      digest = ((out or '').split() or [''])[0]
+      if DIGEST_RE.match(digest):
+        self.digest = digest
+      else:
+        # The device cannot take digests, e.g. it has no md5sum.
+        print 'Screen digests are not supported, turning off the probe.'
+        self.probe_screen = False
+    return self.digest
+
+  def is_keyboard_shown(self):
+    self._ensure_valid()
+    return self.keyboard_shown
+
+  def is_screen_on(self):
+    self._ensure_valid()
+    return self.screen_on
+
+  def get_frag_list(self, package_name):
+    """Returns the list of fragments in the current layout of the package."""
+    if package_name != self.package_name:
+      # Only the crawled package is part of the combined command.
+      self.num_queries += 1
+      return parse_frag_list(self.device.shell(ACTIVITY_CMD + package_name))
+    self._ensure_valid()
+    return parse_frag_list(self.activity_dump)
@@ -0,0 +1,132 @@
+#!/usr/bin/python2.7
+# Copyright 2016 The Vanadium Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+"""Compares the frame rate and CPU cost of the ways to capture a window.
+
+Writes a framebuffer file laid out the way Xvfb writes it, then crops and
+encodes the same window from it repeatedly, once by running ImageMagick's
+convert for every frame and once in process from the memory mapped file. The
+cost of a frame of a static screen, which is compared with the last frame but
+not encoded, is measured as well. Pass the path of a real Xvfb_screen0 file to
+measure on a live display.
+"""
+
+import argparse
+import os
+import shutil
+import struct
+import tempfile
+import time
+
+import numpy
+
+import framebuffer
+
+XVFB_WINDOW_NAME = "Xvfb main window\0"
+XVFB_NCOLORS = 256
+
+
+def write_xwd(path, width, height, seed=0):
+  """Writes a 24 bit TrueColor XWD file like the one of Xvfb -fbdir."""
+  header_size = framebuffer.XWD_HEADER.size + len(XVFB_WINDOW_NAME)
+  bytes_per_line = width * 4
+  fields = {"header_size": header_size, "file_version": 7,
+            "pixmap_format": framebuffer.ZPIXMAP, "pixmap_depth": 24,
+            "pixmap_width": width, "pixmap_height": height, "xoffset": 0,
+            "byte_order": framebuffer.LSB_FIRST, "bitmap_unit": 32,
+            "bitmap_bit_order": framebuffer.LSB_FIRST, "bitmap_pad": 32,
+            "bits_per_pixel": 32, "bytes_per_line": bytes_per_line,
+            "visual_class": 4, "red_mask": 0xff0000, "green_mask": 0xff00,
+            "blue_mask": 0xff, "bits_per_rgb": 8, "colormap_entries": 256,
+            "ncolors": XVFB_NCOLORS, "window_width": width,
+            "window_height": height, "window_x": 0, "window_y": 0,
+            "window_bdrwidth": 0}
+  # Smooth gradients with some noise compress about as well as app screens.
+  rand = numpy.random.RandomState(seed)
+  ys, xs = numpy.mgrid[0:height, 0:width]
+  pixels = numpy.zeros((height, width, 4), numpy.uint8)
+  pixels[:, :, 0] = (xs * 255 / max(width - 1, 1)).astype(numpy.uint8)
+  pixels[:, :, 1] = (ys * 255 / max(height - 1, 1)).astype(numpy.uint8)
+  pixels[:, :, 2] = rand.randint(0, 32, (height, width))
+  with open(path, "wb") as out_file:
+    out_file.write(framebuffer.XWD_HEADER.pack(
+        *[fields[name] for name in framebuffer.XWD_FIELDS]))
+    out_file.write(XVFB_WINDOW_NAME)
+    for i in range(XVFB_NCOLORS):
+      out_file.write(struct.pack(">IHHHBB", i, i << 8, i << 8, i << 8, 7, 0))
+    out_file.write(pixels.tostring())
+
+
+def cpu_seconds():
+  """User and system time of this process and its finished children."""
+  times = os.times()
+  return sum(times[:4])
+
+
+def measure(capture_frame, num_frames):
+  """Returns (frames per second, CPU ms per frame, mean JPEG bytes)."""
+  capture_frame()
+  start_wall = time.time()
+  start_cpu = cpu_seconds()
+  total_bytes = 0
+  for _ in range(num_frames):
+    total_bytes += len(capture_frame())
+  wall = time.time() - start_wall
+  cpu = cpu_seconds() - start_cpu
+  return (num_frames / wall, cpu * 1000 / num_frames,
+          total_bytes / num_frames)
+
+
+def check_and_encode(window, detector):
+  """Returns the JPEG of the window if it changed, like emucapture does."""
+  if detector.check():
+    return window.encode(window.image(detector.previous))
+  return ""
+
+
+def has_convert():
+  return any(os.access(os.path.join(d, "convert"), os.X_OK)
+             for d in os.environ.get("PATH", "").split(os.pathsep))
+
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser()
+  parser.add_argument("--fb", help="Xvfb_screen0 file to capture from. A "
+                      "synthetic 1000x900 screen is used by default.")
+  parser.add_argument("--window", default="540x860+230+20",
+                      help="WIDTHxHEIGHT+X+Y of the window to capture.")
+  parser.add_argument("--frames", type=int, default=50)
+  args = parser.parse_args()
+
+  tmp_dir = None
+  path = args.fb
+  if not path:
+    tmp_dir = tempfile.mkdtemp()
+    path = os.path.join(tmp_dir, "Xvfb_screen0")
+    write_xwd(path, 1000, 900)
+  size, x, y = args.window.split("+")
+  width, height = [int(n) for n in size.split("x")]
+  x, y = int(x), int(y)
+
+  try:
+    fb = framebuffer.XwdFramebuffer(path)
+    window = framebuffer.WindowCapture(fb, x, y, width, height)
+    results = [("mmap", measure(window.encode, args.frames))]
+    detector = framebuffer.ChangeDetector(window)
+    results.append(("static", measure(
+        lambda: check_and_encode(window, detector), args.frames)))
+    if has_convert():
+      results.append(("convert", measure(
+          lambda: framebuffer.convert_window(path, x, y, width, height),
+          args.frames)))
+    else:
+      print "ImageMagick convert is not installed, skipping it."
+    for name, (fps, cpu_ms, jpeg_bytes) in results:
+      print "{:8} {:7.1f} fps {:7.1f} ms CPU/frame {:8d} bytes/frame".format(
+          name, fps, cpu_ms, jpeg_bytes)
+    fb.close()
+  finally:
+    if tmp_dir:
+      shutil.rmtree(tmp_dir)
@@ -0,0 +1,294 @@
+# Copyright 2016 The Vanadium Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+"""Serves the frames of one capture to any number of clients.
+
+Each frame is encoded once and published to every connected client. Clients
+get the global header as soon as they connect, followed by the latest frame.
+Every client has its own queue of frames waiting to be sent. When a client
+reads slower than frames are published, its queue drops the oldest frames
+instead of growing or holding up the other clients. A frame that has started
+to go out is always finished, so the stream stays well formed.
+
+All sockets are non-blocking and served by select() in serve_forever(), from a
+single thread, along with the sockets of any other servers that have the same
+readers(), writers(), handle_readable() and handle_writable() methods.
+"""
+
+import errno
+import fcntl
+import os
+import select
+import socket
+import threading
+
+# Frames a client may have waiting before the oldest ones are dropped.
+MAX_QUEUED_FRAMES = 4
+LISTEN_BACKLOG = 16
+# Errors of a non-blocking socket that mean "try again later".
+WOULD_BLOCK = (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR)
+
+
+class Client(object):
+  """A connected client and the frames waiting to be sent to it."""
+
+  def __init__(self, sock, address, max_queued):
+    self.sock = sock
+    self.address = address
+    self.max_queued = max_queued
+    self.queue = []
+    # Frame being sent, and how many of its bytes have been sent.
+    self.current = None
+    self.offset = 0
+    self.num_sent = 0
+    self.num_dropped = 0
+    self.bytes_sent = 0
+
+  def push(self, frame):
+    """Queues a frame, dropping the oldest queued frame if the queue is full.
+
+    Returns:
+      The number of frames dropped.
+    """
+    num_dropped = 0
+    if len(self.queue) >= self.max_queued:
+      self.queue.pop(0)
+      self.num_dropped += 1
+      num_dropped = 1
+    self.queue.append(frame)
+    return num_dropped
+
+  def wants_write(self):
+    return self.current is not None or bool(self.queue)
+
+  def flush(self):
+    """Sends as much as the socket takes without blocking.
+
+    Raises:
+      socket.error: The client disconnected.
+    """
+    while True:
+      if self.current is None:
+        if not self.queue:
+          return
+        self.current = self.queue.pop(0)
+        self.offset = 0
+      try:
+        num_bytes = self.sock.send(buffer(self.current, self.offset))
+      except socket.error as e:
+        if e.errno in WOULD_BLOCK:
+          return
+        raise
+      self.offset += num_bytes
+      self.bytes_sent += num_bytes
+      if self.offset < len(self.current):
+        return
+      self.current = None
+      self.num_sent += 1
+
+
+class Broadcaster(object):
+  """Listens on a port and sends every published frame to all clients."""
+
+  def __init__(self, port, global_header, host="localhost",
+               max_queued=MAX_QUEUED_FRAMES, stats=None):
+    self.port = port
+    # Optional CaptureStats counting the frames sent and dropped.
+    self.stats = stats
+    self.global_header = global_header
+    self.max_queued = max_queued
+    self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    self.server.bind((host, port))
+    self.server.listen(LISTEN_BACKLOG)
+    self.server.setblocking(0)
+    # Maps socket to Client.
+    self.clients = {}
+    self.last_frame = None
+    self.lock = threading.Lock()
+    # Set while there are clients, so capture can pause without them.
+    self.has_clients = threading.Event()
+    # Publishing from another thread writes to this pipe to wake up select().
+    # A single byte is enough to wake it, so nothing is written while one is
+    # pending.
+    self.wake_read, self.wake_write = os.pipe()
+    for fd in (self.wake_read, self.wake_write):
+      fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) |
+                  os.O_NONBLOCK)
+    self.wake_pending = False
+    self.stopped = False
+    self.closed = False
+
+  def publish(self, frame):
+    """Queues a frame for every client. Can be called from any thread."""
+    with self.lock:
+      if self.stopped:
+        return
+      self.last_frame = frame
+      num_dropped = 0
+      for client in self.clients.itervalues():
+        num_dropped += client.push(frame)
+      self._wake()
+    if num_dropped and self.stats:
+      self.stats.count("dropped", num_dropped)
+
+  def _wake(self):
+    """Wakes up select(). Must be called with the lock held."""
+    if self.closed or self.wake_pending:
+      return
+    try:
+      os.write(self.wake_write, "x")
+    except OSError as e:
+      # The pipe is full, so select() will wake up anyway.
+      if e.errno not in WOULD_BLOCK:
+        raise
+    self.wake_pending = True
+
+  def wait_for_clients(self, timeout=None):
+    """Blocks until a client is connected. Returns whether one is."""
+    return self.has_clients.wait(timeout)
+
+  def num_clients(self):
+    with self.lock:
+      return len(self.clients)
+
+  def readers(self):
+    with self.lock:
+      if self.closed:
+        return []
+      return [self.server, self.wake_read] + self.clients.keys()
+
+  def writers(self):
+    with self.lock:
+      return [sock for sock, client in self.clients.iteritems()
+              if client.wants_write()]
+
+  def _accept(self):
+    try:
+      sock, address = self.server.accept()
+    except socket.error as e:
+      if e.errno in WOULD_BLOCK:
+        return
+      raise
+    sock.setblocking(0)
+    client = Client(sock, address, self.max_queued)
+    # Every time a new client connects, we send the global header first, and
+    # then the latest frame so it does not wait for the screen to change.
+    client.current = self.global_header
+    with self.lock:
+      if self.last_frame is not None:
+        client.push(self.last_frame)
+      self.clients[sock] = client
+      self.has_clients.set()
+    print "client connected: " + str(address)
+
+  def _remove(self, sock, reason):
+    with self.lock:
+      client = self.clients.pop(sock, None)
+      if not self.clients:
+        self.has_clients.clear()
+        # Capture pauses without clients, so the last frame goes stale.
+        self.last_frame = None
+    sock.close()
+    if client:
+      print "client disconnected: " + str(client.address) + " " + str(reason)
+
+  def handle_readable(self, sock):
+    if self.closed:
+      # Closed by another thread while select() was waiting.
+      return
+    if sock is self.server:
+      self._accept()
+    elif sock is self.wake_read:
+      with self.lock:
+        self.wake_pending = False
+        if self.closed:
+          return
+        try:
+          os.read(self.wake_read, 4096)
+        except OSError as e:
+          if e.errno not in WOULD_BLOCK:
+            raise
+    else:
+      try:
+        data = sock.recv(4096)
+      except socket.error as e:
+        if e.errno not in WOULD_BLOCK:
+          self._remove(sock, e)
+        return
+      # Clients have nothing to say, so anything readable is the end.
+      if not data:
+        self._remove(sock, "closed")
+
+  def handle_writable(self, sock):
+    with self.lock:
+      client = self.clients.get(sock)
+    if not client:
+      return
+    num_sent, bytes_sent = client.num_sent, client.bytes_sent
+    try:
+      with self.lock:
+        client.flush()
+    except socket.error as e:
+      self._remove(sock, e)
+    if self.stats:
+      self.stats.record_sent(client.num_sent - num_sent,
+                             client.bytes_sent - bytes_sent)
+
+  def serve_forever(self, poll_interval=1.0):
+    """Accepts clients and sends them frames until stop() is called."""
+    serve_forever([self], poll_interval)
+
+  def stop(self):
+    with self.lock:
+      self.stopped = True
+      self._wake()
+
+  def close(self):
+    """Disconnects the clients and stops listening.
+
+    Publishing after this does nothing, and wait_for_clients() returns at once
+    so that capture can notice.
+    """
+    with self.lock:
+      self.stopped = True
+      clients = self.clients
+      self.clients = {}
+      self.last_frame = None
+      self.has_clients.set()
+      if not self.closed:
+        self.closed = True
+        os.close(self.wake_read)
+        os.close(self.wake_write)
+    for sock in clients:
+      sock.close()
+    self.server.close()
+
+
+def serve_once(servers, timeout):
+  """Waits up to timeout seconds for sockets of the servers to be ready.
+
+  Serves the sockets that are ready, if any.
+  """
+  # Maps each socket to the server it belongs to.
+  readers = {}
+  writers = {}
+  for server in servers:
+    readers.update((sock, server) for sock in server.readers())
+    writers.update((sock, server) for sock in server.writers())
+  readable, writable, _ = select.select(readers.keys(), writers.keys(), [],
+                                        timeout)
+  for sock in readable:
+    readers[sock].handle_readable(sock)
+  for sock in writable:
+    writers[sock].handle_writable(sock)
+
+
+def serve_forever(servers, poll_interval=1.0):
+  """Serves the sockets of all servers until they are all stopped."""
+  while True:
+    servers = [server for server in servers if not server.stopped]
+    if not servers:
+      return
+    serve_once(servers, poll_interval)
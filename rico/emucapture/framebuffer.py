@@ -0,0 +1,201 @@
+# Copyright 2016 The Vanadium Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+"""Captures a window from the Xvfb framebuffer without leaving the process.
+
+With -fbdir, Xvfb keeps its screen in an XWD file that it maps into memory and
+draws into directly. Mapping the same file once gives every frame for free:
+the window is cropped out of it with NumPy views, which do not copy the rest of
+the screen, and the crop is encoded as JPEG with PIL.
+
+The XWD header is written in big endian order, and is followed by the window
+name, the colormap and the pixels, one row of bytes_per_line bytes per line of
+the screen.
+
+Emulator screens are static most of the time, so ChangeDetector compares the
+window with the last frame tile by tile, and frames that did not change need
+not be encoded at all.
+"""
+
+from cStringIO import StringIO
+import mmap
+import os
+import struct
+from subprocess import PIPE
+from subprocess import Popen
+
+import numpy
+from PIL import Image
+
+# The 25 CARD32 fields of XWDFileHeader, see X11/XWDFile.h.
+XWD_HEADER = struct.Struct(">25I")
+XWD_FIELDS = ("header_size", "file_version", "pixmap_format", "pixmap_depth",
+              "pixmap_width", "pixmap_height", "xoffset", "byte_order",
+              "bitmap_unit", "bitmap_bit_order", "bitmap_pad",
+              "bits_per_pixel", "bytes_per_line", "visual_class", "red_mask",
+              "green_mask", "blue_mask", "bits_per_rgb", "colormap_entries",
+              "ncolors", "window_width", "window_height", "window_x",
+              "window_y", "window_bdrwidth")
+XWD_COLOR_SIZE = 12
+ZPIXMAP = 2
+LSB_FIRST = 0
+# The default JPEG quality of ImageMagick, which the convert path used.
+JPEG_QUALITY = 92
+# Width and height in pixels of the tiles compared by ChangeDetector.
+TILE_SIZE = 32
+# Maps (bits per pixel, byte order, red mask) to the PIL raw mode that decodes
+# the pixels as RGB.
+RAW_MODES = {
+    (32, LSB_FIRST, 0xff0000): "BGRX",
+    (32, LSB_FIRST, 0x0000ff): "RGBX",
+    (32, 1, 0xff0000): "XRGB",
+    (32, 1, 0x0000ff): "XBGR",
+    (24, LSB_FIRST, 0xff0000): "BGR",
+    (24, LSB_FIRST, 0x0000ff): "RGB",
+    (24, 1, 0xff0000): "RGB",
+    (24, 1, 0x0000ff): "BGR",
+}
+
+
+def screen_path(display_num):
+  """Path of the framebuffer file of a display started by emucapture."""
+  return os.path.join("/var/tmp", str(display_num), "Xvfb_screen0")
+
+
+class XwdFramebuffer(object):
+  """A memory mapped XWD framebuffer file."""
+
+  def __init__(self, path):
+    self.path = path
+    with open(path, "rb") as fb_file:
+      self.mmap = mmap.mmap(fb_file.fileno(), 0, access=mmap.ACCESS_READ)
+    header = dict(zip(XWD_FIELDS, XWD_HEADER.unpack_from(self.mmap)))
+    if header["pixmap_format"] != ZPIXMAP:
+      raise ValueError("Unsupported XWD pixmap format %d" %
+                       header["pixmap_format"])
+    key = (header["bits_per_pixel"], header["byte_order"], header["red_mask"])
+    if key not in RAW_MODES:
+      raise ValueError("Unsupported XWD pixel layout %r" % (key,))
+    self.raw_mode = RAW_MODES[key]
+    self.width = header["pixmap_width"]
+    self.height = header["pixmap_height"]
+    self.bytes_per_pixel = header["bits_per_pixel"] / 8
+    self.bytes_per_line = header["bytes_per_line"]
+    offset = header["header_size"] + header["ncolors"] * XWD_COLOR_SIZE
+    # One row of bytes per line of the screen. This is a view of the mapped
+    # file, so it always holds the current screen.
+    self.rows = numpy.frombuffer(
+        self.mmap, numpy.uint8, count=self.bytes_per_line * self.height,
+        offset=offset).reshape(self.height, self.bytes_per_line)
+
+  def close(self):
+    self.rows = None
+    self.mmap.close()
+
+
+class WindowCapture(object):
+  """Crops a window out of an XwdFramebuffer and encodes it as JPEG."""
+
+  def __init__(self, framebuffer, x, y, width, height,
+               quality=JPEG_QUALITY):
+    self.framebuffer = framebuffer
+    # Windows partly off the screen are cropped to the screen.
+    self.x = max(0, min(x, framebuffer.width))
+    self.y = max(0, min(y, framebuffer.height))
+    self.width = max(0, min(width, framebuffer.width - self.x))
+    self.height = max(0, min(height, framebuffer.height - self.y))
+    self.quality = quality
+    bpp = framebuffer.bytes_per_pixel
+    rows = framebuffer.rows[self.y:self.y + self.height]
+    # Pixels of the window, as a (height, width, bytes per pixel) view.
+    self.pixels = rows[:, self.x * bpp:(self.x + self.width) * bpp].reshape(
+        self.height, self.width, bpp)
+    # The window's rows are contiguous in the file apart from the bytes
+    # outside the window, so PIL can decode them straight from the mapping by
+    # skipping bytes_per_line between rows.
+    self.window_bytes = rows.reshape(-1)[self.x * bpp:]
+
+  def image(self, pixels=None):
+    """Returns the window as a PIL image.
+
+    Args:
+      pixels: Optional contiguous copy of the window's pixels, such as
+        ChangeDetector.previous. Defaults to the live framebuffer.
+    """
+    if pixels is not None:
+      return Image.frombuffer("RGB", (self.width, self.height), pixels, "raw",
+                              self.framebuffer.raw_mode,
+                              self.width * self.framebuffer.bytes_per_pixel, 1)
+    return Image.frombuffer("RGB", (self.width, self.height),
+                            self.window_bytes, "raw",
+                            self.framebuffer.raw_mode,
+                            self.framebuffer.bytes_per_line, 1)
+
+  def encode(self, image=None):
+    """Returns the window (or an image of it) as JPEG bytes."""
+    out = StringIO()
+    (image or self.image()).save(out, "JPEG", quality=self.quality)
+    return out.getvalue()
+
+
+class ChangeDetector(object):
+  """Finds the tiles of a window that changed since the last check."""
+
+  def __init__(self, window, tile_size=TILE_SIZE):
+    self.window = window
+    self.tile_size = tile_size
+    self.grid = (-(-window.height // tile_size), -(-window.width // tile_size))
+    self.num_tiles = self.grid[0] * self.grid[1]
+    # Nonzero for the pixels that changed, padded to whole tiles.
+    self.changed = numpy.zeros((self.grid[0] * tile_size,
+                                self.grid[1] * tile_size), numpy.uint32)
+    # Copy of the window as of the last check, which is also the frame to
+    # encode, so that what is sent is exactly what was compared.
+    self.previous = None
+
+  def check(self):
+    """Returns the number of tiles that changed, and remembers the window.
+
+    All tiles count as changed the first time.
+    """
+    current = self.window.pixels
+    if self.previous is None:
+      self.previous = numpy.array(current)
+      return self.num_tiles
+    differs = current != self.previous
+    # Most frames are the same, which one pass over the bytes tells.
+    if not differs.any():
+      return 0
+    height, width = self.window.height, self.window.width
+    if differs.shape[2] == 4:
+      # Reducing over the short bytes axis is slow, so each pixel's 4 bytes
+      # are read as one number instead.
+      self.changed[:height, :width] = differs.view(numpy.uint32)[:, :, 0]
+    else:
+      self.changed[:height, :width] = differs.any(axis=2)
+    tile = self.tile_size
+    tiles = self.changed.reshape(self.grid[0], tile, self.grid[1], tile)
+    num_changed = int(numpy.count_nonzero(tiles.max(axis=3).max(axis=1)))
+    numpy.copyto(self.previous, current)
+    return num_changed
+
+
+def encode_pixels(pixels, raw_mode, quality=JPEG_QUALITY):
+  """Encodes a contiguous (height, width, bytes per pixel) array as JPEG.
+
+  PIL holds the GIL while it encodes, so this is a function of its own that
+  encoder processes can run in parallel.
+  """
+  height, width, bytes_per_pixel = pixels.shape
+  image = Image.frombuffer("RGB", (width, height), pixels, "raw", raw_mode,
+                           width * bytes_per_pixel, 1)
+  out = StringIO()
+  image.save(out, "JPEG", quality=quality)
+  return out.getvalue()
+
+
+def convert_window(path, x, y, width, height):
+  """Crops and encodes a window with ImageMagick, one process per frame."""
+  cmd = "convert {} -crop {}x{}+{}+{} jpeg:-".format(path, width, height, x, y)
+  return Popen(cmd, shell=True, stdout=PIPE, stderr=PIPE).communicate()[0]
@@ -0,0 +1,190 @@
+# Copyright 2016 The Vanadium Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+"""Captures, encodes and publishes frames in separate threads.
+
+Capturing a frame is a quick comparison with the last one, while encoding it
+as JPEG takes tens of milliseconds. Running the stages one after the other
+makes every frame cost their sum. Here the capture thread hands the frames that
+changed to a pool of encoder threads, and a sender thread publishes the encoded
+frames in the order they were captured. PIL holds the GIL while it encodes, so
+the encoder threads hand the frames to as many encoder processes.
+
+The stages are connected by bounded queues. When the encoders fall behind, the
+capture thread waits for them instead of piling up frames, so frames flow at
+the rate of the slowest stage.
+"""
+
+import multiprocessing
+import Queue
+import struct
+import threading
+import time
+import traceback
+
+import framebuffer
+
+# Frames encoded in parallel, and frames each stage may have waiting for the
+# next one per encoder.
+DEFAULT_ENCODERS = 2
+QUEUED_PER_ENCODER = 2
+# Sent through the queues to stop the threads.
+STOP = object()
+
+
+class FramePipeline(object):
+  """Publishes the frames of a window in which something changed, at most fps.
+
+  Frames are compared before they are encoded, so a static screen costs a
+  comparison per frame instead of an encode. Each frame is encoded once,
+  however many clients there are. Capture pauses while there are no clients,
+  and the first frame after the pause is always published.
+  """
+
+  def __init__(self, window, detector, broadcaster, fps, keepalive,
+               encoders=DEFAULT_ENCODERS, stats=None, pool=None):
+    """Constructor for FramePipeline class.
+
+    Args:
+      window: WindowCapture to capture.
+      detector: ChangeDetector of the window.
+      broadcaster: Broadcaster to publish the frames to.
+      fps: Maximum number of frames captured per second.
+      keepalive: Seconds after which an unchanged frame is published again, 0
+        to publish every frame.
+      encoders: Number of frames encoded in parallel.
+      stats: Optional CaptureStats counting the frames captured and encoded.
+      pool: Optional multiprocessing.Pool to encode the frames in, which may be
+        shared with other pipelines. By default the pipeline starts a pool of
+        its own, of as many processes as encoders.
+    """
+    self.window = window
+    self.detector = detector
+    self.broadcaster = broadcaster
+    self.fps = fps
+    self.keepalive = keepalive
+    self.stats = stats
+    self.num_encoders = max(1, encoders)
+    max_queued = self.num_encoders * QUEUED_PER_ENCODER
+    # (sequence number, pixels) of the frames to encode.
+    self.to_encode = Queue.Queue(max_queued)
+    # (sequence number, frame) of the encoded frames, in any order. A None
+    # frame repeats the last one.
+    self.to_send = Queue.Queue(max_queued)
+    self.stopped = threading.Event()
+    self.threads = []
+    self.owns_pool = pool is None
+    # Started before any thread, as forking a process with threads is unsafe.
+    self.pool = pool or multiprocessing.Pool(self.num_encoders)
+
+  def start(self):
+    targets = [(self._capture, "capture"), (self._send, "send")]
+    targets += [(self._encode, "encode %d" % i)
+                for i in range(self.num_encoders)]
+    for target, name in targets:
+      thread = threading.Thread(target=target, name=name)
+      thread.daemon = True
+      thread.start()
+      self.threads.append(thread)
+
+  def stop(self):
+    """Stops capturing and waits for the captured frames to be published.
+
+    If capture is waiting for clients, it only stops once the broadcaster is
+    closed.
+    """
+    self.stopped.set()
+    for thread in self.threads:
+      thread.join()
+    if self.owns_pool:
+      self.pool.close()
+      self.pool.join()
+
+  def _capture(self):
+    frame_interval = 1.0 / self.fps
+    next_capture = time.time()
+    last_sent = None
+    sequence = 0
+    while not self.stopped.is_set() and not self.broadcaster.stopped:
+      if not self.broadcaster.wait_for_clients(0):
+        # A timeout would make Python poll, so this waits until a client
+        # connects or the broadcaster is closed.
+        self.broadcaster.wait_for_clients()
+        next_capture = time.time()
+        last_sent = None
+        continue
+      delay = next_capture - time.time()
+      if delay > 0:
+        time.sleep(delay)
+      # If capturing fell behind, do not try to catch up.
+      next_capture = max(next_capture + frame_interval, time.time())
+      changed = self.detector.check()
+      if self.stats:
+        self.stats.count("captured")
+      now = time.time()
+      if last_sent is not None and not changed:
+        if now - last_sent < self.keepalive:
+          continue
+        # Nothing changed, so the last frame is sent again as it was encoded.
+        pixels = None
+      else:
+        # The detector overwrites its copy of the window on the next check.
+        pixels = self.detector.previous.copy()
+      # Blocks while the encoders are behind.
+      self.to_encode.put((sequence, pixels))
+      sequence += 1
+      last_sent = now
+    for _ in range(self.num_encoders):
+      self.to_encode.put(STOP)
+
+  def _encode(self):
+    try:
+      while True:
+        task = self.to_encode.get()
+        if task is STOP:
+          return
+        sequence, pixels = task
+        frame = None
+        if pixels is not None:
+          try:
+            frame = self._encode_frame(pixels)
+          except Exception:  # pylint: disable=broad-except
+            # E.g. an encoder process died. The frame is skipped, and the
+            # sender repeats the last one so the sequence goes on.
+            traceback.print_exc()
+        self.to_send.put((sequence, frame))
+    finally:
+      # The sender only stops once every encoder has stopped.
+      self.to_send.put(STOP)
+
+  def _encode_frame(self, pixels):
+    start = time.time()
+    jpeg = self.pool.apply(framebuffer.encode_pixels, (
+        pixels, self.window.framebuffer.raw_mode, self.window.quality))
+    if self.stats:
+      self.stats.record_encode(time.time() - start)
+    # Each frame consist of the frame size as a 4 byte uint32 followed by the
+    # actual JPEG bytes.
+    return struct.pack("<I", len(jpeg) + 4) + jpeg
+
+  def _send(self):
+    # Frames that were encoded before the frames captured ahead of them.
+    ready = {}
+    next_sequence = 0
+    last_frame = None
+    num_stopped = 0
+    while num_stopped < self.num_encoders:
+      task = self.to_send.get()
+      if task is STOP:
+        num_stopped += 1
+        continue
+      ready[task[0]] = task[1]
+      while next_sequence in ready:
+        frame = ready.pop(next_sequence)
+        next_sequence += 1
+        if frame is None:
+          frame = last_frame
+        if frame is not None:
+          self.broadcaster.publish(frame)
+          last_frame = frame
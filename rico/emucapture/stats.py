@@ -0,0 +1,169 @@
+# Copyright 2016 The Vanadium Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+"""Counts what a capture server does and reports it on a local port.
+
+Every capture server listens on a stats port next to its frames port. A client
+that connects to it gets a JSON report of the frames captured, encoded, sent
+and dropped, the encode latency percentiles, the bytes sent per second and the
+number of clients, after which the connection is closed:
+
+  nc localhost 6203
+"""
+
+import collections
+import json
+import math
+import socket
+import threading
+import time
+
+# Each display's stats port is this plus the display number.
+STATS_BASE_PORT_NUM = 6200
+COUNTERS = ("captured", "encoded", "sent", "dropped")
+# Number of the latest encodes whose latency is reported.
+LATENCY_SAMPLES = 1000
+PERCENTILES = (50, 90, 99)
+# Seconds over which rates are averaged.
+RATE_SECONDS = 10
+
+
+def percentile(sorted_values, percent):
+  """Nearest-rank percentile of a sorted list, or None if it is empty."""
+  if not sorted_values:
+    return None
+  rank = int(math.ceil(percent / 100.0 * len(sorted_values)))
+  return sorted_values[max(0, min(rank, len(sorted_values)) - 1)]
+
+
+class Rate(object):
+  """Counts events per second over the last seconds."""
+
+  def __init__(self, seconds=RATE_SECONDS):
+    self.seconds = seconds
+    self.start = time.time()
+    # [second, count] of the last seconds in which there were events.
+    self.buckets = collections.deque()
+
+  def _expire(self, second):
+    while self.buckets and self.buckets[0][0] <= second - self.seconds:
+      self.buckets.popleft()
+
+  def add(self, count):
+    second = int(time.time())
+    if self.buckets and self.buckets[-1][0] == second:
+      self.buckets[-1][1] += count
+    else:
+      self.buckets.append([second, count])
+      self._expire(second)
+
+  def per_second(self):
+    now = time.time()
+    self._expire(int(now))
+    # Right after the start, the rate is over the seconds that have passed.
+    span = max(1.0, min(self.seconds, now - self.start))
+    return sum(count for _, count in self.buckets) / span
+
+
+class CaptureStats(object):
+  """Thread-safe counters of a capture server."""
+
+  def __init__(self, display_num=None, port=None):
+    """Constructor for CaptureStats class.
+
+    Args:
+      display_num: Display captured, reported to tell servers apart.
+      port: Port the frames are served on, reported as well.
+    """
+    self.display_num = display_num
+    self.port = port
+    self.start = time.time()
+    self.lock = threading.Lock()
+    self.counts = dict.fromkeys(COUNTERS, 0)
+    self.encode_seconds = collections.deque(maxlen=LATENCY_SAMPLES)
+    self.bytes_sent = 0
+    self.byte_rate = Rate()
+    self.frame_rate = Rate()
+
+  def count(self, name, num=1):
+    with self.lock:
+      self.counts[name] += num
+
+  def record_encode(self, seconds):
+    with self.lock:
+      self.counts["encoded"] += 1
+      self.encode_seconds.append(seconds)
+
+  def record_sent(self, num_frames, num_bytes):
+    with self.lock:
+      self.counts["sent"] += num_frames
+      self.bytes_sent += num_bytes
+      self.frame_rate.add(num_frames)
+      self.byte_rate.add(num_bytes)
+
+  def report(self, num_clients):
+    """Returns the stats as a dict."""
+    with self.lock:
+      latencies = sorted(self.encode_seconds)
+      report = dict(self.counts)
+      report.update({
+          "display": self.display_num,
+          "port": self.port,
+          "clients": num_clients,
+          "uptime_seconds": round(time.time() - self.start, 1),
+          "bytes_sent": self.bytes_sent,
+          "bytes_per_second": round(self.byte_rate.per_second(), 1),
+          "frames_sent_per_second": round(self.frame_rate.per_second(), 2),
+      })
+    for percent in PERCENTILES:
+      seconds = percentile(latencies, percent)
+      report["encode_ms_p%d" % percent] = (
+          None if seconds is None else round(seconds * 1000, 2))
+    return report
+
+
+class StatsServer(object):
+  """Writes the report of a CaptureStats to every client that connects.
+
+  It is served by the select() loop of broadcast.serve_forever.
+  """
+
+  def __init__(self, port, stats, broadcaster, host="localhost"):
+    self.stats = stats
+    self.broadcaster = broadcaster
+    self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    self.server.bind((host, port))
+    self.server.listen(5)
+    self.server.setblocking(0)
+    self.stopped = False
+
+  def readers(self):
+    return [self.server]
+
+  def writers(self):
+    return []
+
+  def handle_readable(self, sock):
+    try:
+      connection, _ = self.server.accept()
+    except socket.error:
+      return
+    report = self.stats.report(self.broadcaster.num_clients())
+    try:
+      # The report fits in the socket buffer, so this does not hold up the
+      # select() loop.
+      connection.sendall(json.dumps(report, indent=2, sort_keys=True,
+                                    separators=(",", ": ")) + "\n")
+    except socket.error as e:
+      print "could not send stats: " + str(e)
+    finally:
+      connection.close()
+
+  def handle_writable(self, sock):
+    pass
+
+  def stop(self):
+    self.stopped = True
+    self.server.close()
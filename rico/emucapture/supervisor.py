@@ -0,0 +1,349 @@
+# Copyright 2016 The Vanadium Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+"""Runs the displays, emulators and capture servers of one or more AVDs.
+
+A single thread starts every display and emulator, and polls each display
+until what it waits for is ready instead of sleeping for as long as it could
+take: the X server is up as soon as it accepts a connection, and the emulator
+is up once its window has been found and has kept the same size and position
+for a few seconds. Windows are found with xwindows, without running xwininfo.
+
+The same thread serves the frames and stats ports of all displays with
+select(). Each display captures in a FramePipeline of its own, and all of them
+share one pool of encoder processes.
+
+While a display is served, its window is still looked at every few seconds.
+If it moved or changed size, its clients are disconnected and it is served
+again once the window has settled, so that clients reconnect and get the new
+global header.
+"""
+
+import atexit
+import multiprocessing
+import os
+import socket
+from subprocess import PIPE
+from subprocess import Popen
+import struct
+import time
+
+import broadcast
+import framebuffer
+import pipeline
+import stats
+import xwindows
+
+# The depth needed for the emulator is minimum of 24
+# The size should be changed if you change the display associated with
+# the AVD that you're using with the emulator.
+SCREEN_SIZE = "1000x900x24"
+# Each display is assigned a port number that starts from this port
+# Display :0 will be port 6100, display :1 will be 6101 etc.
+BASE_PORT_NUM = 6100
+# To be compatible with Minicap, we use a similar header format as specified at
+# https://github.com/openstf/minicap (under "Usage")
+HEADER_SIZE = 24
+HEADER_VERSION = 1
+# Minicap's QUIRK_DUMB bitflag, for frames sent even if nothing changed.
+QUIRK_DUMB = 1
+# Frames per second to capture at, at most. Only frames in which the screen
+# changed are encoded and sent.
+DEFAULT_FPS = 15
+# Seconds after which the last frame is sent again even if nothing changed, so
+# clients can tell the server is alive. 0 sends every captured frame.
+DEFAULT_KEEPALIVE = 2.0
+# Seconds between polls of a display that is starting, and the longest it may
+# take to become ready before it is given up on.
+X_POLL_INTERVAL = 0.05
+X_DEADLINE = 30
+WINDOW_POLL_INTERVAL = 0.5
+EMULATOR_DEADLINE = 600
+# The emulator window is initially smaller while it is loading, so it is only
+# captured once it kept the same geometry for this many seconds.
+WINDOW_SETTLE_SECONDS = 3
+# Seconds between checks that the window of a served display did not change.
+WINDOW_CHECK_INTERVAL = 2
+# States of a display.
+STARTING_X = "starting X"
+STARTING_EMULATOR = "waiting for the emulator window"
+SERVING = "serving"
+FAILED = "failed"
+
+procs = []
+
+
+@atexit.register
+def kill_subprocesses():
+  """Auto kill subprocesses (Xvfb and emulator) when this script is killed.
+
+  Details at: http://sharats.me/the-ever-useful-and-neat-subprocess-module.html
+  """
+  for process in procs:
+    if process.poll() is None:
+      process.kill()
+
+
+def start_xvfb(display_num):
+  """Starts Xvfb on a display, keeping its framebuffer in a file."""
+  # Folder where xvfb will store its framebuffer as a memory mapped file.
+  # We create a separate subdirectory under /var/tmp for each display.
+  fbdir = os.path.dirname(framebuffer.screen_path(display_num))
+  if not os.path.exists(fbdir):
+    os.mkdir(fbdir)
+  cmd = ["Xvfb", ":"+str(display_num), "-ac", "-fbdir", fbdir, "-screen", "0",
+         SCREEN_SIZE]
+  process = Popen(cmd, stdout=PIPE, stderr=PIPE)
+  procs.append(process)
+  return process
+
+
+def start_emulator(display_num, avd_name):
+  """Runs the emulator on the display created by Xvfb."""
+  cmd = ("DISPLAY=:" + str(display_num) + " emulator64-x86 -avd " + avd_name +
+         " -noaudio -nojni -netfast -no-boot-anim -qemu -enable-kvm -snapshot")
+  process = Popen(cmd, shell=True, stdout=PIPE, stderr=PIPE)
+  procs.append(process)
+  return process
+
+
+def global_header(pid, width, height, quirks):
+  """Returns the header sent to clients before the frames.
+
+  We use a similar header format as Minicap -- specified here
+  https://github.com/openstf/minicap (under "Usage").
+  The only difference is that instead of the real PID we have a number that
+  helps identify the emulator this server is associated with. We also have the
+  same virtual display width/height as the real display width/height.
+  """
+  # The struct python library is used to pack different data as bytes.
+  # More info here: https://docs.python.org/3/library/struct.html
+  return (struct.pack("B", HEADER_VERSION) +
+          struct.pack("B", HEADER_SIZE) +
+          struct.pack("<I", pid) +
+          struct.pack("<I", width) +
+          struct.pack("<I", height) +
+          struct.pack("<I", width) +
+          struct.pack("<I", height) +
+          struct.pack("B", 0) +
+          struct.pack("B", quirks))
+
+
+class Display(object):
+  """An Xvfb display, the emulator on it and the servers of its frames."""
+
+  def __init__(self, display_num, avd_name, options, pool):
+    """Constructor for Display class.
+
+    Args:
+      display_num: The display number to use with Xvfb.
+      avd_name: The name of the AVD instance to run on it.
+      options: Parsed command line options of emucapture.
+      pool: multiprocessing.Pool to encode frames in.
+    """
+    self.display_num = display_num
+    self.avd_name = avd_name
+    self.options = options
+    self.pool = pool
+    self.port = BASE_PORT_NUM + display_num
+    self.stats_port = stats.STATS_BASE_PORT_NUM + display_num
+    self.stats = stats.CaptureStats(display_num, self.port)
+    self.state = None
+    self.deadline = None
+    self.next_poll = 0
+    self.xvfb = None
+    self.emulator = None
+    self.x = None
+    self.framebuffer = None
+    # (window, name) of the emulator window, its geometry and since when.
+    self.window = None
+    self.geometry = None
+    self.geometry_since = None
+    self.broadcaster = None
+    self.stats_server = None
+    self.pipeline = None
+
+  def log(self, message):
+    print "display " + str(self.display_num) + ": " + message
+
+  def _enter(self, state, now, deadline=None):
+    self.state = state
+    self.deadline = now + deadline if deadline else None
+    self.log(state)
+
+  def start(self):
+    self.xvfb = start_xvfb(self.display_num)
+    self._enter(STARTING_X, time.time(), X_DEADLINE)
+
+  def servers(self):
+    """Returns the servers whose sockets are served by the supervisor."""
+    if self.state == SERVING:
+      return [self.broadcaster, self.stats_server]
+    return []
+
+  def poll(self, now):
+    """Moves the display on once what it waits for is ready."""
+    for process in (self.xvfb, self.emulator):
+      if process and process.poll() is not None:
+        self.fail("{} exited with {}".format(
+            "Xvfb" if process is self.xvfb else "the emulator",
+            process.returncode))
+        return
+    if self.deadline and now > self.deadline:
+      self.fail("timed out " + self.state)
+      return
+    try:
+      if self.state == STARTING_X:
+        self._poll_x(now)
+      elif self.state == STARTING_EMULATOR:
+        self._poll_window(now)
+      elif self.state == SERVING:
+        self._check_window(now)
+    except xwindows.XError as e:
+      # E.g. Xvfb is going away, which the next poll notices.
+      self.log(str(e))
+      self.next_poll = now + WINDOW_POLL_INTERVAL
+    except socket.error as e:
+      # The ports are taken, e.g. by another emucapture.
+      self.fail("could not serve: " + str(e))
+
+  def _poll_x(self, now):
+    self.next_poll = now + X_POLL_INTERVAL
+    try:
+      self.x = xwindows.XConnection(self.display_num)
+      self.framebuffer = framebuffer.XwdFramebuffer(
+          framebuffer.screen_path(self.display_num))
+    except (xwindows.XError, EnvironmentError, ValueError, struct.error):
+      # Xvfb is not up yet, or has not written its framebuffer yet.
+      if self.x:
+        self.x.close()
+        self.x = None
+      return
+    self.emulator = start_emulator(self.display_num, self.avd_name)
+    self._wait_for_window(now)
+
+  def _wait_for_window(self, now):
+    self.window = self.geometry = self.geometry_since = None
+    self._enter(STARTING_EMULATOR, now, EMULATOR_DEADLINE)
+    self.next_poll = now
+
+  def _poll_window(self, now):
+    self.next_poll = now + WINDOW_POLL_INTERVAL
+    # We assume that each display will only have one window with an emulator.
+    # We locate it by using the fact that the window name contains the
+    # avd_name that we specify when running the emulator.
+    if not self.window:
+      self.window = self.x.find_window(self.avd_name)
+      if not self.window:
+        return
+    geometry = self.x.geometry(self.window[0])
+    if geometry != self.geometry:
+      self.geometry = geometry
+      self.geometry_since = now
+    elif now - self.geometry_since >= WINDOW_SETTLE_SECONDS:
+      self._serve(now)
+
+  def _check_window(self, now):
+    self.next_poll = now + WINDOW_CHECK_INTERVAL
+    try:
+      geometry = self.x.geometry(self.window[0])
+    except xwindows.XError:
+      geometry = None
+    if geometry != self.geometry:
+      self.log("the emulator window changed from {} to {}".format(
+          self.geometry, geometry))
+      self._stop_serving()
+      self._wait_for_window(now)
+
+  def _serve(self, now):
+    window_x, window_y, window_width, window_height = self.geometry
+    # The emulator window is cropped out of the Xvfb framebuffer (that is
+    # mapped to a file), which we map into our memory as well, and encoded as
+    # JPEG.
+    window = framebuffer.WindowCapture(
+        self.framebuffer, window_x, window_y, window_width, window_height,
+        self.options.quality)
+    detector = framebuffer.ChangeDetector(window, self.options.tile)
+    # We grab the number that identifies the emulator (say "5554") from the
+    # window name (which in this case will be 5554:avd_name).
+    pid = int(self.window[1].split(":")[0])
+    self.log("emulator " + str(pid) + " on port " + str(self.port) +
+             ", stats on port " + str(self.stats_port))
+    quirks = QUIRK_DUMB if self.options.keepalive <= 0 else 0
+    self.broadcaster = broadcast.Broadcaster(
+        self.port, global_header(pid, window.width, window.height, quirks),
+        max_queued=self.options.max_queued, stats=self.stats)
+    self.stats_server = stats.StatsServer(self.stats_port, self.stats,
+                                          self.broadcaster)
+    self.pipeline = pipeline.FramePipeline(
+        window, detector, self.broadcaster, self.options.fps,
+        self.options.keepalive, self.options.encoders, self.stats, self.pool)
+    self.pipeline.start()
+    self._enter(SERVING, now)
+    self.next_poll = now + WINDOW_CHECK_INTERVAL
+
+  def _stop_serving(self):
+    # Closing the broadcaster first lets capture stop if it waits for clients.
+    if self.broadcaster:
+      self.broadcaster.close()
+    if self.pipeline:
+      self.pipeline.stop()
+    if self.stats_server:
+      self.stats_server.stop()
+    self.broadcaster = self.stats_server = self.pipeline = None
+
+  def fail(self, reason):
+    self.log(reason)
+    self.close()
+    self._enter(FAILED, time.time())
+
+  def close(self):
+    self._stop_serving()
+    if self.x:
+      self.x.close()
+      self.x = None
+    for process in (self.emulator, self.xvfb):
+      if process and process.poll() is None:
+        process.kill()
+
+
+class Supervisor(object):
+  """Runs any number of displays from one thread."""
+
+  def __init__(self, options):
+    """Constructor for Supervisor class.
+
+    Args:
+      options: Parsed command line options of emucapture.
+    """
+    self.options = options
+    # Started before any thread, as forking a process with threads is unsafe.
+    self.pool = multiprocessing.Pool(max(1, options.encoders))
+    self.displays = []
+
+  def add_display(self, display_num, avd_name):
+    display = Display(display_num, avd_name, self.options, self.pool)
+    display.start()
+    self.displays.append(display)
+
+  def run(self):
+    """Runs the displays until they have all failed."""
+    while True:
+      displays = [d for d in self.displays if d.state != FAILED]
+      if not displays:
+        return
+      now = time.time()
+      for display in displays:
+        if display.next_poll <= now:
+          display.poll(now)
+      servers = []
+      for display in displays:
+        servers += display.servers()
+      next_poll = min(display.next_poll for display in displays)
+      broadcast.serve_once(servers, max(0, next_poll - time.time()))
+
+  def close(self):
+    for display in self.displays:
+      display.close()
+    self.pool.terminate()
@@ -0,0 +1,158 @@
+# Copyright 2016 The Vanadium Authors. All rights reserved.
+# Use of this source code is governed by a BSD-style
+# license that can be found in the LICENSE file.
+
+"""Finds windows on an X display without running xwininfo.
+
+Speaks just enough of the X11 protocol over the display's local socket to list
+the windows, read their names and find where they are on the screen. Each call
+is a round trip of well under a millisecond to the X server, so displays can be
+polled for readiness instead of waited for. Xvfb is started with -ac, so the
+connection needs no authorization.
+
+See https://www.x.org/releases/X11R7.7/doc/xproto/x11protocol.html for the
+encoding of the requests and replies.
+"""
+
+import socket
+import struct
+
+X_SOCKET = "/tmp/.X11-unix/X%d"
+# Seconds to wait for the X server to answer.
+X_TIMEOUT = 2.0
+# Opcodes of the requests used.
+GET_GEOMETRY = 14
+QUERY_TREE = 15
+GET_PROPERTY = 20
+TRANSLATE_COORDINATES = 40
+# Predefined atoms.
+WM_NAME = 39
+ANY_PROPERTY_TYPE = 0
+# Longest window name read, in 4 byte units.
+MAX_NAME_LENGTH = 256
+SETUP = struct.Struct("<BxHHHHxx")
+SETUP_REPLY = struct.Struct("<BBHHH")
+# Fixed part of the connection setup data, up to the vendor string.
+SETUP_DATA = struct.Struct("<IIIIHHBBBBBBBB4x")
+REPLY_SIZE = 32
+
+
+class XError(Exception):
+  """The X server could not be reached or refused a request."""
+
+
+def pad4(length):
+  return (length + 3) & ~3
+
+
+class XConnection(object):
+  """A connection to a local X display."""
+
+  def __init__(self, display_num, timeout=X_TIMEOUT):
+    """Connects to the display.
+
+    Raises:
+      XError: The display is not up, or refused the connection.
+    """
+    self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    self.sock.settimeout(timeout)
+    try:
+      self.sock.connect(X_SOCKET % display_num)
+      self.sock.sendall(SETUP.pack(ord("l"), 11, 0, 0, 0))
+      status, reason_length, _, _, length = SETUP_REPLY.unpack(
+          self._read(SETUP_REPLY.size))
+      data = self._read(length * 4)
+    except socket.error as e:
+      self.sock.close()
+      raise XError("Could not connect to display :%d: %s" % (display_num, e))
+    if status != 1:
+      self.sock.close()
+      raise XError("Display :%d refused the connection: %s" % (
+          display_num, data[:reason_length]))
+    fields = SETUP_DATA.unpack_from(data)
+    vendor_length, num_formats = fields[4], fields[7]
+    # The first screen follows the vendor string and the pixmap formats, and
+    # starts with its root window.
+    offset = SETUP_DATA.size + pad4(vendor_length) + 8 * num_formats
+    self.root = struct.unpack_from("<I", data, offset)[0]
+    self.sequence = 0
+
+  def close(self):
+    self.sock.close()
+
+  def _read(self, length):
+    data = ""
+    while len(data) < length:
+      chunk = self.sock.recv(length - len(data))
+      if not chunk:
+        raise socket.error("X server closed the connection")
+      data += chunk
+    return data
+
+  def _request(self, opcode, data_byte, body):
+    """Sends a request and returns its reply.
+
+    Raises:
+      XError: The server answered with an error, e.g. because the window went
+        away, or could not be reached.
+    """
+    self.sequence = (self.sequence + 1) & 0xffff
+    request = struct.pack("<BBH", opcode, data_byte, 1 + len(body) / 4) + body
+    try:
+      self.sock.sendall(request)
+      while True:
+        reply = self._read(REPLY_SIZE)
+        kind = ord(reply[0])
+        if kind == 0:
+          code, sequence, value = struct.unpack_from("<BHI", reply, 1)
+          if sequence == self.sequence:
+            raise XError("X error %d for request %d on 0x%x" % (
+                code, opcode, value))
+        elif kind == 1:
+          length = struct.unpack_from("<I", reply, 4)[0]
+          return reply + self._read(length * 4)
+        # Anything else is an event, which nothing here asked for.
+    except socket.error as e:
+      raise XError("X request %d failed: %s" % (opcode, e))
+
+  def children(self, window):
+    """Returns the children of a window, bottom to top."""
+    reply = self._request(QUERY_TREE, 0, struct.pack("<I", window))
+    num_children = struct.unpack_from("<H", reply, 16)[0]
+    return list(struct.unpack_from("<%dI" % num_children, reply, REPLY_SIZE))
+
+  def name(self, window):
+    """Returns the WM_NAME of a window, or an empty string."""
+    reply = self._request(GET_PROPERTY, 0, struct.pack(
+        "<IIIII", window, WM_NAME, ANY_PROPERTY_TYPE, 0, MAX_NAME_LENGTH))
+    value_format, = struct.unpack_from("<B", reply, 1)
+    value_length, = struct.unpack_from("<I", reply, 16)
+    return reply[REPLY_SIZE:REPLY_SIZE + value_length * value_format / 8]
+
+  def geometry(self, window):
+    """Returns (x, y, width, height) of the inside of a window on the screen."""
+    reply = self._request(GET_GEOMETRY, 0, struct.pack("<I", window))
+    width, height = struct.unpack_from("<HH", reply, 16)
+    reply = self._request(TRANSLATE_COORDINATES, 0, struct.pack(
+        "<IIhh", window, self.root, 0, 0))
+    x, y = struct.unpack_from("<hh", reply, 12)
+    return x, y, width, height
+
+  def find_window(self, phrase):
+    """Returns (window, name) of the first window whose name has the phrase.
+
+    Windows are searched depth first from the root, like xwininfo -tree lists
+    them. Returns None if there is no such window.
+    """
+    windows = [self.root]
+    while windows:
+      window = windows.pop(0)
+      try:
+        name = self.name(window)
+        if phrase in name:
+          return window, name
+        windows[0:0] = self.children(window)
+      except XError:
+        # The window went away while it was looked at.
+        continue
+    return None